@@ -18,3 +18,16 @@ def test_get_aws_iam(mock_system):
     assert "id" in iam
     assert "secret" in iam
     assert isinstance(iam, dict)
+
+
+@patch("voithos.lib.aws.aws.get_aws_iam")
+@patch("voithos.lib.aws.aws.boto3")
+def test_get_customer_client(mock_boto3, mock_get_aws_iam):
+    """ get_customer_client uses boto3's default credentials, never the license """
+    client = aws.get_customer_client("s3", endpoint_url="https://rgw.example.com")
+    mock_boto3.Session.assert_called_once_with()
+    mock_boto3.Session.return_value.client.assert_called_once_with(
+        "s3", endpoint_url="https://rgw.example.com"
+    )
+    assert client is mock_boto3.Session.return_value.client.return_value
+    mock_get_aws_iam.assert_not_called()
@@ -0,0 +1,74 @@
+""" Shared fixtures for the VMware lib tests """
+import struct
+import zlib
+
+import pytest
+
+from voithos.lib.vmware.vmdk import FLAG_COMPRESSED, FLAG_MARKERS, HEADER_FORMAT, SPARSE_MAGIC
+
+
+def _sector_pad(data):
+    """ Pad data with zeros to a whole number of sectors """
+    return data + bytes(-len(data) % 512)
+
+
+def _metadata_marker(num_sectors, marker_type):
+    """ Return a one sector metadata marker """
+    return _sector_pad(struct.pack("<QII", num_sectors, 0, marker_type))
+
+
+def _build_stream_vmdk(grains, capacity_sectors, grain_sectors=128):
+    """Return the bytes of a streamOptimized VMDK
+
+    grains maps a grain's starting sector to its uncompressed data.
+    """
+    descriptor = _sector_pad(
+        (
+            "# Disk DescriptorFile\nversion=1\nCID=fffffffe\nparentCID=ffffffff\n"
+            'createType="streamOptimized"\n\n# Extent description\n'
+            f'RDONLY {capacity_sectors} SPARSE "disk-0.vmdk"\n\n'
+            '# The Disk Data Base\n#DDB\n\nddb.virtualHWVersion = "8"\n'
+            'ddb.adapterType = "lsilogic"\n'
+        ).encode()
+    )
+    overhead = 1 + len(descriptor) // 512
+
+    def header(gd_offset):
+        return struct.pack(
+            HEADER_FORMAT,
+            SPARSE_MAGIC,
+            3,
+            1 | FLAG_COMPRESSED | FLAG_MARKERS,
+            capacity_sectors,
+            grain_sectors,
+            1,
+            len(descriptor) // 512,
+            512,
+            0,
+            gd_offset,
+            overhead,
+            0,
+            b"\n \r\n",
+            1,
+            bytes(433),
+        )
+
+    body = bytearray(header(0xFFFFFFFFFFFFFFFF) + descriptor)
+    grain_table = [0] * 512
+    for lba in sorted(grains):
+        grain_table[lba // grain_sectors] = len(body) // 512
+        compressed = zlib.compress(grains[lba])
+        body += _sector_pad(struct.pack("<QI", lba, len(compressed)) + compressed)
+    body += _metadata_marker(4, 1) + struct.pack("<512I", *grain_table)
+    gd_offset = len(body) // 512 + 1
+    gt_offset = gd_offset - 5
+    body += _metadata_marker(1, 2) + _sector_pad(struct.pack("<I", gt_offset))
+    body += _metadata_marker(1, 3) + header(gd_offset)
+    body += _metadata_marker(0, 0)
+    return bytes(body)
+
+
+@pytest.fixture
+def make_stream_vmdk():
+    """ Fixture returning a builder of streamOptimized VMDK bytes """
+    return _build_stream_vmdk
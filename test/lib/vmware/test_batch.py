@@ -0,0 +1,106 @@
+""" Unit tests for batch VM exports """
+import json
+from threading import Lock
+from time import sleep
+from unittest.mock import MagicMock
+
+import pytest
+
+from voithos.lib.vmware.batch import BatchExporter, ConcurrencyScheduler, read_uuid_file
+
+
+def test_scheduler_respects_caps():
+    """ No resource ever has more running jobs than its cap, and every job runs """
+    lock = Lock()
+    running = {}
+    peaks = {}
+    done = []
+
+    def worker(job):
+        with lock:
+            for key in job[1]:
+                running[key] = running.get(key, 0) + 1
+                peaks[key] = max(peaks.get(key, 0), running[key])
+        sleep(0.02)
+        with lock:
+            for key in job[1]:
+                running[key] -= 1
+            done.append(job[0])
+
+    jobs = []
+    for num in range(8):
+        keys = [("vcenter", "vc"), ("host", f"esxi-{num % 2}"), ("datastore", "ds1")]
+        jobs.append(((num, keys), keys))
+    ConcurrencyScheduler({"vcenter": 3, "host": 1, "datastore": 2}).run(jobs, worker)
+    assert sorted(done) == list(range(8))
+    assert peaks[("vcenter", "vc")] <= 2  # the datastore cap is tighter
+    assert peaks[("host", "esxi-0")] == 1
+    assert peaks[("datastore", "ds1")] == 2
+
+
+def _fake_vm(num):
+    """ Return a mock VM on host esxi-<num> """
+    vm = MagicMock()
+    vm.config.uuid = f"uuid-{num}"
+    vm.name = f"vm-{num}"
+    vm.runtime.host.name = f"esxi-{num}"
+    datastore = MagicMock()
+    datastore.name = "ds1"
+    vm.datastore = [datastore]
+    return vm
+
+
+class FakeExporter:
+    """ Stands in for VMWareExporter, failing for vm-1 """
+
+    def __init__(self, vmware_mgr, vm, base_dir, interval):
+        self.vm = vm
+        self.size_in_bytes = 100
+        self.bytes_received = 0
+
+    def download(self):
+        if self.vm.name == "vm-1":
+            raise ValueError("lease refused")
+        self.bytes_received = 50
+
+
+def test_batch_summary(tmp_path):
+    """ A failed VM is recorded in the summary without stopping the others """
+    mgr = MagicMock()
+    mgr.ip_addr = "vcenter"
+    batch = BatchExporter(
+        mgr,
+        [_fake_vm(num) for num in range(3)],
+        base_dir=str(tmp_path),
+        exporter_class=FakeExporter,
+        interval=0,
+    )
+    batch.run()
+    summary = {entry["uuid"]: entry for entry in json.loads(open(batch.summary_path).read())}
+    assert summary["uuid-0"]["status"] == "done"
+    assert summary["uuid-0"]["bytes"] == 50
+    assert summary["uuid-1"]["status"] == "failed"
+    assert summary["uuid-1"]["error"] == "lease refused"
+    assert summary["uuid-2"]["datastores"] == ["ds1"]
+    assert (tmp_path / "uuid-2").is_dir()
+
+
+def test_batch_interrupt_aborts_running_exports(tmp_path):
+    """ Ctrl+C aborts the NFC lease of each running export, exports without a lease too """
+    batch = BatchExporter(MagicMock(), [_fake_vm(num) for num in range(3)], base_dir=str(tmp_path))
+    for job in batch.jobs[:2]:
+        job.status = "running"
+        job.exporter = MagicMock()
+    batch.jobs[0].exporter.lease = None  # --transport datastore
+    batch.scheduler.run = MagicMock(side_effect=KeyboardInterrupt)
+    with pytest.raises(KeyboardInterrupt):
+        batch.run()
+    assert [job.status for job in batch.jobs] == ["aborted", "aborted", "pending"]
+    batch.jobs[1].exporter.lease.HttpNfcLeaseAbort.assert_called_once_with()
+
+
+def test_read_uuid_file(tmp_path):
+    """ Blank lines and comments are skipped """
+    uuid_file = tmp_path / "wave1.txt"
+    uuid_file.write_text("# wave 1\nuuid-a\n\nuuid-b  # database\n")
+    assert read_uuid_file(str(uuid_file)) == ["uuid-a", "uuid-b"]
@@ -0,0 +1,123 @@
+""" Unit tests for the on-disk VMware inventory cache """
+import json
+from unittest.mock import MagicMock
+
+from pyVmomi import VmomiSupport, vim, vmodl
+
+from voithos.lib.vmware.cache import InventoryCache
+
+
+def _result(vms):
+    """ Return one unpaged RetrievePropertiesEx result for {moref: props} """
+    objects = [
+        vmodl.query.PropertyCollector.ObjectContent(
+            obj=vim.VirtualMachine(moref),
+            propSet=[vmodl.DynamicProperty(name=key, val=val) for key, val in props.items()],
+        )
+        for moref, props in vms.items()
+    ]
+    return MagicMock(objects=objects, token=None)
+
+
+def _conn(*results):
+    """ Return a mock connection whose property collector returns each result in turn """
+    conn = MagicMock()
+    conn._stub.version = VmomiSupport.newestVersions.GetName("vim")
+    conn.content.viewManager.CreateContainerView.return_value = vim.view.ContainerView(
+        "session[1]view-1", stub=MagicMock()
+    )
+    conn.content.propertyCollector.RetrievePropertiesEx.side_effect = list(results)
+    return conn
+
+
+def _props(name, version, power_state="poweredOff"):
+    """ Return a VM's full properties """
+    disk = vim.vm.device.VirtualDisk(key=2000, capacityInBytes=1024)
+    return {
+        "name": name,
+        "config.uuid": f"uuid-{name}",
+        "runtime.powerState": power_state,
+        "runtime.host": vim.HostSystem("host-1"),
+        "config.hardware.device": vim.vm.device.VirtualDevice.Array([disk]),
+        "config.changeVersion": version,
+    }
+
+
+def test_cache_is_used_within_ttl(tmp_path):
+    """ A fresh cache answers without asking vCenter, decoding vSphere types on use """
+    cache = InventoryCache(cache_dir=str(tmp_path), ttl=3600)
+    conn = _conn(_result({"vm-1": _props("web", "v1")}))
+    records = cache.load_records(conn, "vcenter.local", scope="DC1/vm")
+    assert [record.name for record in records] == ["web"]
+    assert (tmp_path / "vcenter.local--DC1_vm.json").exists()
+
+    conn = _conn()
+    records = cache.load_records(conn, "vcenter.local", scope="DC1/vm")
+    conn.content.propertyCollector.RetrievePropertiesEx.assert_not_called()
+    assert records[0].moref == "vm-1"
+    assert records[0].uuid == "uuid-web"
+    assert records[0].disks[0].capacityInBytes == 1024
+    assert records[0].host._moId == "host-1"
+
+
+def test_cache_refreshes_changed_vms(tmp_path):
+    """ An expired cache rereads only VMs whose changeVersion moved, and drops deleted ones """
+    cache = InventoryCache(cache_dir=str(tmp_path), ttl=0)
+    full = {
+        "vm-1": _props("web", "v1"),
+        "vm-2": _props("db", "v1"),
+        "vm-3": _props("old", "v1"),
+    }
+    cache.load_records(_conn(_result(full)), "vcenter.local")
+
+    check = {
+        "vm-1": {"config.changeVersion": "v1", "runtime.powerState": "poweredOn"},
+        "vm-2": {"config.changeVersion": "v2", "runtime.powerState": "poweredOff"},
+        "vm-4": {"config.changeVersion": "v1", "runtime.powerState": "poweredOff"},
+    }
+    conn = _conn(
+        _result(check), _result({"vm-2": _props("db-renamed", "v2"), "vm-4": _props("new", "v1")})
+    )
+    records = cache.load_records(conn, "vcenter.local")
+    assert [(record.moref, record.name) for record in records] == [
+        ("vm-1", "web"),
+        ("vm-2", "db-renamed"),
+        ("vm-4", "new"),
+    ]
+    assert records[0].power_state == "poweredOn"
+    refetch = conn.content.propertyCollector.RetrievePropertiesEx.call_args_list[1]
+    object_set = refetch[1]["specSet"][0].objectSet
+    assert [spec.obj._moId for spec in object_set] == ["vm-2", "vm-4"]
+    with open(tmp_path / "vcenter.local.json") as file_:
+        assert sorted(json.load(file_)["vms"]) == ["vm-1", "vm-2", "vm-4"]
+
+
+def test_cache_drops_vm_deleted_during_refresh(tmp_path):
+    """ A changed VM deleted before it is reread loses its old cached record """
+    cache = InventoryCache(cache_dir=str(tmp_path), ttl=0)
+    full = {"vm-1": _props("web", "v1"), "vm-2": _props("db", "v1")}
+    cache.load_records(_conn(_result(full)), "vcenter.local")
+
+    check = {
+        "vm-1": {"config.changeVersion": "v2", "runtime.powerState": "poweredOff"},
+        "vm-2": {"config.changeVersion": "v2", "runtime.powerState": "poweredOff"},
+    }
+    conn = _conn(
+        _result(check),
+        vmodl.fault.ManagedObjectNotFound(obj=vim.VirtualMachine("vm-2")),
+        _result({"vm-1": _props("web", "v2")}),
+    )
+    records = cache.load_records(conn, "vcenter.local")
+    assert [record.moref for record in records] == ["vm-1"]
+    with open(tmp_path / "vcenter.local.json") as file_:
+        assert list(json.load(file_)["vms"]) == ["vm-1"]
+
+
+def test_refresh_rebuilds(tmp_path):
+    """ refresh=True ignores the saved cache """
+    InventoryCache(cache_dir=str(tmp_path)).load_records(
+        _conn(_result({"vm-1": _props("web", "v1")})), "vcenter.local"
+    )
+    cache = InventoryCache(cache_dir=str(tmp_path), refresh=True)
+    records = cache.load_records(_conn(_result({"vm-9": _props("app", "v1")})), "vcenter.local")
+    assert [record.moref for record in records] == ["vm-9"]
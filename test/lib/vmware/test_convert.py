@@ -0,0 +1,86 @@
+""" Unit tests for the VMware stream conversion lib """
+import struct
+from unittest.mock import MagicMock
+
+from voithos.lib.vmware.convert import Qcow2ImageWriter, StreamConverter
+
+
+GRAIN = 128 * 512
+
+
+def _read_qcow2(path):
+    """ Return the guest contents of a qcow2 image written by Qcow2ImageWriter """
+    data = path.read_bytes()
+    magic, version = struct.unpack(">II", data[:8])
+    assert (magic, version) == (0x514649FB, 2)
+    cluster_bits, size = struct.unpack(">IQ", data[20:32])
+    l1_size, l1_offset = struct.unpack(">IQ", data[36:48])
+    cluster_size = 1 << cluster_bits
+    guest = bytearray(size)
+    for l1_index in range(l1_size):
+        entry_at = l1_offset + l1_index * 8
+        (l2_offset,) = struct.unpack(">Q", data[entry_at : entry_at + 8])
+        l2_offset &= (1 << 62) - 1
+        if not l2_offset:
+            continue
+        for l2_index in range(cluster_size // 8):
+            entry_at = l2_offset + l2_index * 8
+            (host,) = struct.unpack(">Q", data[entry_at : entry_at + 8])
+            host &= (1 << 62) - 1
+            if host:
+                start = (l1_index * cluster_size // 8 + l2_index) * cluster_size
+                guest[start : start + cluster_size] = data[host : host + cluster_size]
+    return bytes(guest)
+
+
+def _session_for(body):
+    """ Return a mock requests session streaming body """
+    resp = MagicMock()
+    resp.iter_content.return_value = [body[i : i + 1000] for i in range(0, len(body), 1000)]
+    session = MagicMock()
+    session.get.return_value.__enter__.return_value = resp
+    return session
+
+
+def test_stream_convert_raw(tmp_path, make_stream_vmdk):
+    """ A streamed VMDK is written to a raw file with each grain at its offset """
+    grains = {0: b"\x01" * GRAIN, 256: b"\x02" * GRAIN}
+    body = make_stream_vmdk(grains, capacity_sectors=512)
+    target = tmp_path / "disk-0.raw"
+    converter = StreamConverter(_session_for(body), "https://esxi/d", str(target))
+    converter.run()
+    converter.raise_for_error()
+    assert converter.thick_size == 512 * 512
+    assert converter.bytes_written == len(body)
+    assert target.read_bytes() == b"\x01" * GRAIN + bytes(GRAIN) + b"\x02" * GRAIN + bytes(GRAIN)
+
+
+def test_stream_convert_qcow2(tmp_path, make_stream_vmdk):
+    """ A streamed VMDK is written to a readable qcow2 image """
+    grains = {128: b"\x03" * GRAIN, 384: b"\x04" * 1000}
+    body = make_stream_vmdk(grains, capacity_sectors=512)
+    target = tmp_path / "disk-0.qcow2"
+    converter = StreamConverter(
+        _session_for(body), "https://esxi/d", str(target), image_format="qcow2"
+    )
+    converter.run()
+    converter.raise_for_error()
+    expected = bytes(GRAIN) + b"\x03" * GRAIN + bytes(GRAIN) + b"\x04" * 1000 + bytes(GRAIN - 1000)
+    assert _read_qcow2(target) == expected
+
+
+def test_qcow2_refcounts(tmp_path):
+    """ Every cluster in the image, metadata included, has a refcount of one """
+    target = tmp_path / "disk.qcow2"
+    writer = Qcow2ImageWriter(str(target), 10 * GRAIN)
+    writer.write(3 * GRAIN, b"\x05" * GRAIN)
+    writer.close()
+    data = target.read_bytes()
+    rt_offset, rt_clusters = struct.unpack(">QI", data[48:60])
+    (block_offset,) = struct.unpack(">Q", data[rt_offset : rt_offset + 8])
+    num_clusters = len(data) // GRAIN
+    block = data[block_offset : block_offset + num_clusters * 2]
+    refcounts = struct.unpack(f">{num_clusters}H", block)
+    assert len(data) % GRAIN == 0
+    assert rt_clusters == 1
+    assert set(refcounts) == {1}
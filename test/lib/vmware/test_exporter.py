@@ -0,0 +1,111 @@
+""" Unit tests for VMWareExporter's datastore transport """
+import json
+from unittest.mock import MagicMock, patch
+
+import pytest
+from pyVmomi import vim
+
+from voithos.lib.vmware.exporter import VMWareExporter, VMWareTransportNotSupported
+
+
+class _FolderServer:
+    """ Stand-in for a requests session serving datastore files with range support """
+
+    def __init__(self, files):
+        self.files = files
+        self.cookies = {}
+
+    def get(self, url, stream=True, timeout=None, headers=None):
+        data = self.files[url]
+        first, last = headers["Range"].replace("bytes=", "").split("-")
+        last = int(last) if last else len(data) - 1
+        resp = MagicMock()
+        resp.status_code = 206
+        resp.headers = {"Content-Range": f"bytes {first}-{last}/{len(data)}"}
+        body = data[int(first) : last + 1]
+        resp.iter_content.return_value = [body[i : i + 64] for i in range(0, len(body), 64)]
+        ctx = MagicMock()
+        ctx.__enter__.return_value = resp
+        return ctx
+
+
+def _vm(parent=None, file_names=("[ds1] vm1/vm1.vmdk",)):
+    """ Return a powered-off mock VM with a flat disk per file name """
+    vm = MagicMock()
+    vm.name = "vm1"
+    vm.config.uuid = "uuid-1"
+    vm.runtime.powerState = vim.VirtualMachine.PowerState.poweredOff
+    vm.parent = MagicMock(spec=vim.Datacenter)
+    vm.parent.name = "dc1"
+    vm.config.hardware.device = [
+        vim.vm.device.VirtualDisk(
+            capacityInBytes=4096,
+            backing=vim.vm.device.VirtualDisk.FlatVer2BackingInfo(fileName=name, parent=parent),
+        )
+        for name in file_names
+    ]
+    return vm
+
+
+def _mgr():
+    """ Return a mock VMWareMgr """
+    mgr = MagicMock()
+    mgr.ip_addr = "vcenter"
+    mgr.conn._stub.cookie = 'vmware_soap_session="abc"; Path=/; HttpOnly'
+    return mgr
+
+
+def test_datastore_transport_lands_raw_files(tmp_path):
+    """ The flat extent is fetched in ranges without an NFC lease and lands as a raw file """
+    vm = _vm()
+    data = bytes(range(256)) * 16
+    url = "https://vcenter/folder/vm1/vm1-flat.vmdk?dcPath=dc1&dsName=ds1"
+    server = _FolderServer({url: data})
+    exporter = VMWareExporter(
+        _mgr(), vm, base_dir=str(tmp_path), interval=0, chunk_size=256, transport="datastore"
+    )
+    with patch("voithos.lib.vmware.exporter.get_session", return_value=server):
+        exporter.download()
+    vm.ExportVm.assert_not_called()
+    assert "vmware_soap_session" in server.cookies
+    assert (tmp_path / "vm1.raw").read_bytes() == data
+    manifest = json.loads((tmp_path / "uuid-1.manifest.json").read_text())
+    assert manifest["disks"][0]["target_id"] == "vm1.vmdk"
+
+
+def test_datastore_transport_names_disks_apart(tmp_path):
+    """ Disks with the same file name on different datastores land in separate files """
+    vm = _vm(file_names=["[ds1] vm1/vm1.vmdk", "[ds2] vm1/vm1.vmdk", "[ds1] vm1/vm1_1.vmdk"])
+    files = {
+        "https://vcenter/folder/vm1/vm1-flat.vmdk?dcPath=dc1&dsName=ds1": b"a" * 4096,
+        "https://vcenter/folder/vm1/vm1-flat.vmdk?dcPath=dc1&dsName=ds2": b"b" * 4096,
+        "https://vcenter/folder/vm1/vm1_1-flat.vmdk?dcPath=dc1&dsName=ds1": b"c" * 4096,
+    }
+    exporter = VMWareExporter(
+        _mgr(), vm, base_dir=str(tmp_path), interval=0, chunk_size=256, transport="datastore"
+    )
+    assert exporter.get_datastore_target_ids() == [
+        "ds1_vm1_vm1.vmdk",
+        "ds2_vm1_vm1.vmdk",
+        "vm1_1.vmdk",
+    ]
+    with patch("voithos.lib.vmware.exporter.get_session", return_value=_FolderServer(files)):
+        exporter.download()
+    assert (tmp_path / "ds1_vm1_vm1.raw").read_bytes() == b"a" * 4096
+    assert (tmp_path / "ds2_vm1_vm1.raw").read_bytes() == b"b" * 4096
+    assert (tmp_path / "vm1_1.raw").read_bytes() == b"c" * 4096
+
+
+def test_datastore_transport_refuses_deltas(tmp_path):
+    """ Snapshot and linked clone deltas, and vSAN objects, have no flat extent to fetch """
+    parent = vim.vm.device.VirtualDisk.FlatVer2BackingInfo(fileName="[ds1] base/base.vmdk")
+    with pytest.raises(VMWareTransportNotSupported):
+        VMWareExporter(_mgr(), _vm(parent=parent), base_dir=str(tmp_path), transport="datastore")
+    with pytest.raises(VMWareTransportNotSupported):
+        VMWareExporter(
+            _mgr(), _vm(), base_dir=str(tmp_path), transport="datastore", convert_to="qcow2"
+        )
+    vsan = _vm()
+    vsan.config.hardware.device[0].backing.backingObjectId = "52a1b2c3-vsan-object"
+    with pytest.raises(VMWareTransportNotSupported):
+        VMWareExporter(_mgr(), vsan, base_dir=str(tmp_path), transport="datastore")
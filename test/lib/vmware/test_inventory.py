@@ -0,0 +1,109 @@
+""" Unit tests for bulk VMware inventory loading """
+from unittest.mock import MagicMock
+
+from pyVmomi import vim, vmodl
+
+from voithos.lib.vmware.inventory import VMIndex, VMRecord, load_vm_records
+from voithos.lib.vmware.mgr import VMWareMgr
+
+
+def _content(moref, name, uuid):
+    """ Return the property collector's result for one VM """
+    props = {"name": name, "config.uuid": uuid, "runtime.powerState": "poweredOff"}
+    return vmodl.query.PropertyCollector.ObjectContent(
+        obj=vim.VirtualMachine(moref),
+        propSet=[vmodl.DynamicProperty(name=key, val=val) for key, val in props.items()],
+    )
+
+
+def _conn(pages):
+    """ Return a mock connection whose property collector returns pages of VMs """
+    conn = MagicMock()
+    view = vim.view.ContainerView("session[1]view-1", stub=MagicMock())
+    conn.content.viewManager.CreateContainerView.return_value = view
+    results = [
+        MagicMock(objects=page, token=f"page-{number + 1}" if number + 1 < len(pages) else None)
+        for number, page in enumerate(pages)
+    ]
+    collector = conn.content.propertyCollector
+    collector.RetrievePropertiesEx.return_value = results[0]
+    collector.ContinueRetrievePropertiesEx.side_effect = results[1:]
+    return conn
+
+
+def _mgr(conn, scope=None):
+    """ Return a VMWareMgr on conn without connecting, its inventory not loaded yet """
+    mgr = VMWareMgr.__new__(VMWareMgr)
+    mgr.conn = conn
+    mgr.scope = scope
+    mgr.cache = None
+    mgr._records = None
+    mgr.index = None
+    return mgr
+
+
+def test_load_vm_records_pages():
+    """ Every page is read into plain records, and the view is destroyed """
+    conn = _conn([[_content("vm-1", "web-01", "u-1")], [_content("vm-2", "db-01", "u-2")]])
+    records = load_vm_records(conn, page_size=1)
+    assert [(record.moref, record.name, record.uuid) for record in records] == [
+        ("vm-1", "web-01", "u-1"),
+        ("vm-2", "db-01", "u-2"),
+    ]
+    assert records[0].power_state == "poweredOff"
+    assert records[0].instance_uuid is None
+    assert records[0].disks == []
+    collector = conn.content.propertyCollector
+    collector.ContinueRetrievePropertiesEx.assert_called_once_with(token="page-1")
+    view = conn.content.viewManager.CreateContainerView.return_value
+    view._stub.InvokeMethod.assert_called_once()  # DestroyView
+
+
+def test_mgr_lookups_use_records():
+    """ The manager finds VMs by name and UUID from the records """
+    mgr = _mgr(_conn([[_content("vm-1", "web-01", "u-1"), _content("vm-2", "db-01", "u-2")]]))
+    mgr.load_vms()
+    assert mgr.find_vm_by_uuid("u-2")._moId == "vm-2"
+    assert mgr.find_vm_by_uuid("u-3") is None
+    assert [vm._moId for vm in mgr.find_vms_by_name(["web"])] == ["vm-1"]
+    assert len(mgr.find_vms_by_name(["*"])) == 2
+
+
+def test_vm_index():
+    """ Records are found by either UUID, the first VM keeps a duplicated BIOS UUID """
+    first = VMRecord(vim.VirtualMachine("vm-1"), {"name": "web", "config.uuid": "u-1"})
+    clone = VMRecord(
+        vim.VirtualMachine("vm-2"),
+        {"name": "web", "config.uuid": "u-1", "config.instanceUuid": "i-2"},
+    )
+    index = VMIndex([first, clone])
+    assert index.find_by_uuid("u-1") is first
+    assert index.find_by_uuid("i-2") is clone
+    assert index.find_by_uuid("u-3") is None
+
+
+def test_mgr_uuid_lookup_without_inventory():
+    """ Without loaded records, a UUID is looked up through the SearchIndex alone """
+    mgr = _mgr(MagicMock())
+    search_index = mgr.conn.content.searchIndex
+    found = vim.VirtualMachine("vm-7")
+    search_index.FindByUuid.side_effect = [None, found]
+    assert mgr.find_vm_by_uuid("i-7") is found
+    assert search_index.FindByUuid.call_args[1]["instanceUuid"] is True
+    mgr.conn.content.propertyCollector.RetrievePropertiesEx.assert_not_called()
+
+
+def test_mgr_loads_scope_on_first_use():
+    """ Records load when first needed, from a view of the scope's container """
+    conn = _conn([[_content("vm-1", "web-01", "u-1")]])
+    cluster = vim.ClusterComputeResource("domain-c7")
+    conn.content.searchIndex.FindByInventoryPath.return_value = cluster
+    mgr = _mgr(conn, scope="/DC1/host/Cluster1")
+    conn.content.propertyCollector.RetrievePropertiesEx.assert_not_called()
+    assert [vm._moId for vm in mgr.vms] == ["vm-1"]
+    conn.content.searchIndex.FindByInventoryPath.assert_called_once_with(
+        inventoryPath="DC1/host/Cluster1"
+    )
+    assert conn.content.viewManager.CreateContainerView.call_args[0][0] is cluster
+    assert mgr.find_vm_by_uuid("u-1")._moId == "vm-1"
+    conn.content.searchIndex.FindByUuid.assert_not_called()
@@ -0,0 +1,37 @@
+""" Unit tests for the NFC lease keepalive """
+from time import sleep
+from unittest.mock import MagicMock
+
+from voithos.lib.vmware.lease import LeaseKeepalive
+
+
+def test_keepalive_renews_every_lease():
+    """ Every registered lease is renewed with its own progress on the timer """
+    first, second = MagicMock(), MagicMock()
+    renewed = []
+    with LeaseKeepalive(interval=0.01, on_renew=renewed.append) as keepalive:
+        keepalive.add(first, name="first", percent_fn=lambda: 42)
+        keepalive.add(second, name="second")
+        sleep(0.1)
+    count = len(renewed)
+    sleep(0.05)
+    assert len(renewed) == count  # the thread stopped with the with block
+    first.HttpNfcLeaseProgress.assert_called_with(42)
+    second.HttpNfcLeaseProgress.assert_called_with(0)
+    status = {state["lease"]: state for state in keepalive.status()}
+    assert status["first"]["renewals"] >= 1
+    assert status["first"]["last_latency_ms"] is not None
+
+
+def test_keepalive_survives_failed_renewal():
+    """ A failed renewal is recorded and the thread keeps going """
+    lease = MagicMock()
+    lease.HttpNfcLeaseProgress.side_effect = [TimeoutError("slow"), None, None]
+    keepalive = LeaseKeepalive()
+    keepalive.add(lease, name="vm")
+    keepalive.renew_all()
+    keepalive.renew_all()
+    status = keepalive.status()[0]
+    assert status["failures"] == 1
+    assert status["renewals"] == 1
+    assert status["last_error"] == "slow"
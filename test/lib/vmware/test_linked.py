@@ -0,0 +1,128 @@
+""" Unit tests for linked clone exports """
+from collections import Counter
+from unittest.mock import MagicMock, patch
+
+import pytest
+from pyVmomi import vim
+
+from voithos.lib.vmware.linked import LinkedCloneExport, VMWareLinkedCloneExportFailed
+
+
+DELTA_DESCRIPTOR = """# Disk DescriptorFile
+version=1
+CID=fffffffe
+parentCID=aaaaaaaa
+createType="vmfsSparse"
+parentFileNameHint="/vmfs/volumes/5f1c-ds1/base/base.vmdk"
+RW 8 VMFSSPARSE "{name}-000001-delta.vmdk"
+"""
+
+
+class _FolderServer:
+    """ Serves datastore files by URL, counting the requests for each """
+
+    def __init__(self, files):
+        self.files = files
+        self.cookies = {}
+        self.requests = Counter()
+
+    def get(self, url, stream=True, timeout=None, headers=None):
+        path = url.split("/folder/")[1].split("?")[0]
+        self.requests[path] += 1
+        data = self.files[path]
+        resp = MagicMock()
+        ctx = MagicMock()
+        ctx.__enter__.return_value = resp
+        if not headers:
+            resp.status_code = 200
+            resp.iter_content.return_value = [data]
+            return ctx
+        first, last = headers["Range"].replace("bytes=", "").split("-")
+        last = int(last) if last else len(data) - 1
+        resp.status_code = 206
+        resp.headers = {"Content-Range": f"bytes {first}-{last}/{len(data)}"}
+        resp.iter_content.return_value = [data[int(first) : last + 1]]
+        return ctx
+
+
+def _clone(name):
+    """ Return a powered-off linked clone of base/base.vmdk """
+    vm = MagicMock()
+    vm.name = name
+    vm.config.uuid = f"uuid-{name}"
+    vm.runtime.powerState = vim.VirtualMachine.PowerState.poweredOff
+    vm.parent = MagicMock(spec=vim.Datacenter)
+    vm.parent.name = "dc1"
+    base = vim.vm.device.VirtualDisk.FlatVer2BackingInfo(fileName="[ds1] base/base.vmdk")
+    delta = vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+        fileName=f"[ds1] {name}/{name}-000001.vmdk", parent=base
+    )
+    disk = vim.vm.device.VirtualDisk(
+        key=2000, backing=delta, deviceInfo=vim.Description(label="Hard disk 1", summary="")
+    )
+    vm.config.hardware.device = [disk]
+    files = [
+        ("[ds1] base/base.vmdk", "diskDescriptor", 100),
+        ("[ds1] base/base-flat.vmdk", "diskExtent", 4096),
+        (f"[ds1] {name}/{name}-000001.vmdk", "diskDescriptor", 200),
+        (f"[ds1] {name}/{name}-000001-delta.vmdk", "diskExtent", 512),
+    ]
+    vm.layoutEx = vim.vm.FileLayoutEx(
+        file=[
+            vim.vm.FileLayoutEx.FileInfo(key=key, name=path, type=kind, size=size)
+            for key, (path, kind, size) in enumerate(files)
+        ],
+        disk=[
+            vim.vm.FileLayoutEx.DiskLayout(
+                key=2000,
+                chain=[
+                    vim.vm.FileLayoutEx.DiskUnit(fileKey=[0, 1]),
+                    vim.vm.FileLayoutEx.DiskUnit(fileKey=[2, 3]),
+                ],
+            )
+        ],
+    )
+    return vm
+
+
+def test_linked_clones_share_the_base(tmp_path):
+    """ The base is downloaded once, deltas are rebased onto it, and flattening is per VM """
+    server = _FolderServer(
+        {
+            "base/base.vmdk": b"# Disk DescriptorFile\n",
+            "base/base-flat.vmdk": b"b" * 4096,
+            "a/a-000001.vmdk": DELTA_DESCRIPTOR.format(name="a").encode(),
+            "a/a-000001-delta.vmdk": b"a" * 512,
+            "b/b-000001.vmdk": DELTA_DESCRIPTOR.format(name="b").encode(),
+            "b/b-000001-delta.vmdk": b"c" * 512,
+        }
+    )
+    mgr = MagicMock()
+    mgr.ip_addr = "vcenter"
+    mgr.conn._stub.cookie = 'vmware_soap_session="abc"; Path=/; HttpOnly'
+    export = LinkedCloneExport(
+        mgr, [_clone("a"), _clone("b")], base_dir=str(tmp_path), flatten="qcow2", interval=0
+    )
+    with patch("voithos.lib.vmware.linked.get_session", return_value=server), patch(
+        "voithos.lib.vmware.linked.qemu_img.convert_chain"
+    ) as convert_chain:
+        report = export.run()
+    # one range probe, then the file itself
+    assert server.requests["base/base-flat.vmdk"] == 2
+    datastore = tmp_path / "datastore" / "ds1"
+    assert (datastore / "base" / "base-flat.vmdk").read_bytes() == b"b" * 4096
+    delta = (datastore / "a" / "a-000001.vmdk").read_text()
+    assert 'parentFileNameHint="../base/base.vmdk"' in delta
+    assert report["saved_bytes"] == 4096 + 100
+    assert [link["shared"] for link in report["vms"][0]["chain"]] == [True, False]
+    assert convert_chain.call_count == 2
+    output_path = convert_chain.call_args_list[1][0][3]
+    assert output_path == str(tmp_path / "uuid-b" / "b-000001.qcow2")
+
+
+def test_delta_without_file_layout_is_refused():
+    """ A delta's extent name is not guessed when the VM has no file layout """
+    clone = _clone("a")
+    clone.layoutEx = None
+    with pytest.raises(VMWareLinkedCloneExportFailed, match="no file layout"):
+        LinkedCloneExport(MagicMock(), [clone])
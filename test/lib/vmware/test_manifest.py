@@ -0,0 +1,96 @@
+""" Unit tests for export manifests and disk verification """
+import hashlib
+from unittest.mock import MagicMock
+
+from voithos.lib.vmware.manifest import ExportManifest, verify_manifests
+from voithos.lib.vmware.transfer import DiskDownload, DownloadJournal, SegmentedDownload
+
+
+def _mock_session(chunks, status_code=200):
+    """ Return a mock requests session whose GET streams the given chunks """
+    resp = MagicMock()
+    resp.status_code = status_code
+    resp.iter_content.return_value = chunks
+    session = MagicMock()
+    session.get.return_value.__enter__.return_value = resp
+    return session
+
+
+def test_resumed_download_digest_covers_whole_file(tmp_path):
+    """ The digest of a resumed download includes the bytes kept from the earlier run """
+    file_path = tmp_path / "disk-0.vmdk"
+    file_path.write_bytes(b"a" * 10 + b"garbage")
+    journal = DownloadJournal(str(tmp_path / "vm.journal.json"))
+    journal.commit("disk-0", 10)
+    download = DiskDownload(
+        _mock_session([b"b" * 5], status_code=206),
+        "https://x/d",
+        file_path,
+        journal=journal,
+        target_id="disk-0",
+        resume=True,
+    )
+    download.run()
+    download.raise_for_error()
+    expected = hashlib.sha256(b"a" * 10 + b"b" * 5).hexdigest()
+    assert download.sha256 == expected
+    assert DownloadJournal(journal.path).get_digest("disk-0") == expected
+
+
+def test_manifest_verify(tmp_path):
+    """ verify passes untouched disks, fails changed ones and skips undigested ones """
+    manifest = ExportManifest(str(tmp_path / "vm.manifest.json"), vm_uuid="uuid-1")
+    for name, data in [("disk-0.vmdk", b"x" * 100), ("disk-1.vmdk", b"y" * 100)]:
+        download = DiskDownload(_mock_session([data]), "https://x/d", tmp_path / name)
+        download.target_id = name
+        download.run()
+        manifest.add(download.manifest_entry())
+    manifest.add(
+        {
+            "target_id": "disk-2.vmdk",
+            "file": "disk-2.raw",
+            "bytes": 1,
+            "sha256": None,
+            "sha256_note": "image written out of order, only its VMDK stream is hashed",
+        }
+    )
+    manifest.write()
+    assert ExportManifest.load(manifest.path).disks[0]["file"] == "disk-0.vmdk"
+    (tmp_path / "disk-1.vmdk").write_bytes(b"y" * 99 + b"z")
+    results = verify_manifests([manifest.path], workers=2)
+    assert [result["status"] for result in results] == ["ok", "failed", "skipped"]
+    assert "sha256" in results[1]["message"]
+    assert "VMDK stream" in results[2]["message"]
+
+
+def test_manifest_verify_segments(tmp_path):
+    """ A segmented download is verified segment by segment, without a whole-file digest """
+    data = bytes(range(256)) * 4
+    session = MagicMock()
+
+    def get(url, headers=None, **kwargs):
+        first, last = headers["Range"].split("=")[1].split("-")
+        last = int(last) if last else len(data) - 1
+        resp = MagicMock()
+        resp.status_code = 206
+        resp.headers = {"Content-Range": f"bytes {first}-{last}/{len(data)}"}
+        resp.iter_content.return_value = [data[int(first) : last + 1]]
+        ctx = MagicMock()
+        ctx.__enter__.return_value = resp
+        return ctx
+
+    session.get.side_effect = get
+    manifest = ExportManifest(str(tmp_path / "vm.manifest.json"))
+    download = SegmentedDownload(
+        session, "https://x/d", str(tmp_path / "disk-0.vmdk"), chunk_size=16, segments=4
+    )
+    download.run()
+    download.raise_for_error()
+    manifest.add(download.manifest_entry())
+    manifest.write()
+    assert manifest.disks[0]["sha256"] is None
+    assert [result["status"] for result in verify_manifests([manifest.path])] == ["ok"]
+    (tmp_path / "disk-0.vmdk").write_bytes(data[:-1] + b"x")
+    results = verify_manifests([manifest.path])
+    assert results[0]["status"] == "failed"
+    assert "offset 768" in results[0]["message"]
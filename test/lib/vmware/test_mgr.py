@@ -0,0 +1,44 @@
+""" Unit tests for the VMware manager """
+from unittest.mock import MagicMock, patch
+
+from voithos.lib.vmware.mgr import VMWareMgr
+
+
+def _mgr(api_type="VirtualCenter"):
+    """ Return a VMWareMgr with a mock connection, without connecting """
+    mgr = VMWareMgr.__new__(VMWareMgr)
+    mgr.ip_addr = "vcenter"
+    mgr.conn = MagicMock()
+    mgr.conn.content.about.apiType = api_type
+    mgr.host_addresses = {}
+    return mgr
+
+
+def _vm():
+    """ Return a mock VM on host esxi-01 with one VMkernel NIC """
+    vm = MagicMock()
+    vm.runtime.host.name = "esxi-01"
+    vnic = MagicMock()
+    vnic.spec.ip.ipAddress = "10.0.0.11"
+    vm.runtime.host.config.network.vnic = [vnic]
+    return vm
+
+
+def test_get_host_address_prefers_host_name():
+    """ A reachable host name is used, and the lookup is cached """
+    mgr = _mgr()
+    with patch("voithos.lib.vmware.mgr._reachable", return_value=True) as reachable:
+        assert mgr.get_host_address(_vm()) == "esxi-01"
+        assert mgr.get_host_address(_vm()) == "esxi-01"
+    assert reachable.call_count == 1
+
+
+def test_get_host_address_fallbacks():
+    """ The VMkernel IP is tried next, then the configured address """
+    mgr = _mgr()
+    with patch("voithos.lib.vmware.mgr._reachable", side_effect=lambda addr: addr != "esxi-01"):
+        assert mgr.get_host_address(_vm()) == "10.0.0.11"
+    mgr = _mgr()
+    with patch("voithos.lib.vmware.mgr._reachable", return_value=False):
+        assert mgr.get_host_address(_vm()) == "vcenter"
+    assert _mgr(api_type="HostAgent").get_host_address(_vm()) == "vcenter"
@@ -0,0 +1,82 @@
+""" Unit tests for reporting on several vCenters at once """
+import json
+import time
+
+import pytest
+
+from voithos.lib.vmware import multi
+from voithos.lib.vmware.multi import MultiVCenterReport, VCenter, read_vcenters_file
+
+
+class FakeMgr:
+    """ A VMWareMgr whose VMs are its vCenter's address plus a number, found after a delay """
+
+    delays = {"vc1": 0.3, "vc2": 0.3, "vc3": 0.3}
+
+    def __init__(self, username=None, password=None, ip_addr=None, scope=None, cache=None):
+        """ Connecting to "bad" fails the way an invalid login does """
+        if ip_addr == "bad":
+            raise SystemExit(1)
+        self.ip_addr = ip_addr
+        self.conn = None
+
+    def find_vms_by_name(self, names):
+        """ Return two VM names """
+        time.sleep(self.delays[self.ip_addr])
+        return [f"{self.ip_addr}-vm{num}" for num in range(2)]
+
+
+@pytest.fixture(autouse=True)
+def fake_reports(monkeypatch):
+    """ Report each VM as {"name": vm} """
+    monkeypatch.setattr(
+        multi.reports, "iter_vm_reports", lambda conn, vms: ({"name": vm} for vm in vms)
+    )
+
+
+def test_reports_are_merged_and_tagged():
+    """ vCenters are queried in parallel, a failed one is recorded and the rest still report """
+    vcenters = [VCenter("vc1"), VCenter("bad"), VCenter("vc2", name="dr"), VCenter("vc3")]
+    report = MultiVCenterReport(vcenters, names=["*"], mgr_class=FakeMgr)
+    start = time.monotonic()
+    collected = list(report.iter_reports())
+    assert time.monotonic() - start < 0.6
+    assert sorted((item["vcenter"], item["name"]) for item in collected) == [
+        ("dr", "vc2-vm0"),
+        ("dr", "vc2-vm1"),
+        ("vc1", "vc1-vm0"),
+        ("vc1", "vc1-vm1"),
+        ("vc3", "vc3-vm0"),
+        ("vc3", "vc3-vm1"),
+    ]
+    assert list(report.failures) == ["bad"]
+    assert report.counts == {"vc1": 2, "bad": 0, "dr": 2, "vc3": 2}
+
+
+def test_reader_can_stop_early():
+    """ Closing the stream early releases workers waiting on a full queue """
+    vcenters = [VCenter("vc1"), VCenter("vc2")]
+    report = MultiVCenterReport(vcenters, names=["*"], queued_reports=1, mgr_class=FakeMgr)
+    stream = report.iter_reports()
+    assert next(stream)["name"].endswith("vm0")
+    stream.close()
+    assert report.failures == {}
+
+
+def test_read_vcenters_file(tmp_path):
+    """ Missing credentials and scopes fall back to the defaults given """
+    path = tmp_path / "vcenters.json"
+    path.write_text(
+        json.dumps([{"ip_addr": "vc1", "username": "admin"}, {"ip_addr": "vc2", "name": "dr"}])
+    )
+    vcenters = read_vcenters_file(str(path), username="root", password="secret", scope="DC1")
+    assert [(vc.name, vc.username, vc.password, vc.scope) for vc in vcenters] == [
+        ("vc1", "admin", "secret", "DC1"),
+        ("dr", "root", "secret", "DC1"),
+    ]
+    path.write_text(json.dumps([{"ip_addr": "vc1"}, {"ip_addr": "vc1"}]))
+    with pytest.raises(ValueError):
+        read_vcenters_file(str(path))
+    path.write_text(json.dumps([{"name": "vc1"}]))
+    with pytest.raises(ValueError):
+        read_vcenters_file(str(path))
@@ -0,0 +1,154 @@
+""" Unit tests for streaming VMware disks into an S3-compatible store """
+
+import hashlib
+from threading import Lock
+from unittest.mock import MagicMock
+
+import pytest
+
+from voithos.lib.aws.s3 import MIN_PART_SIZE, MultipartUploadFailed, get_part_size
+from voithos.lib.vmware.objectstore import S3DiskUpload, S3Target
+from voithos.lib.vmware.transfer import DownloadJournal
+
+
+class FakeS3:
+    """ An in-memory stand-in for the multipart calls of a boto3 S3 client """
+
+    def __init__(self):
+        self.uploads = {}  # upload ID: {"Key", "Initiated", "parts": {number: bytes}}
+        self.objects = {}
+        self.uploaded_parts = []
+        self.fail_part = None
+        self.lock = Lock()
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = f"upload-{len(self.uploads)}"
+        self.uploads[upload_id] = {"Key": Key, "Initiated": len(self.uploads), "parts": {}}
+        return {"UploadId": upload_id}
+
+    def list_multipart_uploads(self, Bucket, Prefix):
+        uploads = [
+            {"Key": upload["Key"], "UploadId": upload_id, "Initiated": upload["Initiated"]}
+            for upload_id, upload in self.uploads.items()
+            if upload["Key"].startswith(Prefix)
+        ]
+        return {"Uploads": uploads}
+
+    def list_parts(self, Bucket, Key, UploadId, PartNumberMarker=0):
+        parts = sorted(self.uploads[UploadId]["parts"].items())
+        parts = [(number, data) for number, data in parts if number > PartNumberMarker]
+        page = [
+            {"PartNumber": number, "ETag": f"etag-{number}", "Size": len(data)}
+            for number, data in parts[:1]
+        ]
+        truncated = len(parts) > 1
+        resp = {"Parts": page, "IsTruncated": truncated}
+        if truncated:
+            resp["NextPartNumberMarker"] = page[-1]["PartNumber"]
+        return resp
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if PartNumber == self.fail_part:
+            raise ConnectionError("reset")
+        with self.lock:
+            self.uploads[UploadId]["parts"][PartNumber] = Body
+            self.uploaded_parts.append(PartNumber)
+        return {"ETag": f"etag-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        upload = self.uploads.pop(UploadId)
+        numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+        self.objects[Key] = b"".join(upload["parts"][number] for number in numbers)
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId)
+
+
+def _mock_session(data, status_code=200, chunk_size=MIN_PART_SIZE // 2):
+    """ Return a mock requests session whose GET streams data in chunks """
+    resp = MagicMock()
+    resp.status_code = status_code
+    chunks = [data[start : start + chunk_size] for start in range(0, len(data), chunk_size)]
+    resp.iter_content.return_value = chunks
+    session = MagicMock()
+    session.get.return_value.__enter__.return_value = resp
+    return session
+
+
+DATA = bytes(range(256)) * (MIN_PART_SIZE * 2 // 256) + b"tail"
+
+
+def test_upload_streams_parts():
+    """ The stream is cut into part-size parts and assembled into one object """
+    client = FakeS3()
+    target = S3Target(client, "exports", prefix="/dc1/", part_size=MIN_PART_SIZE)
+    upload = S3DiskUpload(_mock_session(DATA), "https://x/d", target, "dc1/vm/disk-0.vmdk")
+    upload.run()
+    upload.raise_for_error()
+    assert upload.file_path == "s3://exports/dc1/vm/disk-0.vmdk"
+    assert client.objects["dc1/vm/disk-0.vmdk"] == DATA
+    assert sorted(client.uploaded_parts) == [1, 2, 3]
+    assert upload.sha256 == hashlib.sha256(DATA).hexdigest()
+    assert upload.allocated_size() is None
+
+
+def test_upload_resumes_after_uploaded_parts(tmp_path):
+    """ A resumed upload continues after the full parts S3 holds, with a Range request """
+    client = FakeS3()
+    client.fail_part = 3
+    target = S3Target(client, "exports", part_size=MIN_PART_SIZE, workers=1)
+    upload = S3DiskUpload(_mock_session(DATA), "https://x/d", target, "vm/disk-0.vmdk")
+    upload.run()
+    with pytest.raises(Exception):
+        upload.raise_for_error()
+    assert "vm/disk-0.vmdk" not in client.objects
+
+    client.fail_part = None
+    client.uploaded_parts = []
+    journal = DownloadJournal(str(tmp_path / "vm.journal.json"))
+    session = _mock_session(DATA[MIN_PART_SIZE * 2 :], status_code=206)
+    upload = S3DiskUpload(
+        session,
+        "https://x/d",
+        target,
+        "vm/disk-0.vmdk",
+        journal=journal,
+        target_id="disk-0.vmdk",
+        resume=True,
+    )
+    upload.run()
+    upload.raise_for_error()
+    assert session.get.call_args[1]["headers"] == {"Range": f"bytes={MIN_PART_SIZE * 2}-"}
+    assert client.uploaded_parts == [3]
+    assert client.objects["vm/disk-0.vmdk"] == DATA
+    assert upload.sha256 is None  # the parts kept in S3 were never rehashed
+    assert "S3" in upload.manifest_entry()["sha256_note"]
+    assert DownloadJournal(journal.path).is_complete("disk-0.vmdk")
+
+
+def test_upload_without_resume_aborts_old_upload():
+    """ Starting over discards the parts of an unfinished upload of the same key """
+    client = FakeS3()
+    client.create_multipart_upload(Bucket="exports", Key="vm/disk-0.vmdk")
+    target = S3Target(client, "exports", part_size=MIN_PART_SIZE)
+    upload = S3DiskUpload(_mock_session(DATA), "https://x/d", target, "vm/disk-0.vmdk")
+    upload.run()
+    upload.raise_for_error()
+    assert client.uploads == {}
+    assert client.objects["vm/disk-0.vmdk"] == DATA
+
+
+def test_part_size_grows_to_fit_part_limit():
+    """ Parts are at least S3's minimum and big enough for 10,000 of them to hold the disk """
+    assert get_part_size(1024, None) == MIN_PART_SIZE
+    assert get_part_size(MIN_PART_SIZE, 10000 * MIN_PART_SIZE * 3) == MIN_PART_SIZE * 3
+
+
+def test_failed_part_raises():
+    """ A part that can't be uploaded fails the upload """
+    client = FakeS3()
+    client.fail_part = 1
+    target = S3Target(client, "exports", part_size=MIN_PART_SIZE)
+    upload = S3DiskUpload(_mock_session(DATA), "https://x/d", target, "vm/disk-0.vmdk")
+    upload.run()
+    assert isinstance(upload.error, MultipartUploadFailed)
@@ -0,0 +1,82 @@
+""" Unit tests for streamed VM report output """
+import csv
+import io
+import json
+
+from voithos.lib.vmware.output import CSV_COLUMNS, write_reports
+
+
+def _report(name, networks):
+    """ Return a minimal get_vm_data report """
+    return {
+        "uuid": f"uuid-{name}",
+        "name": name,
+        "guest_os": "Ubuntu Linux (64-bit)",
+        "num_cpu": 2,
+        "ram": {"total_mb": 4096},
+        "storage": {
+            "num_disks": 1,
+            "disks": [{"capacity_gb": 20, "shared": False}],
+            "partitions": {"total_used_gb": 6.123},
+        },
+        "network": {
+            "num_interfaces": len(networks),
+            "networks": [{"vswitch_name": network} for network in networks],
+        },
+    }
+
+
+REPORTS = [_report("web, 01", ["VM Network", 'DMZ "a"']), _report("db-01", [])]
+
+
+def test_json_matches_whole_list():
+    """ The streamed array is what json.dumps of the whole list gives """
+    stream = io.StringIO()
+    assert write_reports(iter(REPORTS), "json", stream) == 2
+    assert stream.getvalue() == json.dumps(REPORTS) + "\n"
+    stream = io.StringIO()
+    write_reports(iter([]), "json", stream)
+    assert json.loads(stream.getvalue()) == []
+
+
+def test_ndjson_one_report_per_line():
+    """ Each line is one report """
+    stream = io.StringIO()
+    write_reports(iter(REPORTS), "ndjson", stream)
+    assert [json.loads(line) for line in stream.getvalue().splitlines()] == REPORTS
+
+
+def test_csv_quotes_values():
+    """ Commas and quotes in values survive a round trip through a CSV reader """
+    stream = io.StringIO()
+    write_reports(iter(REPORTS), "csv", stream)
+    rows = list(csv.reader(io.StringIO(stream.getvalue())))
+    assert rows[0] == CSV_COLUMNS
+    assert rows[1][:2] == ["uuid-web, 01", "web, 01"]
+    assert rows[1][7] == "6.12"
+    assert rows[1][9] == 'VM Network ||| DMZ "a"'
+    assert rows[2][9] == ""
+    assert len(rows) == 3
+
+
+def test_reports_are_consumed_lazily():
+    """ A report is written before the next one is built """
+    stream = io.StringIO()
+    seen = []
+
+    def generate():
+        for report in REPORTS:
+            seen.append(stream.getvalue().count("\n"))
+            yield report
+
+    write_reports(generate(), "ndjson", stream)
+    assert seen == [0, 1]
+
+
+def test_csv_extra_columns():
+    """ Extra report keys lead each CSV row """
+    stream = io.StringIO()
+    write_reports(iter([dict(REPORTS[1], vcenter="vc1")]), "csv", stream, extra_columns=["vcenter"])
+    rows = list(csv.reader(io.StringIO(stream.getvalue())))
+    assert rows[0] == ["vcenter"] + CSV_COLUMNS
+    assert rows[1][:2] == ["vc1", "uuid-db-01"]
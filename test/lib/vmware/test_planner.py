@@ -0,0 +1,97 @@
+""" Unit tests for the migration wave planner """
+import json
+import time
+
+import pytest
+
+from voithos.lib.vmware.planner import WavePlanError, WavePlanner, read_inventory
+
+
+def _report(name, capacity_gb, used_gb=0, num_cpu=2, ram_mb=4096):
+    """ Return the parts of a get_vm_data report the planner reads """
+    return {
+        "uuid": f"uuid-{name}",
+        "name": name,
+        "num_cpu": num_cpu,
+        "ram": {"total_mb": ram_mb},
+        "storage": {
+            "disks": [{"capacity_gb": capacity_gb}],
+            "partitions": {"total_used_gb": used_gb},
+        },
+    }
+
+
+def _names(waves):
+    """ Return the VM names of each wave """
+    return [sorted(report["name"] for report in wave.reports) for wave in waves]
+
+
+def test_first_fit_decreasing():
+    """ The largest VMs are placed first, each in the first wave with room for it """
+    # 100 MB/s for 1 hour moves 351.5625 GB
+    planner = WavePlanner(1, 100)
+    reports = [
+        _report("a", 100),
+        _report("b", 300),
+        _report("c", 200),
+        _report("d", 500, used_gb=150),
+        _report("e", 50),
+    ]
+    waves = planner.plan(reports)
+    assert _names(waves) == [["b", "e"], ["c", "d"], ["a"]]
+    summary = waves[0].as_dict(100)
+    assert summary["transfer_gb"] == 350
+    assert summary["duration_hours"] == 1.0
+    assert summary["oversized"] is False
+
+
+def test_landing_capacity_and_oversized():
+    """ Landing limits split waves, an item over a limit on its own gets its own wave """
+    planner = WavePlanner(100, 1000, max_cores=8)
+    reports = [_report(name, 10, num_cpu=4) for name in "abc"] + [_report("big", 10, num_cpu=16)]
+    waves = planner.plan(reports)
+    assert _names(waves) == [["big"], ["a", "b"], ["c"]]
+    assert [wave.oversized for wave in waves] == [True, False, False]
+
+
+def test_groups_move_together():
+    """ Group members share a wave, matched by name or UUID """
+    planner = WavePlanner(100, 1000, max_cores=8)
+    reports = [_report(name, 10, num_cpu=2) for name in "abcde"]
+    waves = planner.plan(reports, {"erp": ["a", "uuid-e", "c"]})
+    assert _names(waves) == [["a", "b", "c", "e"], ["d"]]
+    assert waves[0].as_dict(1000)["groups"] == ["erp"]
+    with pytest.raises(WavePlanError):
+        planner.plan(reports, {"erp": ["a"], "web": ["a"]})
+    with pytest.raises(WavePlanError):
+        planner.plan(reports, {"erp": ["missing"]})
+    with pytest.raises(WavePlanError):
+        WavePlanner(0, 100)
+
+
+def test_empty_inventory():
+    """ An inventory with no VMs, such as a filter that matched nothing, plans no waves """
+    assert WavePlanner(8, 200, max_cores=64).plan([]) == []
+
+
+def test_thousands_of_vms():
+    """ Thousands of VMs are planned in seconds, every VM exactly once """
+    reports = [_report(f"vm-{num}", 20 + num % 700, num_cpu=1 + num % 16) for num in range(5000)]
+    planner = WavePlanner(8, 200, max_cores=512, max_storage_gb=20000)
+    start = time.monotonic()
+    waves = planner.plan(reports)
+    assert time.monotonic() - start < 5
+    assert sorted(name for names in _names(waves) for name in names) == sorted(
+        report["name"] for report in reports
+    )
+    assert all(wave.transfer_gb <= 8 * 3600 * 200 / 1024 for wave in waves)
+
+
+def test_read_inventory(tmp_path):
+    """ show-vm json and ndjson output are both read """
+    reports = [_report("a", 10), _report("b", 20)]
+    path = tmp_path / "inventory.json"
+    path.write_text(json.dumps(reports))
+    assert read_inventory(str(path)) == reports
+    path.write_text("\n".join(json.dumps(report) for report in reports) + "\n")
+    assert read_inventory(str(path)) == reports
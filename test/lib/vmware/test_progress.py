@@ -0,0 +1,74 @@
+""" Unit tests for VMware export progress reporting """
+import io
+import json
+from unittest.mock import MagicMock
+
+from voithos.lib.vmware.progress import ExportProgress
+from voithos.lib.vmware.transfer import DiskDownload
+
+
+def _download(tmp_path, name, chunks=None, exc=None):
+    """ Return a DiskDownload backed by a mock session """
+    session = MagicMock()
+    if exc is not None:
+        session.get.side_effect = exc
+    else:
+        session.get.return_value.__enter__.return_value.iter_content.return_value = chunks
+    return DiskDownload(session, f"https://esxi/{name}", str(tmp_path / name))
+
+
+def _events(stream):
+    """ Return the NDJSON events written to stream """
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_export_progress_json_events(tmp_path):
+    """ Byte callbacks feed the counters and every event is one JSON line """
+    stream = io.StringIO()
+    progress = ExportProgress(1000, interval=0, output_format="json", stream=stream, name="vm")
+    downloads = [
+        _download(tmp_path, "disk-0.vmdk", [b"a" * 100, b"b" * 50]),
+        _download(tmp_path, "disk-1.vmdk", [b"c" * 10]),
+    ]
+    for index, download in enumerate(downloads):
+        progress.add(f"disk-{index}.vmdk", download)
+    progress.start()
+    for download in downloads:
+        download.start()
+    ticks = []
+    assert progress.wait(on_tick=ticks.append) is None
+    progress.report()
+    progress.complete()
+    events = _events(stream)
+    assert [event["event"] for event in events[:1] + events[-2:]] == [
+        "start",
+        "progress",
+        "complete",
+    ]
+    assert sorted(e["target_id"] for e in events if e["event"] == "disk_done") == [
+        "disk-0.vmdk",
+        "disk-1.vmdk",
+    ]
+    report = events[-2]
+    assert {disk["bytes"] for disk in report["disks"]} == {150, 10}
+    assert all(disk["done"] and disk["eta_seconds"] == 0 for disk in report["disks"])
+    assert events[-1]["bytes"] == 160
+    assert ticks
+
+
+def test_export_progress_returns_failure(tmp_path):
+    """ wait() returns the failed download as soon as it finishes """
+    stream = io.StringIO()
+    progress = ExportProgress(1000, interval=0, output_format="json", stream=stream)
+    download = _download(tmp_path, "disk-0.vmdk", exc=ConnectionError("reset"))
+    progress.add("disk-0.vmdk", download)
+    progress.start()
+    download.start()
+    assert progress.wait() is download
+    assert _events(stream)[-1] == {
+        "event": "error",
+        "ts": _events(stream)[-1]["ts"],
+        "vm": "",
+        "target_id": "disk-0.vmdk",
+        "message": "reset",
+    }
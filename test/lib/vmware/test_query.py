@@ -0,0 +1,131 @@
+""" Unit tests for the VM query language """
+from unittest.mock import MagicMock
+
+import pytest
+from pyVmomi import vim, vmodl
+
+from voithos.lib.vmware.inventory import VMRecord
+from voithos.lib.vmware.query import (
+    QueryContext,
+    VMQuery,
+    VMQueryError,
+    filter_records,
+    load_query_records,
+)
+
+
+def _record(moref, name, power, datastores, disk_gb, host="host-1"):
+    """ Return a VM record with the properties queries use """
+    disk = vim.vm.device.VirtualDisk(key=2000, capacityInBytes=disk_gb * 1024 ** 3)
+    return VMRecord(
+        vim.VirtualMachine(moref),
+        {
+            "name": name,
+            "runtime.powerState": power,
+            "runtime.host": vim.HostSystem(host),
+            "datastore": [vim.Datastore(ds) for ds in datastores],
+            "config.hardware.device": [disk],
+            "config.hardware.memoryMB": 4096,
+        },
+    )
+
+
+def _context():
+    """ Return a QueryContext whose names are already known """
+    context = QueryContext(MagicMock())
+    context.names = {
+        vim.Datastore: {"ds-1": "ssd-01", "ds-2": "sata-01"},
+        vim.HostSystem: {"host-1": "esxi-01"},
+    }
+    context.host_clusters = {"host-1": "Prod"}
+    return context
+
+
+RECORDS = [
+    _record("vm-1", "web-01", "poweredOff", ["ds-1"], 300),
+    _record("vm-2", "web-02", "poweredOn", ["ds-1"], 300),
+    _record("vm-3", "db-01", "poweredOff", ["ds-2", "ds-1"], 100),
+    _record("vm-4", "db-02", "poweredOff", ["ds-2"], 500),
+]
+
+
+@pytest.mark.parametrize(
+    "text,expected",
+    [
+        ("power=off AND datastore~ssd* AND disk_gb>200", ["vm-1"]),
+        ("power=off and datastore~ssd*", ["vm-1", "vm-3"]),
+        ("datastore!=ssd-01", ["vm-4"]),
+        ("name~db* AND disk_gb >= 500 OR name=WEB-02", ["vm-2", "vm-4"]),
+        ("cluster=prod AND ram_gb=4 AND host=esxi-01", ["vm-1", "vm-2", "vm-3", "vm-4"]),
+        ('name="web 01"', []),
+    ],
+)
+def test_query_matches(text, expected):
+    """ Conditions compare ignoring case, AND binds tighter than OR, lists match any item """
+    query = VMQuery(text)
+    context = _context()
+    matched = [
+        record.moref
+        for record in RECORDS
+        if query.matches(context.get_values(record, query.fields))
+    ]
+    assert matched == expected
+
+
+@pytest.mark.parametrize(
+    "text",
+    ["colour=red", "name>3", "disk_gb>lots", "disk_gb~200", "AND power=off", "power", "name='x"],
+)
+def test_query_errors(text):
+    """ Invalid expressions raise VMQueryError """
+    with pytest.raises(VMQueryError):
+        VMQuery(text)
+
+
+def test_query_pushdown():
+    """ Only an exact cluster or datastore condition without OR narrows the traversal """
+    assert VMQuery("power=off AND cluster=Prod").get_pushdown() == ("cluster", "Prod")
+    assert VMQuery("datastore=ssd-01").get_pushdown() == ("datastore", "ssd-01")
+    assert VMQuery("datastore~ssd*").get_pushdown() is None
+    assert VMQuery("cluster=Prod OR power=on").get_pushdown() is None
+    assert VMQuery("disk_gb>10").property_paths == [
+        "config.hardware.device",
+        "config.uuid",
+        "name",
+    ]
+
+
+def _result(obj_props):
+    """ Return one unpaged RetrievePropertiesEx result """
+    objects = [
+        vmodl.query.PropertyCollector.ObjectContent(
+            obj=obj,
+            propSet=[vmodl.DynamicProperty(name=key, val=val) for key, val in props.items()],
+        )
+        for obj, props in obj_props
+    ]
+    return MagicMock(objects=objects, token=None)
+
+
+def test_load_query_records_in_cluster():
+    """ A cluster= query reads the VMs of that cluster only, and only the fields it needs """
+    conn = MagicMock()
+    view_manager = conn.content.viewManager
+    view_manager.CreateContainerView.side_effect = lambda *args: vim.view.ContainerView(
+        "session[1]view-1", stub=MagicMock()
+    )
+    cluster = vim.ClusterComputeResource("domain-c7")
+    vm = vim.VirtualMachine("vm-1")
+    conn.content.propertyCollector.RetrievePropertiesEx.side_effect = [
+        _result([(cluster, {"name": "Prod"})]),
+        _result([(vm, {"name": "web-01", "runtime.host": vim.HostSystem("host-1")})]),
+        _result([(vim.ClusterComputeResource("domain-c7"), {"name": "Prod"})]),
+        _result([(vim.HostSystem("host-1"), {"parent": cluster})]),
+    ]
+    query = VMQuery("cluster=prod")
+    records = load_query_records(conn, query)
+    assert view_manager.CreateContainerView.call_args_list[1][0][0] is cluster
+    calls = conn.content.propertyCollector.RetrievePropertiesEx.call_args_list
+    vm_spec = calls[1][1]["specSet"][0]
+    assert vm_spec.propSet[0].pathSet == ["config.uuid", "name", "runtime.host"]
+    assert [record.moref for record in filter_records(conn, query, records)] == ["vm-1"]
@@ -0,0 +1,120 @@
+""" Unit tests for VMware VM reports """
+import json
+from datetime import datetime
+from unittest.mock import MagicMock
+
+from pyVmomi import vim, vmodl
+
+from voithos.lib.vmware import reports
+
+
+def _props(name):
+    """ Return a VM's REPORT_PROPERTIES values """
+    disk = vim.vm.device.VirtualDisk(
+        key=2000,
+        capacityInBytes=20 * 1024 ** 3,
+        deviceInfo=vim.Description(label="Hard disk 1", summary=""),
+        backing=vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+            fileName="[ds] a/a.vmdk", diskMode="persistent", uuid="disk-uuid", sharing="sharingNone"
+        ),
+    )
+    nic = vim.vm.device.VirtualVmxnet3(
+        key=4000,
+        macAddress="00:50:56:00:00:01",
+        deviceInfo=vim.Description(label="Network adapter 1", summary=""),
+        backing=vim.vm.device.VirtualEthernetCard.NetworkBackingInfo(deviceName="VM Network"),
+        connectable=vim.vm.device.VirtualDevice.ConnectInfo(
+            connected=True, startConnected=True, allowGuestControl=True
+        ),
+        slotInfo=vim.vm.device.VirtualDevice.PciBusSlotInfo(pciSlotNumber=192),
+    )
+    partition = vim.vm.GuestInfo.DiskInfo(
+        diskPath="/", capacity=10 * 1024 ** 3, freeSpace=4 * 1024 ** 3
+    )
+    summary_config = vim.vm.Summary.ConfigSummary(
+        name=name,
+        uuid=f"uuid-{name}",
+        guestFullName="Ubuntu Linux (64-bit)",
+        numCpu=4,
+        memorySizeMB=8192,
+        numVirtualDisks=1,
+        numEthernetCards=1,
+        template=False,
+    )
+    return {
+        "name": name,
+        "summary.config": summary_config,
+        "summary.quickStats.uptimeSeconds": 3600,
+        "summary.overallStatus": vim.ManagedEntity.Status.green,
+        "config.createDate": datetime(2020, 1, 2, 3, 4, 5),
+        "config.hardware.device": vim.vm.device.VirtualDevice.Array([disk, nic]),
+        "runtime.powerState": vim.VirtualMachine.PowerState.poweredOn,
+        "guest.disk": vim.vm.GuestInfo.DiskInfo.Array([partition]),
+    }
+
+
+def _mock_vm(props):
+    """ Return a mock VM whose attributes hold props, as get_vm_data reads them one by one """
+    vm = MagicMock()
+    vm.name = props["name"]
+    vm.summary.config = props["summary.config"]
+    vm.summary.quickStats.uptimeSeconds = props["summary.quickStats.uptimeSeconds"]
+    vm.summary.overallStatus = props["summary.overallStatus"]
+    vm.config.createDate = props["config.createDate"]
+    vm.config.hardware.device = props["config.hardware.device"]
+    vm.runtime.powerState = props["runtime.powerState"]
+    vm.guest.disk = props["guest.disk"]
+    return vm
+
+
+def test_batched_reports_match_per_vm_reports():
+    """ Reports built from one batched call are identical to get_vm_data's, in order """
+    names = ["web-01", "db-01", "app-01"]
+    results = [
+        MagicMock(
+            objects=[
+                vmodl.query.PropertyCollector.ObjectContent(
+                    obj=vim.VirtualMachine(f"vm-{name}"),
+                    propSet=[
+                        vmodl.DynamicProperty(name=key, val=val)
+                        for key, val in _props(name).items()
+                    ],
+                )
+                for name in batch
+            ],
+            token=None,
+        )
+        for batch in (names[:2], names[2:])
+    ]
+    conn = MagicMock()
+    conn.content.propertyCollector.RetrievePropertiesEx.side_effect = results
+    vms = [vim.VirtualMachine(f"vm-{name}") for name in names]
+    batched = list(reports.iter_vm_reports(conn, vms, batch_size=2))
+    expected = [reports.get_vm_data(_mock_vm(_props(name))) for name in names]
+    assert batched == expected
+    assert json.dumps(batched) == json.dumps(expected)
+    assert batched[0]["storage"]["partitions"]["total_used_gb"] == 6.0
+    assert conn.content.propertyCollector.RetrievePropertiesEx.call_count == 2
+
+
+def test_reports_skip_deleted_vm():
+    """ A VM deleted before its batch is read is left out, the rest of the batch is reported """
+    result = MagicMock(
+        objects=[
+            vmodl.query.PropertyCollector.ObjectContent(
+                obj=vim.VirtualMachine("vm-web-01"),
+                propSet=[vmodl.DynamicProperty(name=k, val=v) for k, v in _props("web-01").items()],
+            )
+        ],
+        token=None,
+    )
+    conn = MagicMock()
+    collector = conn.content.propertyCollector
+    collector.RetrievePropertiesEx.side_effect = [
+        vmodl.fault.ManagedObjectNotFound(obj=vim.VirtualMachine("vm-gone")),
+        result,
+    ]
+    vms = [vim.VirtualMachine("vm-web-01"), vim.VirtualMachine("vm-gone")]
+    assert [report["name"] for report in reports.iter_vm_reports(conn, vms)] == ["web-01"]
+    retry_spec = collector.RetrievePropertiesEx.call_args[1]["specSet"][0]
+    assert [spec.obj._moId for spec in retry_spec.objectSet] == ["vm-web-01"]
@@ -0,0 +1,42 @@
+""" Unit tests for VMware download bandwidth shaping """
+import json
+
+from voithos.lib.vmware.throttle import BYTES_IN_MB, BandwidthShaper, TokenBucket
+
+
+def test_token_bucket_debt():
+    """ Overdrawing the bucket returns the time needed to repay the debt """
+    bucket = TokenBucket(rate_bps=1000)
+    assert 1.9 < bucket.take(2000) <= 2.0
+    assert 2.9 < bucket.take(1000) <= 3.0
+
+
+def test_token_bucket_unlimited():
+    """ A bucket without a rate never makes callers wait """
+    bucket = TokenBucket()
+    assert bucket.take(10 ** 12) == 0
+    bucket.set_rate(1000)
+    assert bucket.take(1000) > 0
+
+
+def test_shaper_waits_for_slowest_level():
+    """ A stream is held to the tightest of the global, host and VM limits """
+    shaper = BandwidthShaper(global_bps=10000, host_bps=1000, vm_bps=5000)
+    waits = [bucket.take(1000) for bucket in shaper._buckets("esxi-01", "vm-1")]
+    assert max(waits) == waits[1]
+
+
+def test_shaper_control_file(tmp_path):
+    """ Control file limits replace the given ones, keys it omits keep the given limits """
+    control = tmp_path / "limits.json"
+    limits = {"global_mbps": 100, "host_mbps": None, "hosts": {"esxi-01": 10}}
+    control.write_text(json.dumps(limits))
+    shaper = BandwidthShaper(host_bps=5, vm_bps=1)
+    shaper.load_control_file(str(control))
+    assert shaper.global_bucket.rate_bps == 100 * BYTES_IN_MB
+    assert shaper.host_bps is None
+    assert shaper.vm_bps == 1
+    global_bucket, host_bucket, vm_bucket = shaper._buckets("esxi-01", "vm-1")
+    assert host_bucket.rate_bps == 10 * BYTES_IN_MB
+    assert vm_bucket.rate_bps == 1
+    assert shaper._buckets("esxi-02", "vm-1")[1].rate_bps is None
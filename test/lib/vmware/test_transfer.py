@@ -0,0 +1,228 @@
+""" Unit tests for the VMware HTTP transfer lib """
+
+import hashlib
+from unittest.mock import MagicMock
+
+import pytest
+
+from voithos.lib.vmware.transfer import (
+    DiskDownload,
+    DownloadJournal,
+    SegmentedDownload,
+    VMWareDownloadFailed,
+)
+
+
+def _mock_session(chunks, status_code=200):
+    """ Return a mock requests session whose GET streams the given chunks """
+    resp = MagicMock()
+    resp.status_code = status_code
+    resp.iter_content.return_value = chunks
+    session = MagicMock()
+    session.get.return_value.__enter__.return_value = resp
+    return session
+
+
+def test_disk_download_counts_bytes(tmp_path):
+    """ DiskDownload writes every chunk and counts the bytes written """
+    file_path = tmp_path / "disk-0.vmdk"
+    download = DiskDownload(_mock_session([b"a" * 10, b"", b"b" * 5]), "https://x/d", file_path)
+    download.run()
+    download.raise_for_error()
+    assert download.done
+    assert download.bytes_written == 15
+    assert file_path.read_bytes() == b"a" * 10 + b"b" * 5
+
+
+def test_disk_download_raises_errors(tmp_path):
+    """ A failed stream is kept and raised as VMWareDownloadFailed """
+    session = MagicMock()
+    session.get.side_effect = ConnectionError("reset")
+    download = DiskDownload(session, "https://x/d", tmp_path / "disk-0.vmdk")
+    download.start()
+    download.join()
+    assert download.done
+    with pytest.raises(VMWareDownloadFailed):
+        download.raise_for_error()
+
+
+def test_disk_download_resumes_from_journal(tmp_path):
+    """ A journaled download continues with a Range request and drops uncommitted bytes """
+    file_path = tmp_path / "disk-0.vmdk"
+    file_path.write_bytes(b"a" * 10 + b"garbage")
+    journal = DownloadJournal(str(tmp_path / "vm.journal.json"))
+    journal.commit("disk-0", 10)
+    session = _mock_session([b"b" * 5], status_code=206)
+    download = DiskDownload(
+        session, "https://x/d", file_path, journal=journal, target_id="disk-0", resume=True
+    )
+    download.run()
+    download.raise_for_error()
+    assert session.get.call_args[1]["headers"] == {"Range": "bytes=10-"}
+    assert file_path.read_bytes() == b"a" * 10 + b"b" * 5
+    assert DownloadJournal(journal.path).is_complete("disk-0")
+    assert DownloadJournal(journal.path).get_offset("disk-0") == 15
+
+
+def test_disk_download_resume_fallback(tmp_path):
+    """ When the server ignores Range, the disk is downloaded again from the start """
+    file_path = tmp_path / "disk-0.vmdk"
+    file_path.write_bytes(b"a" * 10)
+    journal = DownloadJournal(str(tmp_path / "vm.journal.json"))
+    journal.commit("disk-0", 10)
+    session = _mock_session([b"c" * 4], status_code=200)
+    download = DiskDownload(
+        session, "https://x/d", file_path, journal=journal, target_id="disk-0", resume=True
+    )
+    download.run()
+    download.raise_for_error()
+    assert download.resumed_from == 0
+    assert file_path.read_bytes() == b"c" * 4
+
+
+class _RangeServer:
+    """ Stand-in for a requests session serving data with HTTP range support """
+
+    def __init__(self, data):
+        self.data = data
+
+    def get(self, url, stream=True, timeout=None, headers=None):
+        """ Return a response for the requested byte range """
+        first, last = headers["Range"].replace("bytes=", "").split("-")
+        last = int(last) if last else len(self.data) - 1
+        resp = MagicMock()
+        resp.status_code = 206
+        resp.headers = {"Content-Range": f"bytes {first}-{last}/{len(self.data)}"}
+        body = self.data[int(first) : last + 1]
+        resp.iter_content.return_value = [body[i : i + 3] for i in range(0, len(body), 3)]
+        ctx = MagicMock()
+        ctx.__enter__.return_value = resp
+        return ctx
+
+
+def test_segmented_download(tmp_path):
+    """ SegmentedDownload reassembles parallel byte ranges in order """
+    data = bytes(range(256)) * 4
+    file_path = tmp_path / "disk-0.vmdk"
+    journal = DownloadJournal(str(tmp_path / "vm.journal.json"))
+    download = SegmentedDownload(
+        _RangeServer(data),
+        "https://esxi/d",
+        file_path,
+        chunk_size=16,
+        journal=journal,
+        target_id="disk-0",
+        segments=5,
+    )
+    download.run()
+    download.raise_for_error()
+    assert file_path.read_bytes() == data
+    assert download.bytes_written == len(data)
+    assert journal.is_complete("disk-0")
+    segments = download.manifest_entry()["segments"]
+    assert [segment["offset"] for segment in segments] == [0, 205, 410, 615, 820]
+    for segment in segments:
+        chunk = data[segment["offset"] : segment["offset"] + segment["bytes"]]
+        assert segment["sha256"] == hashlib.sha256(chunk).hexdigest()
+
+
+def test_segmented_download_fallback(tmp_path):
+    """ SegmentedDownload streams the whole file when ranges are refused """
+    file_path = tmp_path / "disk-0.vmdk"
+    download = SegmentedDownload(
+        _mock_session([b"a" * 64]), "https://esxi/d", file_path, chunk_size=16, segments=4
+    )
+    download.run()
+    download.raise_for_error()
+    assert file_path.read_bytes() == b"a" * 64
+
+
+def test_disk_download_leaves_zero_runs_sparse(tmp_path):
+    """ All-zero blocks are seeked over, including at the end of the file """
+    block = 64 * 1024
+    data = b"a" * block + bytes(block * 4) + b"b" * block + bytes(block * 2)
+    file_path = tmp_path / "disk-0.vmdk"
+    download = DiskDownload(_mock_session([data[:block * 3], data[block * 3 :]]), "u", file_path)
+    download.run()
+    download.raise_for_error()
+    assert file_path.read_bytes() == data
+    assert download.sparse_bytes == block * 6
+    assert download.allocated_size() <= len(data)
+
+
+def test_segmented_resume_clears_stale_zero_ranges(tmp_path):
+    """ Zero data landing over a reused file's stale bytes must still read back as zeros """
+    block = 64 * 1024
+    data = b"a" * block + bytes(block * 3)
+    file_path = tmp_path / "disk-0.vmdk"
+    file_path.write_bytes(b"a" * block + b"x" * block * 3)
+    journal = DownloadJournal(str(tmp_path / "vm.journal.json"))
+    journal.commit_segment("disk-0", 0, block)
+    journal.commit_segment("disk-0", block * 2, 0)
+    download = SegmentedDownload(
+        _RangeServer(data),
+        "https://esxi/d",
+        file_path,
+        chunk_size=16,
+        journal=journal,
+        target_id="disk-0",
+        resume=True,
+        segments=2,
+    )
+    download.run()
+    download.raise_for_error()
+    assert file_path.read_bytes() == data
+    # The finished first segment is rehashed from the file, the second as it arrives
+    assert download.segment_digests == {
+        0: hashlib.sha256(data[: block * 2]).hexdigest(),
+        block * 2: hashlib.sha256(data[block * 2 :]).hexdigest(),
+    }
+
+
+def test_segmented_download_to_block_device(tmp_path, monkeypatch):
+    """ A block device is never truncated, stale bytes under zero runs are cleared """
+    block = 64 * 1024
+    data = b"a" * block + bytes(block * 2) + b"b" * block
+    device = tmp_path / "sdx"
+    device.write_bytes(b"x" * (len(data) + block))
+    monkeypatch.setattr("voithos.lib.vmware.transfer.is_block_device", lambda path: True)
+    download = SegmentedDownload(
+        _RangeServer(data), "https://esxi/d", str(device), chunk_size=16, segments=2
+    )
+    download.run()
+    download.raise_for_error()
+    contents = device.read_bytes()
+    assert contents[: len(data)] == data
+    assert contents[len(data) :] == b"x" * block
+    assert download.segment_digests == {
+        0: hashlib.sha256(data[: block * 2]).hexdigest(),
+        block * 2: hashlib.sha256(data[block * 2 :]).hexdigest(),
+    }
+
+    small = tmp_path / "sdy"
+    small.write_bytes(b"x" * block)
+    download = SegmentedDownload(
+        _RangeServer(data), "https://esxi/d", str(small), chunk_size=16, segments=2
+    )
+    download.run()
+    with pytest.raises(VMWareDownloadFailed):
+        download.raise_for_error()
+
+
+def test_segmented_download_thick_size(tmp_path, make_stream_vmdk):
+    """ A VMDK stream's thick size is its virtual size, a raw extent's is its length """
+    vmdk = make_stream_vmdk({0: b"a" * 64 * 1024}, capacity_sectors=2048)
+    download = SegmentedDownload(
+        _RangeServer(vmdk), "https://esxi/d", tmp_path / "disk-0.vmdk", chunk_size=16, segments=2
+    )
+    download.run()
+    download.raise_for_error()
+    assert download.thick_size == 2048 * 512
+    assert download.bytes_written == len(vmdk) != download.thick_size
+
+    raw = b"r" * 4096
+    download = SegmentedDownload(
+        _RangeServer(raw), "https://esxi/d", tmp_path / "disk-0.raw", chunk_size=16, segments=2
+    )
+    download.run()
+    assert download.thick_size == len(raw)
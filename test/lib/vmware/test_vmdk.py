@@ -0,0 +1,72 @@
+""" Unit tests for the pure-Python VMDK reader """
+import io
+
+import pytest
+
+from voithos.lib.vmware.vmdk import (
+    VMDKFormatError,
+    VMDKInfo,
+    count_stream_grains,
+    iter_grains,
+    read_stream_header,
+)
+
+
+GRAIN = 128 * 512
+
+
+def test_vmdk_info_stream_optimized(tmp_path, make_stream_vmdk):
+    """ VMDKInfo reads the size, descriptor and grain count of a streamOptimized file """
+    path = tmp_path / "disk-0.vmdk"
+    path.write_bytes(make_stream_vmdk({0: b"\x01" * GRAIN, 256: b"\x02" * GRAIN}, 1024))
+    info = VMDKInfo(str(path), count_grains=True)
+    assert info.virtual_size == 1024 * 512
+    assert info.descriptor.create_type == "streamOptimized"
+    assert info.descriptor.ddb["adapterType"] == "lsilogic"
+    assert info.descriptor.extents[0]["sectors"] == 1024
+    assert info.allocated_grains == 2
+    assert info.allocated_size == 2 * GRAIN
+
+
+def test_iter_grains(make_stream_vmdk):
+    """ iter_grains yields each grain's offset and inflated data, in stream order """
+    stream = io.BytesIO(make_stream_vmdk({128: b"\x07" * GRAIN, 384: b"\x08" * 10}, 512))
+    header = read_stream_header(stream)
+    grains = list(iter_grains(stream, header))
+    assert [offset for offset, _ in grains] == [128 * 512, 384 * 512]
+    assert grains[1][1] == b"\x08" * 10
+
+
+def test_iter_grains_checks_offsets_and_sizes(make_stream_vmdk):
+    """ Grains past the disk end, off the grain boundary or over the grain size are refused """
+    for grains in ({512: b"\x01"}, {64: b"\x01"}, {0: b"\x01" * (GRAIN + 1)}):
+        stream = io.BytesIO(make_stream_vmdk(grains, 512))
+        header = read_stream_header(stream)
+        with pytest.raises(VMDKFormatError):
+            list(iter_grains(stream, header))
+
+
+def test_count_stream_grains(make_stream_vmdk):
+    """ Grains can be counted from the markers alone """
+    stream = io.BytesIO(make_stream_vmdk({0: b"\x01", 128: b"\x02", 256: b"\x03"}, 512))
+    assert count_stream_grains(stream, read_stream_header(stream)) == 3
+
+
+def test_vmdk_info_descriptor_file(tmp_path):
+    """ A text descriptor file's size is the sum of its extents """
+    path = tmp_path / "vm.vmdk"
+    path.write_text(
+        '# Disk DescriptorFile\ncreateType="vmfs"\n'
+        'RW 2048 VMFS "vm-flat.vmdk"\nRW 1024 VMFS "vm-flat2.vmdk" 0\n'
+    )
+    info = VMDKInfo(str(path))
+    assert info.virtual_size == 3072 * 512
+    assert info.descriptor.extents[0]["file_name"] == "vm-flat.vmdk"
+
+
+def test_vmdk_info_rejects_other_files(tmp_path):
+    """ Files that are not VMDKs raise VMDKFormatError """
+    path = tmp_path / "disk.raw"
+    path.write_bytes(bytes(4096))
+    with pytest.raises(VMDKFormatError):
+        VMDKInfo(str(path))
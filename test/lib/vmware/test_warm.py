@@ -0,0 +1,141 @@
+""" Unit tests for warm migration, against a mock vSphere API """
+from unittest.mock import MagicMock
+
+from pyVmomi import vim
+
+from voithos.lib.vmware.warm import WarmMigration
+
+
+BLOCK = 64 * 1024
+CAPACITY = BLOCK * 4
+
+
+class FakeVSphere:
+    """ A running VM with one CBT-tracked disk, its snapshots and a datastore HTTP server """
+
+    def __init__(self):
+        self.disk = bytearray(b"a" * BLOCK + bytes(BLOCK * 3))
+        self.generation = 0
+        self.changes = []  # (generation, start, length)
+        self.frozen = None
+        self.guest_writes = []  # writes the guest makes before each later snapshot
+        self.vm = MagicMock()
+        self.vm.snapshot = None
+        self.vm.config.uuid = "uuid-1"
+        self.vm.config.changeTrackingEnabled = False
+        self.vm.parent = MagicMock(spec=vim.Datacenter)
+        self.vm.parent.name = "dc1"
+        self.vm.runtime.powerState = vim.VirtualMachine.PowerState.poweredOn
+        self.vm.ReconfigVM_Task.return_value.info.state = vim.TaskInfo.State.success
+        self.vm.ShutdownGuest.side_effect = self.shutdown
+        self.vm.CreateSnapshot_Task.side_effect = self.create_snapshot
+        self.vm.QueryChangedDiskAreas.side_effect = self.query_changed_disk_areas
+
+    def shutdown(self):
+        self.vm.runtime.powerState = vim.VirtualMachine.PowerState.poweredOff
+
+    def write(self, start, data):
+        self.disk[start : start + len(data)] = data
+        self.changes.append((self.generation + 1, start, len(data)))
+
+    def create_snapshot(self, **kwargs):
+        if self.generation and self.guest_writes:
+            self.write(*self.guest_writes.pop(0))
+        self.generation += 1
+        self.frozen = bytes(self.disk)
+        disk = vim.vm.device.VirtualDisk(
+            key=2000,
+            capacityInBytes=CAPACITY,
+            backing=vim.vm.device.VirtualDisk.FlatVer2BackingInfo(
+                fileName="[ds1] vm1/vm1.vmdk", changeId=f"52 aa/{self.generation}"
+            ),
+        )
+        snapshot = MagicMock()
+        snapshot.config.hardware.device = [disk]
+        snapshot.RemoveSnapshot_Task.return_value.info.state = vim.TaskInfo.State.success
+        task = MagicMock()
+        task.info.state = vim.TaskInfo.State.success
+        task.info.result = snapshot
+        return task
+
+    def query_changed_disk_areas(self, snapshot, deviceKey, startOffset, changeId):
+        if changeId == "*":
+            areas = [
+                (start, BLOCK)
+                for start in range(0, CAPACITY, BLOCK)
+                if any(self.frozen[start : start + BLOCK])
+            ]
+        else:
+            since = int(changeId.split("/")[1])
+            areas = [(start, size) for gen, start, size in self.changes if gen > since]
+        extents = [
+            vim.VirtualMachine.DiskChangeInfo.DiskChangeExtent(start=start, length=size)
+            for start, size in areas
+        ]
+        return vim.VirtualMachine.DiskChangeInfo(
+            startOffset=startOffset, length=CAPACITY - startOffset, changedArea=extents
+        )
+
+    def get(self, url, headers=None, timeout=None):
+        assert url == "https://vcenter/folder/vm1/vm1-flat.vmdk?dcPath=dc1&dsName=ds1"
+        first, last = (int(num) for num in headers["Range"].split("=")[1].split("-"))
+        resp = MagicMock()
+        resp.status_code = 206
+        resp.content = self.frozen[first : last + 1]
+        return resp
+
+
+def test_warm_migration_copies_only_changes(tmp_path, capsys):
+    """ Later passes copy only changed extents, and the final copy matches the disk """
+    vsphere = FakeVSphere()
+    vsphere.guest_writes = [(BLOCK * 2, b"b" * BLOCK), (0, bytes(BLOCK))]
+    mgr = MagicMock()
+    mgr.ip_addr = "vcenter"
+    migration = WarmMigration(
+        mgr, vsphere.vm, base_dir=str(tmp_path), max_passes=2, min_delta_bytes=0
+    )
+    migration.session = vsphere
+    migration.run()
+    assert vsphere.vm.ReconfigVM_Task.called  # CBT was enabled
+    assert vsphere.vm.ShutdownGuest.called
+    assert (tmp_path / "vm1.raw").read_bytes() == bytes(vsphere.disk)
+    assert migration.state.passes == 3
+    assert migration.state.disks["2000"]["change_id"] == "52 aa/3"
+    copied = [line for line in capsys.readouterr().out.splitlines() if "copied" in line]
+    assert len(copied) == 3
+
+
+def test_warm_migration_continues_from_state(tmp_path):
+    """ A second run picks up the saved changeId instead of copying the whole disk """
+    vsphere = FakeVSphere()
+    vsphere.vm.runtime.powerState = vim.VirtualMachine.PowerState.poweredOff
+    mgr = MagicMock()
+    mgr.ip_addr = "vcenter"
+    migration = WarmMigration(mgr, vsphere.vm, base_dir=str(tmp_path))
+    migration.session = vsphere
+    migration.run()
+    vsphere.write(BLOCK * 3, b"c" * BLOCK)
+    migration = WarmMigration(mgr, vsphere.vm, base_dir=str(tmp_path))
+    migration.session = vsphere
+    assert migration.sync_pass(final=True) == BLOCK
+    assert (tmp_path / "vm1.raw").read_bytes() == bytes(vsphere.disk)
+
+
+def test_warm_migration_names_disks_apart(tmp_path):
+    """ Disks with the same file name on different datastores are copied to separate files """
+    disks = [
+        vim.vm.device.VirtualDisk(
+            key=key, backing=vim.vm.device.VirtualDisk.FlatVer2BackingInfo(fileName=name)
+        )
+        for key, name in [
+            (2000, "[ds1] vm1/vm1.vmdk"),
+            (2001, "[ds2] vm1/vm1.vmdk"),
+            (2002, "[ds1] vm1/vm1_1.vmdk"),
+        ]
+    ]
+    migration = WarmMigration(MagicMock(), FakeVSphere().vm, base_dir=str(tmp_path))
+    assert migration.get_file_paths(disks) == {
+        2000: str(tmp_path / "ds1_vm1_vm1.raw"),
+        2001: str(tmp_path / "ds2_vm1_vm1.raw"),
+        2002: str(tmp_path / "vm1_1.raw"),
+    }
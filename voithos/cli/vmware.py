@@ -1,69 +1,56 @@
 """ Commands for VMWare """
 
 import click
-import json
-from pprint import pprint
 from voithos.lib.system import error
+from voithos.lib.aws.aws import get_customer_client
 import voithos.lib.vmware.reports as reports
 from voithos.lib.vmware.mgr import VMWareMgr
-from voithos.lib.vmware.exporter import VMWareExporter, VMWareOnlineVMCantMigrate
-
-
-def _escape_csv(value):
-    """ Format a CSV value to be safe to use in a CSV (string, escape commas, quotes) """
-    str_val = str(value)
-    str_val = str_val.replace('"', '""')
-    str_val = str_val.replace(",", '","')
-    return str_val
-
-
-def _print_csv(vms):
-    """ Print the CSV format output of a list of VMs """
-    columns = [
-        "uuid",
-        "name",
-        "os",
-        "cores",
-        "ram_mb",
-        "num_disks",
-        "total_storage_gb",
-        "used_storage_gb",
-        "num_nics",
-        "net_list",
-        "shared_storage",
-    ]
-    columns_str = ",".join(columns)
-    print(columns_str)
-    for vm in vms:
-        line = []
-        line.append(_escape_csv(vm["uuid"]))
-        line.append(_escape_csv(vm["name"]))
-        line.append(_escape_csv(vm["guest_os"]))
-        line.append(_escape_csv(vm["num_cpu"]))
-        line.append(_escape_csv(vm["ram"]["total_mb"]))
-        line.append(_escape_csv(vm["storage"]["num_disks"]))
-        capacity_gb = sum(disk["capacity_gb"] for disk in vm["storage"]["disks"])
-        line.append(_escape_csv(capacity_gb))
-        used_gb = round(vm["storage"]["partitions"]["total_used_gb"], 2)
-        line.append(_escape_csv(used_gb))
-        line.append(_escape_csv(vm["network"]["num_interfaces"]))
-        net_list = []
-        for network in vm["network"]["networks"]:
-            net_list.append(network["vswitch_name"])
-        net_list_str = " ||| ".join(net_list)
-        line.append(net_list_str)
-        shared_storage = "no"
-        for disk in vm["storage"]["disks"]:
-            if disk["shared"]:
-                shared_storage = "yes"
-        line.append(shared_storage)
-        print(",".join(line))
-
-
-@click.option(
-    "--name", "-n", multiple=True, help="Repetable - names of VMs to display", required=True
+from voithos.lib.vmware.batch import BatchExporter, read_uuid_file
+from voithos.lib.vmware.cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_TTL, InventoryCache
+from voithos.lib.vmware.exporter import (
+    TRANSPORTS,
+    VMWareExporter,
+    VMWareOnlineVMCantMigrate,
+    VMWareTransportNotSupported,
+)
+from voithos.lib.vmware.convert import CONVERT_FORMATS
+from voithos.lib.vmware.linked import (
+    FLATTEN_FORMATS,
+    LinkedCloneExport,
+    VMWareLinkedCloneExportFailed,
+)
+from voithos.lib.vmware.manifest import VERIFY_WORKERS, verify_manifests
+from voithos.lib.vmware.multi import (
+    DEFAULT_VCENTER_WORKERS,
+    MultiVCenterReport,
+    read_vcenters_file,
+)
+from voithos.lib.vmware.objectstore import S3Target
+from voithos.lib.vmware.output import REPORT_FORMATS, write_reports
+from voithos.lib.vmware.planner import (
+    PLAN_FORMATS,
+    WavePlanner,
+    read_groups,
+    read_inventory,
+    write_plan,
+)
+from voithos.lib.vmware.progress import PROGRESS_FORMATS
+from voithos.lib.vmware.query import VMQuery, VMQueryError
+from voithos.lib.vmware.throttle import BandwidthShaper, mbps_to_bps
+from voithos.lib.vmware.transfer import HOST_CONNECTION_LIMIT, VMWareDownloadFailed
+from voithos.lib.vmware.warm import VMWareWarmMigrationFailed, WarmMigration
+
+
+@click.option("--name", "-n", multiple=True, help="Repetable - names of VMs to display")
+@click.option(
+    "--filter",
+    "query",
+    default=None,
+    help="Optional query such as 'power=off AND datastore~ssd* AND disk_gb>200'",
+)
+@click.option(
+    "--format", "-f", "output", default="pprint", help="Output format: pprint,json,ndjson,csv"
 )
-@click.option("--format", "-f", "output", default="pprint", help="Output format: pprint,json,csv")
 @click.option(
     "--username",
     "-u",
@@ -83,25 +70,140 @@ def _print_csv(vms):
     default=None,
     help="(optional) Overrides environment variable VMWARE_IP_ADDR",
 )
+@click.option(
+    "--scope",
+    default=None,
+    help="Optional inventory path to search - a datacenter, DC/host/<cluster> or DC/vm/<folder>",
+)
+@click.option(
+    "--cache/--no-cache",
+    default=False,
+    help="Keep the VM inventory on disk between runs, refreshing only VMs that changed",
+)
+@click.option(
+    "--cache-ttl",
+    "cache_ttl",
+    default=DEFAULT_CACHE_TTL,
+    type=int,
+    help="Optional seconds a cached inventory is used before checking vCenter for changes",
+)
+@click.option(
+    "--cache-dir", "cache_dir", default=DEFAULT_CACHE_DIR, help="Optional inventory cache location"
+)
+@click.option("--refresh", is_flag=True, help="Rebuild the inventory cache from vCenter")
+@click.option(
+    "--vcenters-file",
+    "vcenters_file",
+    default=None,
+    help="Optional JSON file listing several vCenters to report on at once",
+)
+@click.option(
+    "--vcenter-workers",
+    "vcenter_workers",
+    default=DEFAULT_VCENTER_WORKERS,
+    type=int,
+    help="Optional max vCenters to query at once with --vcenters-file",
+)
 @click.command(name="show-vm")
-def show_vm(name, output, username, password, ip_addr):
+def show_vm(
+    name,
+    query,
+    output,
+    username,
+    password,
+    ip_addr,
+    scope,
+    cache,
+    cache_ttl,
+    cache_dir,
+    refresh,
+    vcenters_file,
+    vcenter_workers,
+):
     """ Show data about provided VMs """
-    allowed_outputs = ["pprint", "json", "csv"]
-    if output not in allowed_outputs:
-        error(f"Invalid output format chosen. Supported outputs: {allowed_outputs}", exit=True)
-    mgr = VMWareMgr(username=username, password=password, ip_addr=ip_addr)
-    vms = mgr.find_vms_by_name(name)
-    vm_reports = []
-    for vm in vms:
-        vm_report = reports.get_vm_data(vm)
-        vm_reports.append(vm_report)
-    if output == "pprint":
-        for vm in vm_reports:
-            pprint(vm)
-    elif output == "json":
-        print(json.dumps(vm_reports))
-    elif output == "csv":
-        _print_csv(vm_reports)
+    if output not in REPORT_FORMATS:
+        error(f"Invalid output format chosen. Supported outputs: {REPORT_FORMATS}", exit=True)
+    if not name and query is None:
+        error("ERROR: Provide --name or --filter", exit=True)
+    if query is not None:
+        try:
+            VMQuery(query)
+        except VMQueryError as exc:
+            error(str(exc), exit=True)
+    inventory_cache = None
+    if cache or refresh:
+        inventory_cache = InventoryCache(cache_dir=cache_dir, ttl=cache_ttl, refresh=refresh)
+    if vcenters_file is not None:
+        _show_vcenters_vms(
+            vcenters_file,
+            name,
+            query,
+            output,
+            username,
+            password,
+            scope,
+            inventory_cache,
+            vcenter_workers,
+        )
+        return
+    mgr = VMWareMgr(
+        username=username, password=password, ip_addr=ip_addr, scope=scope, cache=inventory_cache
+    )
+    if query is not None:
+        vms = mgr.query_vms(query, names=name)
+    else:
+        vms = mgr.find_vms_by_name(name)
+    write_reports(reports.iter_vm_reports(mgr.conn, vms), output)
+
+
+def _show_vcenters_vms(
+    vcenters_file, name, query, output, username, password, scope, inventory_cache, workers
+):
+    """ show-vm across every vCenter of vcenters_file, tagging each report with its vCenter """
+    try:
+        vcenters = read_vcenters_file(
+            vcenters_file, username=username, password=password, scope=scope
+        )
+    except (OSError, ValueError) as exc:
+        error(f"ERROR: Failed to load vCenters from {vcenters_file}: {exc}", exit=True)
+    multi = MultiVCenterReport(
+        vcenters, names=name, query=query, cache=inventory_cache, workers=workers
+    )
+    write_reports(multi.iter_reports(), output, extra_columns=["vcenter"])
+    if multi.failures:
+        failed = ", ".join(sorted(multi.failures))
+        count = f"{len(multi.failures)} of {len(vcenters)}"
+        error(f"ERROR: {count} vCenters failed: {failed}", exit=True)
+
+
+def get_shaper(limit_mbps, host_limit_mbps, vm_limit_mbps, limit_file):
+    """ Return a BandwidthShaper for the CLI's limit options, or None if there are none """
+    if not any([limit_mbps, host_limit_mbps, vm_limit_mbps, limit_file]):
+        return None
+    shaper = BandwidthShaper(
+        global_bps=mbps_to_bps(limit_mbps),
+        host_bps=mbps_to_bps(host_limit_mbps),
+        vm_bps=mbps_to_bps(vm_limit_mbps),
+    )
+    if limit_file is not None:
+        try:
+            shaper.watch(limit_file)
+        except (OSError, ValueError) as exc:
+            error(f"ERROR: Failed to load bandwidth limits from {limit_file}: {exc}", exit=True)
+    return shaper
+
+
+def get_s3_target(bucket, prefix, endpoint, part_size_mb, workers):
+    """ Return an S3Target for the CLI's S3 options, or None without --s3-bucket """
+    if bucket is None:
+        return None
+    return S3Target(
+        get_customer_client("s3", endpoint_url=endpoint),
+        bucket,
+        prefix=prefix,
+        part_size=part_size_mb * 1024 * 1024,
+        workers=workers,
+    )
 
 
 @click.argument("vm_uuid")
@@ -128,28 +230,657 @@ def show_vm(name, output, username, password, ip_addr):
 @click.option(
     "--interval", default="15", help="Optional CLI Print interval override - 0 disables updates"
 )
+@click.option(
+    "--progress-format",
+    "progress_format",
+    default="text",
+    type=click.Choice(PROGRESS_FORMATS),
+    help="Optional - json prints one progress event per line (NDJSON)",
+)
+@click.option(
+    "--chunk-size-mb", "chunk_size_mb", default=20, type=int, help="Optional HTTP read size in MB"
+)
+@click.option(
+    "--resume/--no-resume",
+    default=False,
+    help="Continue an interrupted download using the journal left in the output directory",
+)
+@click.option(
+    "--segments",
+    default=1,
+    type=int,
+    help="Optional parallel byte-range connections per disk (falls back to 1 if refused)",
+)
+@click.option(
+    "--max-host-connections",
+    "max_host_connections",
+    default=HOST_CONNECTION_LIMIT,
+    type=int,
+    help="Optional cap on concurrent connections to one host when using --segments",
+)
+@click.option(
+    "--limit-mbps", "limit_mbps", default=None, type=float, help="Optional total MB/s cap"
+)
+@click.option(
+    "--host-limit-mbps",
+    "host_limit_mbps",
+    default=None,
+    type=float,
+    help="Optional MB/s cap per ESXi host",
+)
+@click.option(
+    "--vm-limit-mbps", "vm_limit_mbps", default=None, type=float, help="Optional MB/s cap per VM"
+)
+@click.option(
+    "--limit-file",
+    "limit_file",
+    default=None,
+    help="Optional JSON file of bandwidth limits, re-read when it changes or on SIGHUP",
+)
+@click.option(
+    "--convert-to",
+    "convert_to",
+    default=None,
+    type=click.Choice(CONVERT_FORMATS),
+    help="Optional - write raw/qcow2 images while downloading instead of VMDK files",
+)
+@click.option(
+    "--transport",
+    default="nfc",
+    type=click.Choice(TRANSPORTS),
+    help="Optional - datastore fetches the flat disk files over HTTP, landing raw files",
+)
+@click.option(
+    "--target",
+    "targets",
+    multiple=True,
+    help="Repeatable, with --convert-to - <disk file name>=<file or block device> to write to",
+)
+@click.option(
+    "--direct-host/--via-vcenter",
+    "direct_host",
+    default=True,
+    help="Download from the ESXi host running the VM, or proxy through the given address",
+)
 @click.option(
     "--auto/--manual",
     default=True,
-    help="--manual will not run wget. Instead, holds NFC lease open until Ctrl-C is passed",
+    help="--manual will not download. Instead, holds NFC lease open until Ctrl-C is passed",
+)
+@click.option(
+    "--s3-bucket",
+    "s3_bucket",
+    default=None,
+    help="Optional - upload each disk to this bucket, credentials come from AWS_* or ~/.aws",
+)
+@click.option(
+    "--s3-prefix", "s3_prefix", default="", help="Optional S3 key prefix, keys are <uuid>/<disk>"
+)
+@click.option(
+    "--s3-endpoint",
+    "s3_endpoint",
+    default=None,
+    help="Optional S3-compatible endpoint URL",
+)
+@click.option(
+    "--s3-part-size-mb", "s3_part_size_mb", default=64, type=int, help="Optional S3 part size"
+)
+@click.option(
+    "--s3-workers", "s3_workers", default=4, type=int, help="Optional parallel S3 part uploads"
 )
 @click.command(name="download-vm")
-def download_vm(vm_uuid, dest_dir, username, password, ip_addr, interval, auto):
+def download_vm(
+    vm_uuid,
+    dest_dir,
+    username,
+    password,
+    ip_addr,
+    interval,
+    progress_format,
+    chunk_size_mb,
+    resume,
+    segments,
+    max_host_connections,
+    limit_mbps,
+    host_limit_mbps,
+    vm_limit_mbps,
+    limit_file,
+    transport,
+    convert_to,
+    targets,
+    direct_host,
+    auto,
+    s3_bucket,
+    s3_prefix,
+    s3_endpoint,
+    s3_part_size_mb,
+    s3_workers,
+):
     """ Download a VM with a given UUID """
+    if targets and convert_to is None and transport != "datastore":
+        error("ERROR: --target requires --convert-to or --transport datastore", exit=True)
+    if transport != "nfc" and not auto:
+        error("ERROR: --manual holds an NFC lease, it requires --transport nfc", exit=True)
+    if any("=" not in target for target in targets):
+        error("ERROR: --target must be formatted as <disk file name>=<path>", exit=True)
+    target_paths = dict(target.split("=", 1) for target in targets)
+    shaper = get_shaper(limit_mbps, host_limit_mbps, vm_limit_mbps, limit_file)
     mgr = VMWareMgr(username=username, password=password, ip_addr=ip_addr)
     vm = mgr.find_vm_by_uuid(vm_uuid)
     if vm is None:
         error(f"ERROR: Failed to find VM with UUID: {vm_uuid}", exit=True)
     try:
-        exporter = VMWareExporter(mgr, vm, base_dir=dest_dir, interval=int(interval))
+        exporter = VMWareExporter(
+            mgr,
+            vm,
+            base_dir=dest_dir,
+            interval=int(interval),
+            chunk_size=chunk_size_mb * 1024 * 1024,
+            resume=resume,
+            segments=segments,
+            max_host_connections=max_host_connections,
+            convert_to=convert_to,
+            targets=target_paths,
+            progress_format=progress_format,
+            shaper=shaper,
+            direct_host=direct_host,
+            transport=transport,
+            s3_target=get_s3_target(s3_bucket, s3_prefix, s3_endpoint, s3_part_size_mb, s3_workers),
+        )
     except VMWareOnlineVMCantMigrate:
         error("ERROR: This VM is not offline", exit=True)
+    except VMWareTransportNotSupported as exc:
+        error(str(exc), exit=True)
     if auto:
-        exporter.download()
+        try:
+            exporter.download()
+        except VMWareDownloadFailed as exc:
+            error(str(exc), exit=True)
     else:
         exporter.hold_nfc_lease()
 
 
+@click.argument("vm_uuids", nargs=-1)
+@click.option(
+    "--file",
+    "-f",
+    "uuid_file",
+    default=None,
+    help="Optional file of VM UUIDs to download, one per line (# starts a comment)",
+)
+@click.option("--output-dir", "-o", "dest_dir", default=".", help="Optional destination directory")
+@click.option(
+    "--username",
+    "-u",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_USERNAME",
+)
+@click.option(
+    "--password",
+    "-p",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_PASSWORD",
+)
+@click.option(
+    "--ip-addr",
+    "-i",
+    "ip_addr",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_IP_ADDR",
+)
+@click.option(
+    "--max-parallel",
+    "max_parallel",
+    default=4,
+    type=int,
+    help="Optional cap on VMs exported at once from the vCenter",
+)
+@click.option(
+    "--max-per-host",
+    "max_per_host",
+    default=2,
+    type=int,
+    help="Optional cap on VMs exported at once from one ESXi host - 0 is unlimited",
+)
+@click.option(
+    "--max-per-datastore",
+    "max_per_datastore",
+    default=2,
+    type=int,
+    help="Optional cap on VMs exported at once from one datastore - 0 is unlimited",
+)
+@click.option(
+    "--interval", default="60", help="Optional CLI Print interval override - 0 disables updates"
+)
+@click.option(
+    "--progress-format",
+    "progress_format",
+    default="json",
+    type=click.Choice(PROGRESS_FORMATS),
+    help="Optional - text prints human readable progress, mixed for every running VM",
+)
+@click.option(
+    "--chunk-size-mb", "chunk_size_mb", default=20, type=int, help="Optional HTTP read size in MB"
+)
+@click.option(
+    "--resume/--no-resume",
+    default=False,
+    help="Continue interrupted downloads using the journals left in the output directory",
+)
+@click.option(
+    "--segments",
+    default=1,
+    type=int,
+    help="Optional parallel byte-range connections per disk (falls back to 1 if refused)",
+)
+@click.option(
+    "--limit-mbps", "limit_mbps", default=None, type=float, help="Optional total MB/s cap"
+)
+@click.option(
+    "--host-limit-mbps",
+    "host_limit_mbps",
+    default=None,
+    type=float,
+    help="Optional MB/s cap per ESXi host",
+)
+@click.option(
+    "--vm-limit-mbps", "vm_limit_mbps", default=None, type=float, help="Optional MB/s cap per VM"
+)
+@click.option(
+    "--limit-file",
+    "limit_file",
+    default=None,
+    help="Optional JSON file of bandwidth limits, re-read when it changes or on SIGHUP",
+)
+@click.option(
+    "--convert-to",
+    "convert_to",
+    default=None,
+    type=click.Choice(CONVERT_FORMATS),
+    help="Optional - write raw/qcow2 images while downloading instead of VMDK files",
+)
+@click.option(
+    "--transport",
+    default="nfc",
+    type=click.Choice(TRANSPORTS),
+    help="Optional - datastore fetches the flat disk files over HTTP, landing raw files",
+)
+@click.option(
+    "--direct-host/--via-vcenter",
+    "direct_host",
+    default=True,
+    help="Download from the ESXi host running the VM, or proxy through the given address",
+)
+@click.option(
+    "--s3-bucket",
+    "s3_bucket",
+    default=None,
+    help="Optional - upload each disk to this bucket, credentials come from AWS_* or ~/.aws",
+)
+@click.option(
+    "--s3-prefix", "s3_prefix", default="", help="Optional S3 key prefix, keys are <uuid>/<disk>"
+)
+@click.option(
+    "--s3-endpoint",
+    "s3_endpoint",
+    default=None,
+    help="Optional S3-compatible endpoint URL",
+)
+@click.option(
+    "--s3-part-size-mb", "s3_part_size_mb", default=64, type=int, help="Optional S3 part size"
+)
+@click.option(
+    "--s3-workers", "s3_workers", default=4, type=int, help="Optional parallel S3 part uploads"
+)
+@click.command(name="download-vms")
+def download_vms(
+    vm_uuids,
+    uuid_file,
+    dest_dir,
+    username,
+    password,
+    ip_addr,
+    max_parallel,
+    max_per_host,
+    max_per_datastore,
+    interval,
+    progress_format,
+    chunk_size_mb,
+    resume,
+    segments,
+    limit_mbps,
+    host_limit_mbps,
+    vm_limit_mbps,
+    limit_file,
+    transport,
+    convert_to,
+    direct_host,
+    s3_bucket,
+    s3_prefix,
+    s3_endpoint,
+    s3_part_size_mb,
+    s3_workers,
+):
+    """ Download several VMs, each to <output-dir>/<uuid>, over one VMware connection """
+    uuids = list(vm_uuids)
+    if uuid_file is not None:
+        uuids += read_uuid_file(uuid_file)
+    if not uuids:
+        error("ERROR: Provide VM UUIDs as arguments or with --file", exit=True)
+    shaper = get_shaper(limit_mbps, host_limit_mbps, vm_limit_mbps, limit_file)
+    mgr = VMWareMgr(username=username, password=password, ip_addr=ip_addr)
+    vms = []
+    for vm_uuid in dict.fromkeys(uuids):
+        vm = mgr.find_vm_by_uuid(vm_uuid)
+        if vm is None:
+            error(f"ERROR: Failed to find VM with UUID: {vm_uuid}", exit=True)
+        vms.append(vm)
+    batch = BatchExporter(
+        mgr,
+        vms,
+        base_dir=dest_dir,
+        max_per_vcenter=max_parallel,
+        max_per_host=max_per_host,
+        max_per_datastore=max_per_datastore,
+        interval=int(interval),
+        chunk_size=chunk_size_mb * 1024 * 1024,
+        resume=resume,
+        segments=segments,
+        convert_to=convert_to,
+        progress_format=progress_format,
+        shaper=shaper,
+        direct_host=direct_host,
+        transport=transport,
+        s3_target=get_s3_target(s3_bucket, s3_prefix, s3_endpoint, s3_part_size_mb, s3_workers),
+    )
+    jobs = batch.run()
+    print(f"Summary written to {batch.summary_path}")
+    for job in jobs:
+        summary = job.as_dict()
+        speed = round(summary["avg_bps"] / 1024 / 1024, 2)
+        print(f"  {job.uuid} {job.name}: {job.status} in {summary['seconds']}s [{speed} MB/s]")
+    failed = [job for job in jobs if job.status != "done"]
+    if failed:
+        error(f"ERROR: {len(failed)} of {len(jobs)} VM exports failed", exit=True)
+
+
+@click.argument("manifests", nargs=-1, required=True)
+@click.option(
+    "--workers",
+    default=VERIFY_WORKERS,
+    type=int,
+    help="Optional number of files to hash in parallel",
+)
+@click.command(name="verify")
+def verify(manifests, workers):
+    """ Recheck downloaded disks against their <uuid>.manifest.json files """
+    try:
+        results = verify_manifests(manifests, workers=workers)
+    except (OSError, ValueError, KeyError) as exc:
+        error(f"ERROR: Failed to read manifest: {exc}", exit=True)
+    for result in results:
+        message = f" - {result['message']}" if result["message"] else ""
+        print(f"{result['status'].upper()}: {result['file']}{message}")
+    failed = [result for result in results if result["status"] == "failed"]
+    if failed:
+        error(f"ERROR: {len(failed)} of {len(results)} disks failed verification", exit=True)
+
+
+@click.argument("vm_uuid")
+@click.option("--output-dir", "-o", "dest_dir", default=".", help="Optional destination directory")
+@click.option(
+    "--username",
+    "-u",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_USERNAME",
+)
+@click.option(
+    "--password",
+    "-p",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_PASSWORD",
+)
+@click.option(
+    "--ip-addr",
+    "-i",
+    "ip_addr",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_IP_ADDR",
+)
+@click.option(
+    "--passes", default=3, type=int, help="Optional max number of syncs while the VM runs"
+)
+@click.option(
+    "--min-delta-mb",
+    "min_delta_mb",
+    default=1024,
+    type=int,
+    help="Optional - stop syncing online once a pass copies less than this",
+)
+@click.option(
+    "--chunk-size-mb", "chunk_size_mb", default=20, type=int, help="Optional HTTP read size in MB"
+)
+@click.option(
+    "--shutdown/--wait-for-poweroff",
+    default=True,
+    help="Shut the guest down for the final sync, or wait for it to be powered off",
+)
+@click.command(name="warm-migrate")
+def warm_migrate(
+    vm_uuid,
+    dest_dir,
+    username,
+    password,
+    ip_addr,
+    passes,
+    min_delta_mb,
+    chunk_size_mb,
+    shutdown,
+):
+    """ Copy a running VM's disks to raw files, then sync the changes after shutdown """
+    mgr = VMWareMgr(username=username, password=password, ip_addr=ip_addr)
+    vm = mgr.find_vm_by_uuid(vm_uuid)
+    if vm is None:
+        error(f"ERROR: Failed to find VM with UUID: {vm_uuid}", exit=True)
+    migration = WarmMigration(
+        mgr,
+        vm,
+        base_dir=dest_dir,
+        chunk_size=chunk_size_mb * 1024 * 1024,
+        max_passes=passes,
+        min_delta_bytes=min_delta_mb * 1024 * 1024,
+        shutdown=shutdown,
+    )
+    try:
+        migration.run()
+    except (VMWareWarmMigrationFailed, VMWareDownloadFailed) as exc:
+        error(str(exc), exit=True)
+
+
+@click.argument("vm_uuids", nargs=-1)
+@click.option(
+    "--file",
+    "-f",
+    "uuid_file",
+    default=None,
+    help="Optional file of VM UUIDs to download, one per line (# starts a comment)",
+)
+@click.option("--output-dir", "-o", "dest_dir", default=".", help="Optional destination directory")
+@click.option(
+    "--username",
+    "-u",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_USERNAME",
+)
+@click.option(
+    "--password",
+    "-p",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_PASSWORD",
+)
+@click.option(
+    "--ip-addr",
+    "-i",
+    "ip_addr",
+    default=None,
+    help="(optional) Overrides environment variable VMWARE_IP_ADDR",
+)
+@click.option(
+    "--flatten",
+    default=None,
+    type=click.Choice(FLATTEN_FORMATS),
+    help="Optional - also convert each VM disk's chain into a standalone raw/qcow2 image",
+)
+@click.option(
+    "--max-parallel",
+    "max_parallel",
+    default=4,
+    type=int,
+    help="Optional number of files downloaded at once",
+)
+@click.option(
+    "--segments",
+    default=4,
+    type=int,
+    help="Optional parallel byte-range connections per file",
+)
+@click.option(
+    "--resume/--no-resume",
+    default=False,
+    help="Continue an interrupted download using the journal left in the output directory",
+)
+@click.option(
+    "--interval", default="15", help="Optional CLI Print interval override - 0 disables updates"
+)
+@click.option(
+    "--progress-format",
+    "progress_format",
+    default="text",
+    type=click.Choice(PROGRESS_FORMATS),
+    help="Optional - json prints one progress event per line (NDJSON)",
+)
+@click.command(name="download-linked-clones")
+def download_linked_clones(
+    vm_uuids,
+    uuid_file,
+    dest_dir,
+    username,
+    password,
+    ip_addr,
+    flatten,
+    max_parallel,
+    segments,
+    resume,
+    interval,
+    progress_format,
+):
+    """ Download linked clones as VMDK chains, fetching each shared base disk once """
+    uuids = list(vm_uuids)
+    if uuid_file is not None:
+        uuids += read_uuid_file(uuid_file)
+    if not uuids:
+        error("ERROR: Provide VM UUIDs as arguments or with --file", exit=True)
+    mgr = VMWareMgr(username=username, password=password, ip_addr=ip_addr)
+    vms = []
+    for vm_uuid in dict.fromkeys(uuids):
+        vm = mgr.find_vm_by_uuid(vm_uuid)
+        if vm is None:
+            error(f"ERROR: Failed to find VM with UUID: {vm_uuid}", exit=True)
+        vms.append(vm)
+    try:
+        export = LinkedCloneExport(
+            mgr,
+            vms,
+            base_dir=dest_dir,
+            flatten=flatten,
+            max_parallel=max_parallel,
+            segments=segments,
+            resume=resume,
+            interval=int(interval),
+            progress_format=progress_format,
+        )
+        report = export.run()
+    except (VMWareLinkedCloneExportFailed, VMWareDownloadFailed) as exc:
+        error(str(exc), exit=True)
+    print(f"Report written to {export.report_path}")
+    downloaded_gb = round(report["downloaded_bytes"] / 1024 / 1024 / 1024, 2)
+    saved_gb = round(report["saved_bytes"] / 1024 / 1024 / 1024, 2)
+    print(f"Downloaded {downloaded_gb} GB, sharing saved {saved_gb} GB")
+
+
+@click.argument("inventory")
+@click.option(
+    "--window-hours",
+    "window_hours",
+    required=True,
+    type=float,
+    help="Length of each maintenance window, in hours",
+)
+@click.option(
+    "--throughput-mbps",
+    "throughput_mbps",
+    required=True,
+    type=float,
+    help="Measured transfer throughput of one wave, in MB/s",
+)
+@click.option(
+    "--max-cores", "max_cores", default=None, type=int, help="Optional landing cores per wave"
+)
+@click.option(
+    "--max-ram-gb", "max_ram_gb", default=None, type=float, help="Optional landing RAM per wave"
+)
+@click.option(
+    "--max-storage-gb",
+    "max_storage_gb",
+    default=None,
+    type=float,
+    help="Optional landing disk capacity per wave",
+)
+@click.option(
+    "--groups-file",
+    "groups_file",
+    default=None,
+    help="Optional JSON file of VM groups that must move in the same wave",
+)
+@click.option("--format", "-f", "output", default="pprint", help="Output format: pprint,json,csv")
+@click.command(name="plan-waves")
+def plan_waves(
+    inventory,
+    window_hours,
+    throughput_mbps,
+    max_cores,
+    max_ram_gb,
+    max_storage_gb,
+    groups_file,
+    output,
+):
+    """ Plan migration waves from show-vm json or ndjson output """
+    if output not in PLAN_FORMATS:
+        error(f"Invalid output format chosen. Supported outputs: {PLAN_FORMATS}", exit=True)
+    try:
+        planner = WavePlanner(
+            window_hours,
+            throughput_mbps,
+            max_cores=max_cores,
+            max_ram_gb=max_ram_gb,
+            max_storage_gb=max_storage_gb,
+        )
+        reports = read_inventory(inventory)
+        groups = read_groups(groups_file) if groups_file is not None else None
+        waves = planner.plan(reports, groups)
+    except OSError as exc:
+        error(f"ERROR: Failed to read the plan inputs: {exc}", exit=True)
+    except (KeyError, TypeError) as exc:
+        error(f"ERROR: {inventory} lacks report data {exc}, use show-vm json output", exit=True)
+    except ValueError as exc:
+        error(str(exc), exit=True)
+    write_plan(waves, throughput_mbps, output)
+    for wave in waves:
+        if wave.oversized:
+            names = ", ".join(item.name for item in wave.items)
+            error(f"WARNING: Wave {wave.number} ({names}) exceeds the window or landing capacity")
+
+
 def get_vmware_group():
     """ Return the VMware click group """
 
@@ -159,4 +890,9 @@ def get_vmware_group():
 
     vmware_group.add_command(show_vm)
     vmware_group.add_command(download_vm)
+    vmware_group.add_command(download_vms)
+    vmware_group.add_command(download_linked_clones)
+    vmware_group.add_command(verify)
+    vmware_group.add_command(warm_migrate)
+    vmware_group.add_command(plan_waves)
     return vmware_group
@@ -24,6 +24,16 @@ def get_client(name):
     return session.client(name, region_name="ca-central-1")
 
 
+def get_customer_client(name, endpoint_url=None):
+    """Return a client for the customer's own account or an AWS-compatible service
+
+    Credentials and region come from boto3's usual sources, such as the AWS_ACCESS_KEY_ID,
+    AWS_SECRET_ACCESS_KEY and AWS_DEFAULT_REGION variables or ~/.aws, never from the license.
+    endpoint_url points the client at an S3-compatible store such as Ceph RGW or MinIO.
+    """
+    return boto3.Session().client(name, endpoint_url=endpoint_url)
+
+
 def get_resource(name):
     """ return an aws resource object """
     iam = get_aws_iam()
@@ -1,4 +1,7 @@
 """ Download and upload files to AWS S3 """
+from queue import Queue
+from threading import Lock, Thread
+
 from tqdm import tqdm
 
 import voithos.lib.aws.aws as aws
@@ -29,3 +32,169 @@ def upload(path, bucket_name, key):
     """ Upload file at path to bucket bucket_name named key """
     s3client = aws.get_client("s3")
     s3client.upload_file(path, bucket_name, key)
+
+
+MIN_PART_SIZE = 1024 * 1024 * 5  # 5 MB - S3's minimum for every part but the last
+MAX_PARTS = 10000
+DEFAULT_PART_SIZE = 1024 * 1024 * 64  # 64 MB
+DEFAULT_UPLOAD_WORKERS = 4
+DEFAULT_QUEUED_PARTS = 4
+
+
+class MultipartUploadFailed(Exception):
+    """ A part or the completion of a multipart upload failed """
+
+
+class MultipartUploader:
+    """Upload a stream to S3 as a parallel multipart upload with bounded memory
+
+    Parts are handed to add_part() in order and uploaded by a pool of worker threads. At most
+    queued_parts parts wait in memory, so add_part() blocks when the uploads fall behind.
+    With resume=True an unfinished upload of the same key is continued, and the parts it
+    already holds are reported by completed_parts so the caller can skip them.
+    """
+
+    def __init__(
+        self,
+        client,
+        bucket,
+        key,
+        workers=DEFAULT_UPLOAD_WORKERS,
+        queued_parts=DEFAULT_QUEUED_PARTS,
+    ):
+        """ Construct the uploader, nothing is sent until start() """
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.workers = workers
+        self.queue = Queue(maxsize=queued_parts)
+        self.upload_id = None
+        self.parts = {}  # part number: {"ETag", "Size"}
+        self.lock = Lock()
+        self.threads = []
+        self.errors = []
+
+    def start(self, resume=False):
+        """ Begin, or with resume=True continue, the upload and start the workers """
+        if resume:
+            self.upload_id = self._find_upload()
+        else:
+            # Parts of an abandoned upload are stored, and billed, until it is aborted
+            for upload in self._unfinished_uploads():
+                self.client.abort_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=upload["UploadId"]
+                )
+        if self.upload_id is not None:
+            self.parts = self._list_parts()
+        else:
+            resp = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)
+            self.upload_id = resp["UploadId"]
+        for _ in range(self.workers):
+            thread = Thread(target=self._work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _unfinished_uploads(self):
+        """ Return the unfinished uploads of this key """
+        resp = self.client.list_multipart_uploads(Bucket=self.bucket, Prefix=self.key)
+        return [upload for upload in resp.get("Uploads", []) if upload["Key"] == self.key]
+
+    def _find_upload(self):
+        """ Return the ID of the newest unfinished upload of this key, or None """
+        uploads = self._unfinished_uploads()
+        if not uploads:
+            return None
+        return max(uploads, key=lambda upload: upload["Initiated"])["UploadId"]
+
+    def _list_parts(self):
+        """ Return the parts the unfinished upload already holds, following pagination """
+        parts = {}
+        kwargs = {"Bucket": self.bucket, "Key": self.key, "UploadId": self.upload_id}
+        while True:
+            resp = self.client.list_parts(**kwargs)
+            for part in resp.get("Parts", []):
+                parts[part["PartNumber"]] = {"ETag": part["ETag"], "Size": part["Size"]}
+            if not resp.get("IsTruncated"):
+                return parts
+            kwargs["PartNumberMarker"] = resp["NextPartNumberMarker"]
+
+    def completed_parts(self, part_size):
+        """ Return how many parts from the first one are already uploaded at part_size """
+        count = 0
+        while self.parts.get(count + 1, {}).get("Size") == part_size:
+            count += 1
+        return count
+
+    def add_part(self, number, data):
+        """ Queue part number (from 1) for upload, blocking while the queue is full """
+        if self.errors:
+            raise MultipartUploadFailed(f"ERROR: Upload of {self.key} failed: {self.errors[0]}")
+        self.queue.put((number, data))
+
+    def _work(self):
+        """ Thread target - upload queued parts until a None sentinel arrives """
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                number, data = item
+                if self.errors:
+                    continue  # drain the queue so add_part() never blocks forever
+                resp = self.client.upload_part(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self.upload_id,
+                    PartNumber=number,
+                    Body=data,
+                )
+                with self.lock:
+                    self.parts[number] = {"ETag": resp["ETag"], "Size": len(data)}
+            except Exception as exc:  # pylint: disable=broad-except
+                self.errors.append(exc)
+            finally:
+                self.queue.task_done()
+
+    def _stop_workers(self):
+        """ Wait for the queued parts, then stop the workers """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def complete(self, num_parts):
+        """ Wait for every part, then assemble parts 1 to num_parts into the object """
+        self._stop_workers()
+        if self.errors:
+            raise MultipartUploadFailed(f"ERROR: Upload of {self.key} failed: {self.errors[0]}")
+        missing = [number for number in range(1, num_parts + 1) if number not in self.parts]
+        if missing:
+            raise MultipartUploadFailed(f"ERROR: Upload of {self.key} is missing parts {missing}")
+        parts = [
+            {"PartNumber": number, "ETag": self.parts[number]["ETag"]}
+            for number in range(1, num_parts + 1)
+        ]
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+
+    def stop(self):
+        """ Stop the workers after a failure, keeping the uploaded parts for a resume """
+        self._stop_workers()
+
+    def abort(self):
+        """ Discard the upload and every part of it """
+        self._stop_workers()
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+        )
+
+
+def get_part_size(part_size, expected_size):
+    """ Return part_size, grown if needed so expected_size bytes fit in MAX_PARTS parts """
+    needed = -(-expected_size // MAX_PARTS) if expected_size else 0
+    return max(part_size, needed, MIN_PART_SIZE)
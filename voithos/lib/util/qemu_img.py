@@ -47,3 +47,23 @@ def show(vol_path):
     mount = f"-v {vol_abspath}:{vol_abspath}"
     cmd = f"docker run --rm -it --name {name} {mount} {image} {run}"
     shell(cmd)
+
+
+def convert_chain(input_format, output_format, input_path, output_path, chain_dir):
+    """Execute qemu-img convert on a disk with backing files, such as a VMDK delta chain
+
+    chain_dir, which must hold input_path and every file it references, is mounted at the
+    same path inside the container so relative parent references keep resolving.
+    """
+    chain_abspath = Path(chain_dir).absolute().__str__()
+    input_abspath = Path(input_path).absolute().__str__()
+    assert_path_exists(input_abspath)
+    output_abspath = Path(output_path).absolute().__str__()
+    output_dir = Path(output_abspath).parent.__str__()
+    assert_path_exists(output_dir)
+    mounts = f"-v {chain_abspath}:{chain_abspath}:ro -v {output_dir}:{output_dir}"
+    name = "qemu-img"
+    image = "breqwatr/qemu-img:latest"
+    run = f"qemu-img convert -f {input_format} -O {output_format} {input_abspath} {output_abspath}"
+    cmd = f"docker run --rm --name {name} {mounts} {image} {run}"
+    shell(cmd)
@@ -0,0 +1,216 @@
+""" Export many VMware VMs from one connection, with per-resource concurrency caps """
+import json
+import os
+from threading import Condition, Thread
+from time import time
+
+from voithos.lib.system import error
+from voithos.lib.vmware.common import debug
+from voithos.lib.vmware.exporter import VMWareExporter, _sigterm_as_interrupt
+
+
+DEFAULT_MAX_PER_VCENTER = 4
+DEFAULT_MAX_PER_HOST = 2
+DEFAULT_MAX_PER_DATASTORE = 2
+
+
+class ConcurrencyScheduler:
+    """Run jobs on threads, never exceeding a cap on any resource the jobs share
+
+    Each job names the resources it uses as (kind, name) keys, for example ("host", "esxi-01").
+    A job starts once every one of its keys is below the cap for its kind. Jobs that can't
+    start yet are skipped, so a busy host doesn't hold up VMs on other hosts.
+    """
+
+    def __init__(self, limits):
+        """ limits maps a resource kind to the max concurrent jobs per resource, 0 is unlimited """
+        self.limits = limits
+        self.condition = Condition()
+        self.active = {}  # (kind, name): number of running jobs using it
+
+    def _can_start(self, keys):
+        """ Return True if none of keys is at its cap, caller holds the condition """
+        return all(
+            not self.limits.get(kind) or self.active.get((kind, name), 0) < self.limits[kind]
+            for kind, name in keys
+        )
+
+    def _finish(self, keys):
+        """ Release the keys of a finished job and wake the scheduler """
+        with self.condition:
+            for key in keys:
+                self.active[key] -= 1
+            self.condition.notify_all()
+
+    def run(self, jobs, worker):
+        """Call worker(job) for every (job, keys) pair in jobs, in order where the caps allow
+
+        Returns once every job has finished. Exceptions raised by worker are not caught here.
+        """
+        pending = list(jobs)
+        threads = []
+        with self.condition:
+            while pending:
+                ready = next(((job, keys) for job, keys in pending if self._can_start(keys)), None)
+                if ready is None:
+                    self.condition.wait()
+                    continue
+                pending.remove(ready)
+                job, keys = ready
+                for key in keys:
+                    self.active[key] = self.active.get(key, 0) + 1
+                thread = Thread(target=self._run_job, args=(worker, job, keys), daemon=True)
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+    def _run_job(self, worker, job, keys):
+        """ Thread target - run one job and release its keys whatever happens """
+        try:
+            worker(job)
+        finally:
+            self._finish(keys)
+
+
+class ExportJob:
+    """ One VM of a batch export and its result """
+
+    def __init__(self, vm, vcenter):
+        """ Describe the export of vm, served by the vcenter address """
+        self.vm = vm
+        self.uuid = vm.config.uuid
+        self.name = vm.name
+        self.vcenter = vcenter
+        self.host = vm.runtime.host.name if vm.runtime.host is not None else None
+        self.datastores = sorted(datastore.name for datastore in vm.datastore)
+        self.exporter = None
+        self.status = "pending"
+        self.error = None
+        self.start_ts = None
+        self.end_ts = None
+        self.size_bytes = 0
+        self.bytes_received = 0
+
+    @property
+    def keys(self):
+        """ Return the (kind, name) resources this export uses, for ConcurrencyScheduler """
+        keys = [("vcenter", self.vcenter)]
+        if self.host is not None:
+            keys.append(("host", self.host))
+        keys += [("datastore", datastore) for datastore in self.datastores]
+        return keys
+
+    @property
+    def seconds(self):
+        """ Return how long the export ran """
+        if self.start_ts is None:
+            return 0
+        return (self.end_ts or time()) - self.start_ts
+
+    def as_dict(self):
+        """ Return the job's summary as a JSON-friendly dict """
+        seconds = self.seconds
+        return {
+            "uuid": self.uuid,
+            "name": self.name,
+            "host": self.host,
+            "datastores": self.datastores,
+            "status": self.status,
+            "error": self.error,
+            "seconds": round(seconds, 1),
+            "size_bytes": self.size_bytes,
+            "bytes": self.bytes_received,
+            "avg_bps": int(self.bytes_received / seconds) if seconds else 0,
+        }
+
+
+class BatchExporter:
+    """Export a list of VMs over one VMWareMgr connection
+
+    Each VM gets its own subdirectory of base_dir and its own VMWareExporter, built with
+    exporter_kwargs. At most max_per_vcenter exports run at once, and no more than
+    max_per_host / max_per_datastore touch the same ESXi host or datastore.
+    """
+
+    def __init__(
+        self,
+        vmware_mgr,
+        vms,
+        base_dir=".",
+        max_per_vcenter=DEFAULT_MAX_PER_VCENTER,
+        max_per_host=DEFAULT_MAX_PER_HOST,
+        max_per_datastore=DEFAULT_MAX_PER_DATASTORE,
+        exporter_class=VMWareExporter,
+        **exporter_kwargs,
+    ):
+        """ Construct the batch, nothing is exported until run() """
+        self.vmware_mgr = vmware_mgr
+        self.base_dir = base_dir
+        self.jobs = [ExportJob(vm, vmware_mgr.ip_addr) for vm in vms]
+        self.scheduler = ConcurrencyScheduler(
+            {"vcenter": max_per_vcenter, "host": max_per_host, "datastore": max_per_datastore}
+        )
+        self.exporter_class = exporter_class
+        self.exporter_kwargs = exporter_kwargs
+
+    @property
+    def summary_path(self):
+        """ Return the path of the JSON summary report """
+        return os.path.join(self.base_dir, "download-summary.json")
+
+    def run(self):
+        """ Export every VM, then write the summary. Returns the jobs """
+        _sigterm_as_interrupt()
+        try:
+            self.scheduler.run([(job, job.keys) for job in self.jobs], self.export)
+        except KeyboardInterrupt:
+            error("Interrupted - aborting the NFC leases of running exports")
+            for job in self.jobs:
+                if job.status == "running" and job.exporter is not None:
+                    # The datastore transport holds no lease
+                    if job.exporter.lease is not None:
+                        job.exporter.lease.HttpNfcLeaseAbort()
+                    job.status = "aborted"
+            raise
+        finally:
+            self.write_summary()
+        return self.jobs
+
+    def export(self, job):
+        """ Export a single VM, recording the outcome on its job instead of raising """
+        job.status = "running"
+        job.start_ts = time()
+        base_dir = os.path.join(self.base_dir, job.uuid)
+        os.makedirs(base_dir, exist_ok=True)
+        debug(f"batch: exporting {job.name} ({job.uuid}) from host {job.host} to {base_dir}")
+        try:
+            job.exporter = self.exporter_class(
+                self.vmware_mgr, job.vm, base_dir=base_dir, **self.exporter_kwargs
+            )
+            job.size_bytes = job.exporter.size_in_bytes
+            job.exporter.download()
+            job.status = "done"
+        except Exception as exc:  # pylint: disable=broad-except
+            # One failed VM must not stop the rest of the batch
+            job.status = "failed"
+            job.error = str(exc)
+            error(f"ERROR: Export of {job.name} ({job.uuid}) failed: {exc}")
+        finally:
+            job.end_ts = time()
+            if job.exporter is not None:
+                job.bytes_received = job.exporter.bytes_received
+
+    def write_summary(self):
+        """ Write the per-VM summary report as JSON """
+        summary = [job.as_dict() for job in self.jobs]
+        with open(self.summary_path, "w") as file_:
+            json.dump(summary, file_, indent=2)
+        return summary
+
+
+def read_uuid_file(path):
+    """ Return the VM UUIDs listed in a file, one per line - blank lines and # comments skipped """
+    with open(path) as file_:
+        lines = (line.split("#", 1)[0].strip() for line in file_)
+        return [line for line in lines if line]
@@ -0,0 +1,172 @@
+""" Keep VM inventory records on disk between runs, refreshing only the VMs that changed """
+import json
+import os
+import re
+from time import time
+
+from pyVmomi import SoapAdapter, vim
+
+from voithos.lib.system import get_absolute_path
+from voithos.lib.vmware.common import debug
+from voithos.lib.vmware.inventory import (
+    VM_PROPERTIES,
+    VMRecord,
+    retrieve_object_properties,
+    retrieve_properties,
+)
+
+
+DEFAULT_CACHE_DIR = "~/.cache/voithos/vmware"
+DEFAULT_CACHE_TTL = 3600  # seconds a cache is used as-is before it is refreshed
+CACHE_VERSION = 1
+# Cheap properties read for every VM on refresh. Only VMs whose changeVersion moved are read
+# in full, the power state and host change without a config change so they are always updated
+CHECK_PROPERTIES = ["config.changeVersion", "runtime.powerState", "runtime.host"]
+UNSAFE_CHARS_RE = re.compile(r"[^A-Za-z0-9._-]+")
+
+
+def encode_value(value, version=None):
+    """Return a property value as JSON - plain values as they are, vSphere types as XML
+
+    version is the API version of the connection, properties newer than it are dropped.
+    """
+    if value is None or type(value) in (str, bool, int, float, dict):
+        return value  # a dict was read back from the cache and never decoded
+    return {"xml": SoapAdapter.Serialize(value, version=version).decode()}
+
+
+def decode_value(value, stub=None):
+    """ Reverse encode_value, binding managed object references to stub """
+    if not isinstance(value, dict):
+        return value
+    return SoapAdapter.Deserialize(value["xml"].encode(), stub=stub)
+
+
+class CachedProps(dict):
+    """Properties read back from the cache, each decoded the first time it is used
+
+    Decoding device lists is the slow part of reading a cache, and most uses of a record
+    never look at them.
+    """
+
+    def __init__(self, encoded, stub=None):
+        """ Wrap {property path: encoded value} """
+        super().__init__(encoded)
+        self.stub = stub
+        self.decoded = set()
+
+    def __getitem__(self, path):
+        """ Return the decoded value of path """
+        value = super().__getitem__(path)
+        if path not in self.decoded:
+            value = decode_value(value, self.stub)
+            self[path] = value
+            self.decoded.add(path)
+        return value
+
+    def get(self, path, default=None):
+        """ Return the decoded value of path, or default """
+        return self[path] if path in self else default
+
+
+class InventoryCache:
+    """VM records saved per vCenter and scope, each VM keyed by its MoRef
+
+    A cache younger than ttl seconds is used without asking vCenter anything. An older one is
+    refreshed incrementally: every VM's config.changeVersion is read in one paged call, and
+    only new or reconfigured VMs are read in full. With refresh=True the cache is rebuilt.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, ttl=DEFAULT_CACHE_TTL, refresh=False):
+        """ Describe the cache, nothing is read until load_records() """
+        self.cache_dir = get_absolute_path(cache_dir)
+        self.ttl = ttl
+        self.refresh = refresh
+
+    def get_path(self, vcenter, scope=None):
+        """ Return the cache file for a vCenter address and inventory scope """
+        name = UNSAFE_CHARS_RE.sub("_", vcenter)
+        if scope:
+            name += "--" + UNSAFE_CHARS_RE.sub("_", scope.strip("/"))
+        return os.path.join(self.cache_dir, f"{name}.json")
+
+    def read(self, vcenter, scope=None):
+        """ Return the saved cache, or None if there is none it can use """
+        path = self.get_path(vcenter, scope)
+        try:
+            with open(path) as file_:
+                data = json.load(file_)
+        except (OSError, ValueError):
+            return None
+        if data.get("version") != CACHE_VERSION or data.get("properties") != VM_PROPERTIES:
+            debug(f"{path} was written for other properties, ignoring it")
+            return None
+        return data
+
+    def write(self, vcenter, scope, records, version=None):
+        """ Save the records, encoding vSphere types for API version """
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.get_path(vcenter, scope)
+        data = {
+            "version": CACHE_VERSION,
+            "vcenter": vcenter,
+            "scope": scope,
+            "updated": time(),
+            "properties": VM_PROPERTIES,
+            "vms": {
+                record.moref: {
+                    path: encode_value(val, version) for path, val in record.props.items()
+                }
+                for record in records
+            },
+        }
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as file_:
+            json.dump(data, file_)
+        os.replace(tmp_path, path)
+
+    def load_records(self, conn, vcenter, scope=None, container=None):
+        """ Return a VMRecord of each VM under container, from the cache where it can """
+        stub = conn._stub
+        data = None if self.refresh else self.read(vcenter, scope)
+        if data is None:
+            debug("building the inventory cache")
+            records = [
+                VMRecord(vm, props)
+                for vm, props in retrieve_properties(
+                    conn, vim.VirtualMachine, VM_PROPERTIES, container=container
+                )
+            ]
+            self.write(vcenter, scope, records, version=stub.version)
+            return records
+        cached = {
+            moref: VMRecord(vim.VirtualMachine(moref, stub), CachedProps(props, stub))
+            for moref, props in data["vms"].items()
+        }
+        if time() - data["updated"] < self.ttl:
+            debug(f"using the inventory cache of {len(cached)} VMs")
+            return list(cached.values())
+        morefs = []  # every VM still in scope, in the order vCenter lists them
+        changed = []
+        current = retrieve_properties(
+            conn, vim.VirtualMachine, CHECK_PROPERTIES, container=container
+        )
+        for vm, props in current:
+            morefs.append(vm._moId)
+            record = cached.get(vm._moId)
+            if record is None or record.change_version != props.get("config.changeVersion"):
+                changed.append(vm)
+                continue
+            record.props.update(props)
+            record.props.decoded.update(props)
+        deleted = {vm._moId for vm in changed}
+        for vm, props in retrieve_object_properties(
+            conn, changed, vim.VirtualMachine, VM_PROPERTIES
+        ):
+            cached[vm._moId] = VMRecord(vm, props)
+            deleted.discard(vm._moId)
+        # A changed VM the second read did not return was deleted in between, drop its old record
+        records = [cached[moref] for moref in morefs if moref in cached and moref not in deleted]
+        debug(f"refreshed the inventory cache, {len(changed)} of {len(records)} VMs changed")
+        self.write(vcenter, scope, records, version=stub.version)
+        return records
@@ -0,0 +1,270 @@
+""" Convert streamOptimized VMDK exports to raw or qcow2 images while they download """
+import fcntl
+import hashlib
+import os
+import sys
+from array import array
+import struct
+
+from voithos.lib.vmware.common import debug
+from voithos.lib.vmware.sparse import is_block_device, is_zero, iter_runs
+from voithos.lib.vmware.transfer import CONNECT_TIMEOUT, READ_TIMEOUT, DiskDownload
+from voithos.lib.vmware.vmdk import ChunkReader, iter_grains, read_stream_header
+
+
+CONVERT_FORMATS = ["raw", "qcow2"]
+BLKZEROOUT = 0x127F  # linux/fs.h - ask a block device to zero a byte range
+ZERO_BUFFER_SIZE = 1024 * 1024 * 4
+
+QCOW2_MAGIC = 0x514649FB  # "QFI\xfb"
+QCOW2_CLUSTER_BITS = 16  # 64 KB clusters, the same size as a default VMDK grain
+QCOW2_COPIED = 1 << 63  # L1/L2 flag: refcount is exactly one
+
+
+def _zero_range(fd, start, length):
+    """ Zero a byte range of a block device, using BLKZEROOUT when the kernel supports it """
+    if length <= 0:
+        return
+    try:
+        fcntl.ioctl(fd, BLKZEROOUT, struct.pack("QQ", start, length))
+        return
+    except OSError:
+        debug("BLKZEROOUT not supported, writing zeros")
+    zeros = bytes(ZERO_BUFFER_SIZE)
+    end = start + length
+    while start < end:
+        step = min(ZERO_BUFFER_SIZE, end - start)
+        os.pwrite(fd, zeros[:step], start)
+        start += step
+
+
+class RawImageWriter:
+    """ Write guest data at its offset into a raw image file or block device """
+
+    def __init__(self, path, virtual_size):
+        """ Open the target. A block device must be at least virtual_size bytes """
+        self.path = path
+        self.virtual_size = virtual_size
+        self.block_device = is_block_device(path)
+        flags = os.O_WRONLY if self.block_device else os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        self.fd = os.open(path, flags, 0o644)
+        if self.block_device:
+            device_size = os.lseek(self.fd, 0, os.SEEK_END)
+            if device_size < virtual_size:
+                os.close(self.fd)
+                raise ValueError(
+                    f"ERROR: {path} is {device_size} bytes, the disk needs {virtual_size}"
+                )
+        # A block device may hold old data, so any gap between writes is zeroed explicitly
+        self.zeroed_to = 0
+
+    def write(self, offset, data):
+        """ Write data at offset of the virtual disk, all-zero runs are left unwritten """
+        view = memoryview(data)
+        for start, end, zero in iter_runs(view):
+            if zero:
+                continue  # a hole in a file, zeroed as part of the next gap on a block device
+            if self.block_device and offset + start > self.zeroed_to:
+                _zero_range(self.fd, self.zeroed_to, offset + start - self.zeroed_to)
+            os.pwrite(self.fd, view[start:end], offset + start)
+            self.zeroed_to = max(self.zeroed_to, offset + end)
+
+    def close(self):
+        """ Finish the image - unwritten space reads as zeros """
+        try:
+            if self.block_device:
+                _zero_range(self.fd, self.zeroed_to, self.virtual_size - self.zeroed_to)
+            else:
+                os.ftruncate(self.fd, self.virtual_size)
+            os.fsync(self.fd)
+        finally:
+            os.close(self.fd)
+
+
+class Qcow2ImageWriter:
+    """Write a qcow2 (version 2) image in a single pass
+
+    Data clusters are appended in the order they arrive. The L2 tables, L1 table and refcounts
+    are written after the last cluster, then the header is written to point at them.
+    """
+
+    def __init__(self, path, virtual_size):
+        """ Open the target file or block device """
+        self.path = path
+        self.virtual_size = virtual_size
+        self.cluster_size = 1 << QCOW2_CLUSTER_BITS
+        self.l2_entries = self.cluster_size // 8
+        flags = os.O_RDWR if is_block_device(path) else os.O_RDWR | os.O_CREAT | os.O_TRUNC
+        self.fd = os.open(path, flags, 0o644)
+        # L2 tables are kept in memory until close, 8 bytes per guest cluster they cover
+        self.l2_tables = {}
+        self.next_free = self.cluster_size  # cluster 0 holds the header
+
+    def _allocate(self, num_clusters=1):
+        """ Return the host offset of num_clusters newly reserved clusters """
+        offset = self.next_free
+        self.next_free += num_clusters * self.cluster_size
+        return offset
+
+    def write(self, offset, data):
+        """ Write data at offset of the virtual disk """
+        view = memoryview(data)
+        while view:
+            index, inner = divmod(offset, self.cluster_size)
+            step = min(len(view), self.cluster_size - inner)
+            host_offset = self._lookup(index)
+            if not host_offset and is_zero(view[:step]):
+                # An unallocated cluster already reads as zeros, keep it unallocated
+                view = view[step:]
+                offset += step
+                continue
+            if not host_offset:
+                host_offset = self._allocate()
+                self._map(index, host_offset)
+                if step < self.cluster_size:
+                    # The rest of a partially written cluster has to read as zeros
+                    os.pwrite(self.fd, bytes(self.cluster_size), host_offset)
+            os.pwrite(self.fd, view[:step], host_offset + inner)
+            view = view[step:]
+            offset += step
+
+    def _lookup(self, index):
+        """ Return the host offset of guest cluster index, 0 if it is not allocated """
+        l1_index, l2_index = divmod(index, self.l2_entries)
+        l2_table = self.l2_tables.get(l1_index)
+        return l2_table[l2_index] & ~QCOW2_COPIED if l2_table is not None else 0
+
+    def _map(self, index, host_offset):
+        """ Point guest cluster index at host_offset """
+        l1_index, l2_index = divmod(index, self.l2_entries)
+        if l1_index not in self.l2_tables:
+            self.l2_tables[l1_index] = array("Q", bytes(self.cluster_size))
+        self.l2_tables[l1_index][l2_index] = host_offset | QCOW2_COPIED
+
+    def _clusters_for(self, num_bytes):
+        """ Return how many clusters num_bytes occupies """
+        return -(-num_bytes // self.cluster_size)
+
+    def close(self):
+        """ Write the metadata and header, then close the image """
+        try:
+            self._write_metadata()
+            os.fsync(self.fd)
+        finally:
+            os.close(self.fd)
+
+    def _write_metadata(self):
+        """ Lay out and write the L2 tables, L1 table, refcount blocks and header """
+        l1_size = max(1, -(-self._clusters_for(self.virtual_size) // self.l2_entries))
+        l1_table = [0] * l1_size
+        for l1_index in sorted(self.l2_tables):
+            l2_offset = self._allocate()
+            l1_table[l1_index] = l2_offset | QCOW2_COPIED
+            l2_table = self.l2_tables[l1_index]
+            if sys.byteorder == "little":
+                l2_table.byteswap()  # qcow2 is big-endian
+            os.pwrite(self.fd, l2_table.tobytes(), l2_offset)
+        l1_clusters = self._clusters_for(l1_size * 8)
+        l1_offset = self._allocate(l1_clusters)
+        l1_table += [0] * (l1_clusters * self.cluster_size // 8 - l1_size)
+        os.pwrite(self.fd, struct.pack(f">{len(l1_table)}Q", *l1_table), l1_offset)
+        # The refcount structures have to count themselves, so grow them until they fit
+        refcounts_per_block = self.cluster_size // 2  # 16 bit refcounts
+        used = self.next_free // self.cluster_size
+        num_blocks, num_table_clusters = 0, 0
+        while True:
+            total = used + num_blocks + num_table_clusters
+            need_blocks = -(-total // refcounts_per_block)
+            need_table = self._clusters_for(need_blocks * 8)
+            if (need_blocks, need_table) == (num_blocks, num_table_clusters):
+                break
+            num_blocks, num_table_clusters = need_blocks, need_table
+        table_offset = self._allocate(num_table_clusters)
+        block_offsets = [self._allocate() for _ in range(num_blocks)]
+        total = self.next_free // self.cluster_size
+        for block_num, block_offset in enumerate(block_offsets):
+            first = block_num * refcounts_per_block
+            count = min(refcounts_per_block, total - first)
+            refcounts = [1] * count + [0] * (refcounts_per_block - count)
+            os.pwrite(self.fd, struct.pack(f">{refcounts_per_block}H", *refcounts), block_offset)
+        # Pad the tables to whole clusters, a block device may hold stale data after them
+        table = block_offsets + [0] * (num_table_clusters * self.cluster_size // 8 - num_blocks)
+        os.pwrite(self.fd, struct.pack(f">{len(table)}Q", *table), table_offset)
+        # Zero the rest of cluster 0 too, then write the header into it
+        os.pwrite(self.fd, bytes(self.cluster_size), 0)
+        header = struct.pack(
+            ">IIQIIQIIQQIIQ",
+            QCOW2_MAGIC,
+            2,  # version
+            0,  # backing file offset
+            0,  # backing file size
+            QCOW2_CLUSTER_BITS,
+            self.virtual_size,
+            0,  # no encryption
+            l1_size,
+            l1_offset,
+            table_offset,
+            num_table_clusters,
+            0,  # no snapshots
+            0,
+        )
+        os.pwrite(self.fd, header, 0)
+
+
+def get_image_writer(image_format, path, virtual_size):
+    """ Return an image writer for image_format ("raw" or "qcow2") """
+    if image_format == "raw":
+        return RawImageWriter(path, virtual_size)
+    if image_format == "qcow2":
+        return Qcow2ImageWriter(path, virtual_size)
+    raise ValueError(f"ERROR: Unsupported image format {image_format}, use {CONVERT_FORMATS}")
+
+
+class StreamConverter(DiskDownload):
+    """Download a streamOptimized VMDK and write it straight into a raw or qcow2 image
+
+    The VMDK never lands on disk, grains are inflated as they arrive and written at their
+    offset in the target file or block device.
+    """
+
+    def __init__(self, session, url, file_path, image_format="raw", **kwargs):
+        """ Construct the conversion, see DiskDownload for the shared arguments """
+        super().__init__(session, url, file_path, **kwargs)
+        self.image_format = image_format
+        self.stream_sha256 = None  # hex digest of the VMDK stream as VMware sent it
+        self.sha256_note = "image written out of order, only its VMDK stream is hashed"
+
+    def _counted(self, chunks):
+        """ Pass chunks through, counting and hashing the bytes received """
+        for chunk in chunks:
+            self.hasher.update(chunk)
+            self._count(len(chunk))
+            yield chunk
+
+    def _stream(self):
+        """ GET the VMDK stream and decode it into the target image """
+        if self._completed_earlier():
+            return
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        self.hasher = hashlib.sha256()
+        with self.session.get(self.url, stream=True, timeout=timeout) as resp:
+            resp.raise_for_status()
+            reader = ChunkReader(self._counted(resp.iter_content(chunk_size=self.chunk_size)))
+            header = read_stream_header(reader)
+            self.thick_size = header.virtual_size
+            writer = get_image_writer(self.image_format, self.file_path, header.virtual_size)
+            try:
+                for offset, data in iter_grains(reader, header):
+                    writer.write(offset, data)
+                    self.disk_position = offset + len(data)
+            finally:
+                writer.close()
+        self.stream_sha256 = self.hasher.hexdigest()
+        if self.journal is not None:
+            self.journal.commit(self.target_id, self.bytes_written, complete=True)
+
+    def manifest_entry(self):
+        """ Return this disk's record for the export manifest """
+        entry = super().manifest_entry()
+        entry.update({"format": self.image_format, "stream_sha256": self.stream_sha256})
+        return entry
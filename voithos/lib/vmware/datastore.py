@@ -0,0 +1,74 @@
+""" Access VM files through the datastore /folder HTTP interface """
+import os
+import re
+from urllib.parse import quote, urlencode
+
+from pyVmomi import vim
+
+
+DATASTORE_PATH_RE = re.compile(r"^\[(?P<datastore>[^\]]+)\]\s*(?P<path>.*)$")
+ESXI_DATACENTER = "ha-datacenter"  # the datacenter name an ESXi host uses for itself
+
+
+def parse_datastore_path(datastore_path):
+    """ Split "[datastore1] vm/vm.vmdk" into ("datastore1", "vm/vm.vmdk") """
+    match = DATASTORE_PATH_RE.match(datastore_path)
+    if match is None:
+        raise ValueError(f"ERROR: {datastore_path} is not a datastore path")
+    return match.group("datastore"), match.group("path")
+
+
+def get_flat_path(descriptor_path):
+    """ Return the path of the flat extent of a VMFS disk, vm/vm.vmdk -> vm/vm-flat.vmdk """
+    base, ext = os.path.splitext(descriptor_path)
+    return f"{base}-flat{ext}"
+
+
+def get_unique_names(datastore_paths):
+    """Return a local file name for each "[datastore] path", distinct between them
+
+    A file keeps its own name, vm1.vmdk, unless another has the same name on a different
+    datastore or folder. Then both are named after their datastore and path, ds1_vm1_vm1.vmdk.
+    """
+    names = [os.path.basename(parse_datastore_path(path)[1]) for path in datastore_paths]
+    unique = []
+    for datastore_path, name in zip(datastore_paths, names):
+        if names.count(name) > 1:
+            datastore, path = parse_datastore_path(datastore_path)
+            name = "_".join([datastore] + path.split("/"))
+        unique.append(name)
+    return unique
+
+
+def get_datacenter(entity):
+    """ Return the datacenter holding a managed entity, such as a VM """
+    while entity is not None and not isinstance(entity, vim.Datacenter):
+        entity = entity.parent
+    return entity
+
+
+def get_datastore_url(address, datacenter_name, datastore_name, path):
+    """ Return the /folder URL of a file on a datastore, served by address """
+    query = urlencode({"dcPath": datacenter_name, "dsName": datastore_name})
+    return f"https://{address}/folder/{quote(path)}?{query}"
+
+
+def get_file_url(address, vm, datastore_path, datacenter_name=None):
+    """Return the /folder URL of one of vm's files, given its "[datastore] path" name
+
+    datacenter_name defaults to the VM's datacenter, use ESXI_DATACENTER when address is
+    an ESXi host rather than vCenter.
+    """
+    datastore_name, path = parse_datastore_path(datastore_path)
+    if datacenter_name is None:
+        datacenter_name = get_datacenter(vm).name
+    return get_datastore_url(address, datacenter_name, datastore_name, path)
+
+
+def get_cookies(vmware_mgr):
+    """ Return the cookies that authenticate HTTP requests as the vSphere API session """
+    stub = vmware_mgr.conn._stub.cookie
+    stub_list = stub.split(";")
+    vmware_soap_session = stub_list[0].split("=")[1]
+    path = stub_list[1].lstrip()
+    return {"vmware_soap_session": f"{vmware_soap_session}; ${path}"}
@@ -1,20 +1,39 @@
 """ Handle exporting a VMWare VM """
 import os
-import requests
 import signal
 import sys
+import threading
 from datetime import datetime
 from time import sleep, time
-from threading import Thread
-from pathlib import Path
+from urllib.parse import urlsplit
 
-from hurry.filesize import size
 from pyVmomi import vim
 
-from voithos.lib.system import run
+from voithos.lib.system import error
+from voithos.lib.vmware.convert import StreamConverter
+from voithos.lib.vmware.datastore import (
+    get_cookies,
+    get_file_url,
+    get_flat_path,
+    get_unique_names,
+)
+from voithos.lib.vmware.lease import LEASE_RENEW_INTERVAL, LeaseKeepalive
+from voithos.lib.vmware.manifest import ExportManifest
+from voithos.lib.vmware.objectstore import S3DiskUpload
+from voithos.lib.vmware.progress import ExportProgress
+from voithos.lib.vmware.throttle import THROTTLED_CHUNK_SIZE
+from voithos.lib.vmware.transfer import (
+    DEFAULT_CHUNK_SIZE,
+    HOST_CONNECTION_LIMIT,
+    DiskDownload,
+    DownloadJournal,
+    SegmentedDownload,
+    get_session,
+)
 
 
-SLEEP_INTERVAL = 30  # seconds
+TRANSPORTS = ["nfc", "datastore"]
+DATASTORE_SEGMENTS = 4  # parallel ranges per flat file when --segments isn't given
 
 
 class VMWareExportLeaseNotReady(Exception):
@@ -25,27 +44,82 @@ class VMWareOnlineVMCantMigrate(Exception):
     """ Online VMs cannot be migrated """
 
 
+class VMWareTransportNotSupported(Exception):
+    """ The VM's disks can't be exported with the chosen transport """
+
+
 class VMWareExporter:
     """ Object used to wrangle VMWare exports """
 
-    def __init__(self, vmware_mgr, vm, base_dir=None, interval=15):
-        """ Construct the exporter around a VM """
+    def __init__(
+        self,
+        vmware_mgr,
+        vm,
+        base_dir=None,
+        interval=15,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        resume=False,
+        segments=1,
+        max_host_connections=HOST_CONNECTION_LIMIT,
+        convert_to=None,
+        targets=None,
+        progress_format="text",
+        lease_interval=LEASE_RENEW_INTERVAL,
+        shaper=None,
+        direct_host=True,
+        transport="nfc",
+        s3_target=None,
+    ):
+        """Construct the exporter around a VM
+
+        With resume=True, disks are continued from the offsets in the download journal left
+        behind by an interrupted run. With segments > 1, each disk is fetched as that many
+        parallel byte ranges, never opening more than max_host_connections to one host.
+        With convert_to="raw" or "qcow2", disks are decoded while downloading and written as
+        images instead of VMDK files. targets optionally maps a disk's targetId to the file or
+        block device it should be written to. progress_format="json" reports progress as
+        NDJSON events instead of text. The NFC lease is renewed every lease_interval seconds
+        regardless of the reporting interval. shaper is an optional BandwidthShaper shared by
+        every stream in the process. With direct_host=True disks are downloaded straight from
+        the ESXi host running the VM rather than through vCenter, when the host is reachable.
+        transport="datastore" skips the NFC lease and fetches each disk's flat extent through
+        the datastore /folder HTTP interface with parallel range requests, landing raw files.
+        s3_target, an S3Target, streams each disk into a multipart upload instead of a file.
+        """
         if vm.runtime.powerState != vim.VirtualMachine.PowerState.poweredOff:
             raise VMWareOnlineVMCantMigrate("ERROR: The VM is on. It must be offline")
         # progress tracking data
-        self.start_ts = int(time())
-        self.last_print = int(time())
         self.interval_seconds = interval
-        self.last_transfered_bytes = 0
-        self.transfered_bytes = 0
         # Download data
         self.vm = vm
+        self.transport = transport
+        if transport == "datastore":
+            self.check_datastore_transport(convert_to)
+            convert_to = None  # flat extents are raw already
+        if s3_target is not None and (convert_to is not None or targets):
+            raise VMWareTransportNotSupported(
+                "ERROR: Uploads to S3 keep the disks as they are streamed, they can't be "
+                "converted or written to targets"
+            )
         self.lease = None
-        self.load_export_lease()
+        if transport == "nfc":
+            self.load_export_lease()
         self.base_dir = base_dir if base_dir is not None else os.getcwd()
         self.vmware_mgr = vmware_mgr
-        self.chunk_size = 1024 * 1024 * 20  # 20 MB
+        self.chunk_size = chunk_size
+        self.resume = resume
+        self.segments = segments
+        self.max_host_connections = max_host_connections
+        self.convert_to = convert_to
+        self.targets = targets if targets is not None else {}
+        self.progress_format = progress_format
+        self.lease_interval = lease_interval
+        self.shaper = shaper
+        self.direct_host = direct_host
+        self.s3_target = s3_target
+        self.download_address = None
         self.percent_transfered = 0
+        self.bytes_received = 0
 
     @property
     def disks(self):
@@ -79,11 +153,89 @@ class VMWareExporter:
     @property
     def cookies(self):
         """ Return cookies to initiate the HTTP-based VMDK transfer request """
-        stub = self.vmware_mgr.conn._stub.cookie
-        stub_list = stub.split(";")
-        vmware_soap_session = stub_list[0].split("=")[1]
-        path = stub_list[1].lstrip()
-        return {"vmware_soap_session": f"{vmware_soap_session}; ${path}"}
+        return get_cookies(self.vmware_mgr)
+
+    @property
+    def journal_path(self):
+        """ Return the path of the sidecar journal used to resume interrupted downloads """
+        return os.path.join(self.base_dir, f"{self.vm.config.uuid}.journal.json")
+
+    @property
+    def manifest_path(self):
+        """ Return the path of the SHA-256 manifest written once every disk is downloaded """
+        return os.path.join(self.base_dir, f"{self.vm.config.uuid}.manifest.json")
+
+    def get_disk_url(self, dev):
+        """ Return the URL of an NFC lease device, with its host placeholder filled in """
+        if self.download_address is None:
+            if self.direct_host:
+                self.download_address = self.vmware_mgr.get_host_address(self.vm)
+            else:
+                self.download_address = self.vmware_mgr.ip_addr
+        return dev.url.replace("*/", f"{self.download_address}/")
+
+    def check_datastore_transport(self, convert_to):
+        """ Raise VMWareTransportNotSupported if the disks have no flat extents to fetch """
+        if convert_to not in (None, "raw"):
+            raise VMWareTransportNotSupported(
+                "ERROR: The datastore transport lands raw files, it can't convert to "
+                f"{convert_to}"
+            )
+        for disk in self.disks:
+            backing = disk.backing
+            if not isinstance(backing, vim.vm.device.VirtualDisk.FlatVer2BackingInfo):
+                raise VMWareTransportNotSupported(
+                    f"ERROR: {disk.deviceInfo.label} is not a flat VMFS/NFS disk, use NFC"
+                )
+            if backing.parent is not None:
+                raise VMWareTransportNotSupported(
+                    f"ERROR: {backing.fileName} is a snapshot or linked clone delta, use NFC"
+                )
+            if is_vsan_backing(backing):
+                raise VMWareTransportNotSupported(
+                    f"ERROR: {backing.fileName} is a vSAN object with no flat extent, use NFC"
+                )
+        target_ids = self.get_datastore_target_ids()
+        if len(set(target_ids)) != len(target_ids):
+            raise VMWareTransportNotSupported(
+                f"ERROR: The disks of {self.vm.name} don't have distinct names: {target_ids}"
+            )
+
+    def get_datastore_target_ids(self):
+        """ Return a distinct targetId for each disk fetched with the datastore transport """
+        return get_unique_names([disk.backing.fileName for disk in self.disks])
+
+    def get_disk_sources(self):
+        """ Return (targetId, URL) for every disk to download, using the chosen transport """
+        if self.transport == "datastore":
+            return [
+                (
+                    target_id,
+                    get_file_url(
+                        self.vmware_mgr.ip_addr, self.vm, get_flat_path(disk.backing.fileName)
+                    ),
+                )
+                for target_id, disk in zip(self.get_datastore_target_ids(), self.disks)
+            ]
+        return [(dev.targetId, self.get_disk_url(dev)) for dev in self.lease_disks]
+
+    def get_file_path(self, target_id):
+        """ Return where the disk with this targetId is written """
+        if self.s3_target is not None:
+            return self.s3_target.get_uri(self.get_s3_key(target_id))
+        if target_id in self.targets:
+            return self.targets[target_id]
+        extension = "raw" if self.transport == "datastore" else self.convert_to
+        if extension is not None:
+            name = f"{os.path.splitext(target_id)[0]}.{extension}"
+            return os.path.join(self.base_dir, name)
+        return os.path.join(self.base_dir, target_id)
+
+    def get_s3_key(self, target_id):
+        """ Return the object key the disk with this targetId is uploaded to """
+        extension = "raw" if self.transport == "datastore" else None
+        name = f"{os.path.splitext(target_id)[0]}.{extension}" if extension else target_id
+        return self.s3_target.get_key(self.vm.config.uuid, name)
 
     def load_export_lease(self):
         """ Get an NFC lease (export the vm), wait until its ready to use before returning it """
@@ -100,87 +252,119 @@ class VMWareExporter:
 
     def download(self):
         """ Initiate the download process """
+        # Stream each vmdk in parallel over one pooled HTTP session
+        sources = self.get_disk_sources()
+        session = get_session(pool_size=len(sources) * max(self.segments, DATASTORE_SEGMENTS))
+        if self.transport == "datastore":
+            # /folder requests are authenticated by the API session, not by a lease ticket
+            session.cookies.update(self.cookies)
+        journal = DownloadJournal(self.journal_path, reset=not self.resume)
+        progress = ExportProgress(
+            self.size_in_bytes,
+            interval=self.interval_seconds,
+            output_format=self.progress_format,
+            name=self.vm.config.uuid,
+        )
         downloads = []
-        # Start a thread running WGET for each vmdk in parralel
-        gb_total = bytes_to_gb(self.size_in_bytes)
-        print(f"Download {gb_total} GB:")
-        for dev in self.lease_disks:
+        for target_id, url in sources:
             # Collect the download paths and filenames
-            url = dev.url.replace("*/", f"{self.vmware_mgr.ip_addr}/")
-            file_path = os.path.join(self.base_dir, dev.targetId)
-            print(f"  {file_path} <-- {url}")
-            thread = Thread(target=download_thread, kwargs={"url": url, "file_path": file_path})
-            thread.start()
-            downloads.append(
-                {
-                    "url": url,
-                    "file_path": file_path,
-                    "thread": thread,
-                    "last_size": 0,
-                    "size": 0,
-                    "finished_size_thick": 0,
-                    "finished_size_thin": 0,
-                    "finshed_speed": 0,
-                    "done": False,
-                }
+            file_path = self.get_file_path(target_id)
+            disk_download = self.get_disk_download(session, url, file_path, journal, target_id)
+            progress.add(target_id, disk_download)
+            downloads.append(disk_download)
+        keepalive = LeaseKeepalive(interval=self.lease_interval)
+        if self.lease is not None:
+            keepalive.add(
+                self.lease, name=self.vm.config.uuid, percent_fn=lambda: progress.percent
+            )
+            progress.lease_status = keepalive.status
+        _sigterm_as_interrupt()
+        try:
+            with keepalive:
+                progress.start()
+                for disk_download in downloads:
+                    disk_download.start()
+                failed = progress.wait()
+        except KeyboardInterrupt:
+            error("Interrupted - retry with --resume to continue")
+            if self.lease is not None:
+                self.lease.HttpNfcLeaseAbort()
+            raise
+        self.percent_transfered = progress.percent
+        self.bytes_received = progress.received_bytes
+        if failed is not None:
+            self.abort(failed)
+        self.write_manifest(downloads)
+        progress.complete()
+        if self.lease is not None:
+            self.lease.HttpNfcLeaseProgress(100)
+            self.lease.HttpNfcLeaseComplete()
+        journal.remove()
+
+    def write_manifest(self, downloads):
+        """ Record each disk's size, digest and timing next to the disks """
+        manifest = ExportManifest(
+            self.manifest_path, vm_uuid=self.vm.config.uuid, vm_name=self.vm.name
+        )
+        for disk_download in downloads:
+            manifest.add(disk_download.manifest_entry())
+        manifest.write()
+
+    def get_disk_download(self, session, url, file_path, journal, target_id):
+        """ Return a single or segmented download for one disk, as configured """
+        kwargs = {
+            "chunk_size": self.chunk_size,
+            "journal": journal,
+            "target_id": target_id,
+            "resume": self.resume,
+        }
+        if self.shaper is not None:
+            host = urlsplit(url).hostname
+            kwargs["throttle"] = self.shaper.get_throttle(host, self.vm.config.uuid)
+            kwargs["chunk_size"] = min(self.chunk_size, THROTTLED_CHUNK_SIZE)
+        if self.s3_target is not None:
+            # Parts are uploaded in parallel, so one stream per disk is enough
+            return S3DiskUpload(
+                session,
+                url,
+                self.s3_target,
+                self.get_s3_key(target_id),
+                expected_size=self.size_in_bytes,
+                **kwargs,
+            )
+        if self.transport == "datastore":
+            segments = self.segments if self.segments > 1 else DATASTORE_SEGMENTS
+            return SegmentedDownload(
+                session,
+                url,
+                file_path,
+                segments=segments,
+                max_host_connections=self.max_host_connections,
+                **kwargs,
             )
-        sleep(2)  # Give wget a second to get going
-        print(f"  Starting download ... Progress updates every {SLEEP_INTERVAL} seconds")
-        # Every x seconds, check the file sizes and provide a status update. Also update NFC lease
-        num_downloading_files = len(downloads)
-        elapsed_seconds = 0
-        while num_downloading_files >= 1:
-            # Count the alive threads, when the count is 0 this is the last iteration
-            num_downloading_files = len([dld for dld in downloads if dld["thread"].is_alive()])
-            if num_downloading_files == 0:
-                break  # no need to wait 30 seconds at the end
-            # wait 30 seconds (or whatever SLEEP_INTERVAL is) per check
-            print("")
-            sleep(SLEEP_INTERVAL)
-            elapsed_seconds += SLEEP_INTERVAL
-            print(f"Downloading files: {num_downloading_files}/{len(downloads)} remaining")
-            downloaded_bytes_thick = 0  # re-calc'd each 30 seconds
-            downloaded_bytes_thin = 0
-            for download in downloads:
-                if download["done"]:
-                    # This VMDK download's download completion tasks have been done
-                    # use its "thick size" instead
-                    downloaded_bytes_thick += download["finished_size_thick"]
-                    print_download_progress(download, download["finished_size_thick"])
-                    downloaded_bytes_thin += download["finished_size_thin"]
-                    continue
-                if not download["thread"].is_alive():
-                    # This download just finished, find its "finished size" and mark it done
-                    download["done"] = True
-                    download["finished_size_thick"] = get_vmdk_thick_size(download["file_path"])
-                    downloaded_bytes_thick += download["finished_size_thick"]
-                    download["finished_size_thin"] = Path(download["file_path"]).stat().st_size
-                    downloaded_bytes_thin += download["finished_size_thin"]
-                    download["finished_speed"] = round(
-                        downloaded_bytes_thin / 1024 / 1024 / elapsed_seconds, 2
-                    )
-                    print_download_progress(download, download["finished_size_thick"])
-                    continue
-                # {download} is still downloading, find its current progress by checking file size
-                file_size = Path(download["file_path"]).stat().st_size  # (thin size)
-                downloaded_bytes_thick += file_size  # We don't know the real thick size yet
-                downloaded_bytes_thin += file_size
-                download["last_size"] = download["size"]
-                download["size"] = file_size
-                print_download_progress(download, file_size)  # use thin size for progress now
-            self.percent_transfered = int(downloaded_bytes_thick / self.size_in_bytes * 100)
-            self.lease.HttpNfcLeaseProgress(self.percent_transfered)
-            gb_down_thick = bytes_to_gb(downloaded_bytes_thick)
-            print(
-                f"\- Total Downloaded: \t{gb_down_thick} GB / {gb_total} GB - {self.percent_transfered}%"
+        if self.convert_to is not None:
+            # A VMDK stream has to be decoded in order, so it is never segmented
+            return StreamConverter(
+                session, url, file_path, image_format=self.convert_to, **kwargs
             )
-            thick_avg_speed_mbs = round(downloaded_bytes_thick / 1024 / 1024 / elapsed_seconds, 2)
-            print(f"\- Avg Speed (thick): \t{thick_avg_speed_mbs} MB/s")
-            thin_avg_speed_mbs = round(downloaded_bytes_thin / 1024 / 1024 / elapsed_seconds, 2)
-            print(f"\- Avg Speed (thin): \t{thin_avg_speed_mbs} MB/s")
-        print("Finished download, closing NFC lease")
-        self.lease.HttpNfcLeaseProgress(100)
-        self.lease.HttpNfcLeaseComplete()
+        if self.segments > 1:
+            return SegmentedDownload(
+                session,
+                url,
+                file_path,
+                segments=self.segments,
+                max_host_connections=self.max_host_connections,
+                **kwargs,
+            )
+        return DiskDownload(session, url, file_path, **kwargs)
+
+    def abort(self, failed):
+        """ Release the NFC lease and raise the error of the failed download """
+        error(f"Download failed: {failed.error}")
+        error(f"Progress was saved to {self.journal_path} - retry with --resume to continue")
+        if self.lease is not None:
+            self.lease.HttpNfcLeaseAbort()
+        failed.raise_for_error()
 
     def hold_nfc_lease(self):
         """ Open and hold an NFC lease until ctrl-c is passed """
@@ -188,55 +372,50 @@ class VMWareExporter:
         gb_total = bytes_to_gb(self.size_in_bytes)
         print(f"Size: {gb_total} GB")
 
+        def print_renewal(state):
+            now = str(datetime.fromtimestamp((time())))
+            latency_ms = int(state.last_latency * 1000)
+            print(f"{now} - Renewed NFC lease ({latency_ms} ms)")
+
+        keepalive = LeaseKeepalive(interval=self.lease_interval, on_renew=print_renewal)
+        keepalive.add(self.lease, name=self.vm.config.uuid, percent_fn=lambda: 50)
+
         def signal_handler(sig, frame):
             print("You pressed Ctrl+C - Closing NFC lease...")
+            keepalive.stop()
             self.lease.HttpNfcLeaseProgress(100)
             self.lease.HttpNfcLeaseComplete()
             print("Gracefully closed NFC lease")
             sys.exit(0)
 
         signal.signal(signal.SIGINT, signal_handler)
+        signal.signal(signal.SIGTERM, signal_handler)
         for dev in self.lease_disks:
             # Collect the download paths and filenames
-            url = dev.url.replace("*/", f"{self.vmware_mgr.ip_addr}/")
+            url = self.get_disk_url(dev)
             file_path = os.path.join(self.base_dir, dev.targetId)
             print(f"  {file_path} <-- {url}")
+        keepalive.start()
         while True:
-            sleep(30)
-            self.percent_transfered = 50
-            self.lease.HttpNfcLeaseProgress(self.percent_transfered)
-            now = str(datetime.fromtimestamp((time())))
-            print(f"{now} - Renewed NFC lease")
-
-
-def print_download_progress(download, progress):
-    """ Print the progress of a download """
-    # last interval speed
-    # total speed
-    # path
-    if download["done"]:
-        done = "(DONE)"
-        speed = f"\t[AVG SPEED: {download['finished_speed']} MB/s]"
-    else:
-        done = ""
-        diff = download["size"] - download["last_size"]
-        current_speed = round(diff / 1024 / 1024 / SLEEP_INTERVAL, 2)
-        speed = f"\t[CUR SPEED: {current_speed} MB/s]"
-    size_gb = bytes_to_gb(progress)
-    print(f"  {download['file_path']} - {size_gb} GB {speed} {done}")
-
-
-def download_thread(url, file_path):
-    """ Start a thread to download the file """
-    run(f"wget --quiet --no-check-certificate {url} -O {file_path}")
-
-
-def get_vmdk_thick_size(file_path):
-    """ Return the 'thick' size of a VMDK file in bytes as an integer - requires qemu-utils """
-    qemu_img_lines = run(f"qemu-img info {file_path}")
-    vsize_line = next(line for line in qemu_img_lines if "virtual size" in line)
-    size_bytes = int(vsize_line.split(" ")[-2].replace("(", ""))
-    return size_bytes
+            signal.pause()
+
+
+def _sigterm_as_interrupt():
+    """ Treat SIGTERM like Ctrl+C, so a killed export still releases its NFC lease """
+    if threading.current_thread() is not threading.main_thread():
+        return  # Signal handlers can only be installed by the main thread
+
+    def handler(sig, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, handler)
+
+
+def is_vsan_backing(backing):
+    """ Return True if a disk backing is a vSAN object rather than a file on VMFS or NFS """
+    if backing.backingObjectId:
+        return True
+    return backing.datastore is not None and backing.datastore.summary.type == "vsan"
 
 
 def bytes_to_gb(qty_bytes):
@@ -0,0 +1,181 @@
+""" Load VMware inventory in bulk through the property collector """
+from pyVmomi import vim, vmodl
+
+from voithos.lib.vmware.common import debug
+
+
+PAGE_SIZE = 1000  # objects per RetrievePropertiesEx page
+VM_PROPERTIES = [
+    "name",
+    "config.uuid",
+    "config.instanceUuid",
+    "config.template",
+    "runtime.powerState",
+    "runtime.host",
+    "config.hardware.device",
+    "config.changeVersion",
+    "config.guestFullName",
+    "config.hardware.numCPU",
+    "config.hardware.memoryMB",
+    "datastore",
+]
+
+
+class VMRecord:
+    """Plain record of one VM's properties, read without any further SOAP round-trips
+
+    vm is the VirtualMachine managed object, for anything not held by the record. Properties
+    that vCenter could not return, such as the config of an inaccessible VM, are None.
+    """
+
+    def __init__(self, vm, props):
+        """ Build the record from a VM and its {property path: value} """
+        self.vm = vm
+        self.moref = vm._moId
+        self.props = props
+
+    @property
+    def name(self):
+        """ Return the VM's name """
+        return self.props.get("name")
+
+    @property
+    def uuid(self):
+        """ Return the VM's BIOS UUID, config.uuid """
+        return self.props.get("config.uuid")
+
+    @property
+    def instance_uuid(self):
+        """ Return the VM's vCenter instance UUID """
+        return self.props.get("config.instanceUuid")
+
+    @property
+    def template(self):
+        """ Return True if the VM is a template """
+        return self.props.get("config.template")
+
+    @property
+    def power_state(self):
+        """ Return the VM's power state """
+        return self.props.get("runtime.powerState")
+
+    @property
+    def host(self):
+        """ Return the HostSystem running the VM """
+        return self.props.get("runtime.host")
+
+    @property
+    def change_version(self):
+        """ Return the config.changeVersion the record was read at """
+        return self.props.get("config.changeVersion")
+
+    @property
+    def devices(self):
+        """ Return the VM's virtual hardware devices """
+        return list(self.props.get("config.hardware.device") or [])
+
+    @property
+    def disks(self):
+        """ Return the VM's virtual disks """
+        return [device for device in self.devices if isinstance(device, vim.vm.device.VirtualDisk)]
+
+    def __repr__(self):
+        """ Show the MoRef and name """
+        return f"<VMRecord {self.moref} {self.name}>"
+
+
+def retrieve_properties(conn, obj_type, path_set, container=None, page_size=PAGE_SIZE):
+    """Yield (managed object, {property path: value}) for every obj_type under container
+
+    A ContainerView of container (the root folder by default) is read with one
+    RetrievePropertiesEx call, continued page by page, instead of one call per attribute.
+    """
+    content = conn.content
+    container = container if container is not None else content.rootFolder
+    view = content.viewManager.CreateContainerView(container, [obj_type], True)
+    try:
+        traversal = vmodl.query.PropertyCollector.TraversalSpec(
+            name="traverseView", path="view", skip=False, type=vim.view.ContainerView
+        )
+        object_specs = [
+            vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal])
+        ]
+        yield from _retrieve(conn, obj_type, path_set, object_specs, page_size)
+    finally:
+        view.DestroyView()
+
+
+def retrieve_object_properties(conn, objs, obj_type, path_set, page_size=PAGE_SIZE):
+    """Yield (managed object, {property path: value}) for each of the given objects
+
+    An object deleted since it was listed fails the whole query with ManagedObjectNotFound, so
+    the query is retried without it and the object is left out of the results.
+    """
+    objs = list(objs)
+    while objs:
+        object_specs = [vmodl.query.PropertyCollector.ObjectSpec(obj=obj) for obj in objs]
+        yielded = False
+        try:
+            for result in _retrieve(conn, obj_type, path_set, object_specs, page_size):
+                yielded = True
+                yield result
+            return
+        except vmodl.fault.ManagedObjectNotFound as exc:
+            missing = getattr(exc.obj, "_moId", None)
+            remaining = [obj for obj in objs if obj._moId != missing]
+            if yielded or len(remaining) == len(objs):
+                raise
+            debug(f"{missing} no longer exists, retrieving the other objects without it")
+            objs = remaining
+
+
+def _retrieve(conn, obj_type, path_set, object_specs, page_size):
+    """ Run one paged RetrievePropertiesEx query """
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=object_specs,
+        propSet=[vmodl.query.PropertyCollector.PropertySpec(type=obj_type, pathSet=path_set)],
+    )
+    options = vmodl.query.PropertyCollector.RetrieveOptions(maxObjects=page_size)
+    collector = conn.content.propertyCollector
+    result = collector.RetrievePropertiesEx(specSet=[filter_spec], options=options)
+    while result is not None:
+        for obj_content in result.objects:
+            yield obj_content.obj, {prop.name: prop.val for prop in obj_content.propSet or []}
+        if not result.token:
+            break
+        result = collector.ContinueRetrievePropertiesEx(token=result.token)
+
+
+def load_vm_records(conn, container=None, page_size=PAGE_SIZE):
+    """ Return a VMRecord for every VM under container, the whole inventory by default """
+    records = [
+        VMRecord(vm, props)
+        for vm, props in retrieve_properties(
+            conn, vim.VirtualMachine, VM_PROPERTIES, container=container, page_size=page_size
+        )
+    ]
+    debug(f"loaded {len(records)} VM records")
+    return records
+
+
+class VMIndex:
+    """ Hash indexes of VM records by BIOS UUID and instance UUID """
+
+    def __init__(self, records=None):
+        """ Index records, more can be added with add() """
+        self.by_uuid = {}
+        self.by_instance_uuid = {}
+        for record in records or []:
+            self.add(record)
+
+    def add(self, record):
+        """ Index one record. The first VM seen keeps a duplicated BIOS UUID """
+        if record.uuid is not None:
+            self.by_uuid.setdefault(record.uuid, record)
+        if record.instance_uuid is not None:
+            self.by_instance_uuid.setdefault(record.instance_uuid, record)
+
+    def find_by_uuid(self, uuid):
+        """ Return the record with this BIOS UUID, else this instance UUID, or None """
+        record = self.by_uuid.get(uuid)
+        return record if record is not None else self.by_instance_uuid.get(uuid)
@@ -0,0 +1,126 @@
+""" Keep VMware NFC leases alive independently of download progress reporting """
+from threading import Event, Lock, Thread
+from time import time
+
+from voithos.lib.vmware.common import debug
+
+
+LEASE_RENEW_INTERVAL = 30  # seconds - NFC leases time out after 5 minutes without progress
+
+
+class LeaseState:
+    """ The renewal history of one NFC lease """
+
+    def __init__(self, name, lease, percent_fn):
+        """ Track lease, reported as name. percent_fn returns the progress to report """
+        self.name = name
+        self.lease = lease
+        self.percent_fn = percent_fn
+        self.renewals = 0
+        self.failures = 0
+        self.last_renewal_ts = None
+        self.last_latency = None
+        self.max_latency = 0
+        self.last_error = None
+
+    def as_dict(self):
+        """ Return the lease's status as a JSON-friendly dict """
+        since = round(time() - self.last_renewal_ts, 1) if self.last_renewal_ts else None
+        return {
+            "lease": self.name,
+            "state": str(self.lease.state),
+            "renewals": self.renewals,
+            "failures": self.failures,
+            "seconds_since_renewal": since,
+            "last_latency_ms": _ms(self.last_latency),
+            "max_latency_ms": _ms(self.max_latency),
+            "last_error": str(self.last_error) if self.last_error is not None else None,
+        }
+
+
+def _ms(seconds):
+    """ Return seconds as whole milliseconds, None stays None """
+    return int(seconds * 1000) if seconds is not None else None
+
+
+class LeaseKeepalive:
+    """Renew every registered NFC lease on its own timer thread
+
+    Renewal calls HttpNfcLeaseProgress with each lease's current percentage, so a long
+    reporting interval or a slow disk never lets a lease expire.
+    Usable as a context manager, the thread stops when the block exits for any reason.
+    """
+
+    def __init__(self, interval=LEASE_RENEW_INTERVAL, on_renew=None):
+        """ Renew every interval seconds. on_renew(LeaseState) is called after each renewal """
+        self.interval = interval
+        self.on_renew = on_renew
+        self.leases = []
+        self.lock = Lock()
+        self.stop_event = Event()
+        self.thread = None
+
+    def add(self, lease, name="lease", percent_fn=None):
+        """ Register a lease to keep alive, percent_fn returns its progress (default 0) """
+        state = LeaseState(name, lease, percent_fn if percent_fn is not None else (lambda: 0))
+        with self.lock:
+            self.leases.append(state)
+        return state
+
+    def remove(self, lease):
+        """ Stop renewing a lease, for example once it is completed or aborted """
+        with self.lock:
+            self.leases = [state for state in self.leases if state.lease is not lease]
+
+    def status(self):
+        """ Return the status of every registered lease """
+        with self.lock:
+            return [state.as_dict() for state in self.leases]
+
+    def renew_all(self):
+        """ Renew every registered lease once """
+        with self.lock:
+            leases = list(self.leases)
+        for state in leases:
+            start = time()
+            try:
+                state.lease.HttpNfcLeaseProgress(int(state.percent_fn()))
+            except Exception as exc:  # pylint: disable=broad-except
+                # Keep trying, the next renewal may still land inside the lease timeout
+                debug(f"NFC lease {state.name} renewal failed: {exc}")
+                state.failures += 1
+                state.last_error = exc
+                continue
+            state.last_latency = time() - start
+            state.max_latency = max(state.max_latency, state.last_latency)
+            state.last_renewal_ts = time()
+            state.renewals += 1
+            if self.on_renew is not None:
+                self.on_renew(state)
+
+    def _run(self):
+        """ Thread target - renew until stopped """
+        while not self.stop_event.wait(self.interval):
+            self.renew_all()
+
+    def start(self):
+        """ Start the renewal thread """
+        self.stop_event.clear()
+        self.thread = Thread(target=self._run, daemon=True, name="nfc-lease-keepalive")
+        self.thread.start()
+
+    def stop(self):
+        """ Stop the renewal thread and wait for an in-flight renewal to finish """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        """ Start renewing on entering a with block """
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """ Stop renewing when the with block exits """
+        self.stop()
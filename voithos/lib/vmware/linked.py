@@ -0,0 +1,294 @@
+""" Export linked clones, downloading each shared base disk only once """
+import json
+import os
+import re
+from threading import BoundedSemaphore, Thread
+
+from pyVmomi import vim
+
+import voithos.lib.util.qemu_img as qemu_img
+from voithos.lib.vmware.common import debug
+from voithos.lib.vmware.datastore import (
+    get_cookies,
+    get_file_url,
+    get_flat_path,
+    get_unique_names,
+    parse_datastore_path,
+)
+from voithos.lib.vmware.progress import ExportProgress
+from voithos.lib.vmware.transfer import (
+    DEFAULT_CHUNK_SIZE,
+    DownloadJournal,
+    SegmentedDownload,
+    get_session,
+)
+
+
+PARENT_HINT_RE = re.compile(r'^(parentFileNameHint\s*=\s*)"[^"]*"', re.MULTILINE)
+FLATTEN_FORMATS = ["raw", "qcow2"]
+LINKED_PARALLEL_FILES = 4
+LINKED_SEGMENTS = 4
+
+
+class VMWareLinkedCloneExportFailed(Exception):
+    """ The linked clone export could not complete """
+
+
+class ChainLink:
+    """ One disk in a chain - a base disk or a delta - and the datastore files that hold it """
+
+    def __init__(self, descriptor, files, vm, parent=None):
+        """ descriptor is its "[datastore] path", files lists (datastore path, size) """
+        self.descriptor = descriptor
+        self.files = files
+        self.vm = vm  # the first VM found using the link, to locate its datacenter
+        self.parent = parent
+        self.users = set()  # UUIDs of the VMs whose disks use this link
+
+    @property
+    def size(self):
+        """ Return the bytes held by this link's files """
+        return sum(size or 0 for _, size in self.files)
+
+    @property
+    def shared(self):
+        """ Return True if more than one VM uses this link """
+        return len(self.users) > 1
+
+
+def get_local_path(base_dir, datastore_path):
+    """ Return where a datastore file is mirrored, <base_dir>/datastore/<datastore>/<path> """
+    datastore_name, path = parse_datastore_path(datastore_path)
+    return os.path.join(base_dir, "datastore", datastore_name, *path.split("/"))
+
+
+def get_link_files(vm):
+    """ Return {descriptor path: [(datastore path, size)]} from the VM's file layout """
+    layout = vm.layoutEx
+    if layout is None:
+        return {}
+    files = {info.key: info for info in layout.file}
+    link_files = {}
+    for disk in layout.disk:
+        for unit in disk.chain:
+            unit_files = [files[key] for key in unit.fileKey if key in files]
+            descriptor = next(
+                (info.name for info in unit_files if info.type == "diskDescriptor"), None
+            )
+            if descriptor is not None:
+                link_files[descriptor] = [(info.name, info.size) for info in unit_files]
+    return link_files
+
+
+def get_disk_chain(disk):
+    """ Return the names of a disk's chain from its backing parent references, base first """
+    names = []
+    backing = disk.backing
+    while backing is not None:
+        names.append(backing.fileName)
+        backing = backing.parent
+    names.reverse()
+    return names
+
+
+class LinkedCloneExport:
+    """Download a group of VMs as VMDK chains, fetching each shared link once
+
+    Every VM disk is followed through its backing parent references to its base disk. Each
+    distinct link of every chain is downloaded once through the datastore /folder interface
+    and mirrored under <base_dir>/datastore/. Delta descriptors are rebased to point at their
+    local parent, so each VM's leaf descriptor opens as a complete disk. With flatten="raw" or
+    "qcow2", each VM disk is also converted to a standalone image under <base_dir>/<uuid>/.
+    """
+
+    def __init__(
+        self,
+        vmware_mgr,
+        vms,
+        base_dir=".",
+        flatten=None,
+        max_parallel=LINKED_PARALLEL_FILES,
+        segments=LINKED_SEGMENTS,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        resume=False,
+        interval=15,
+        progress_format="text",
+    ):
+        """ Construct the export and work out the chains, nothing is downloaded until run() """
+        for vm in vms:
+            if vm.runtime.powerState != vim.VirtualMachine.PowerState.poweredOff:
+                raise VMWareLinkedCloneExportFailed(f"ERROR: {vm.name} is on. It must be offline")
+        self.vmware_mgr = vmware_mgr
+        self.vms = vms
+        self.base_dir = base_dir
+        self.flatten = flatten
+        self.max_parallel = max_parallel
+        self.segments = segments
+        self.chunk_size = chunk_size
+        self.resume = resume
+        self.interval = interval
+        self.progress_format = progress_format
+        self.links = {}  # descriptor path: ChainLink
+        self.disks = []  # (vm, disk label, leaf ChainLink)
+        self.load_chains()
+
+    def load_chains(self):
+        """ Walk every VM disk's backing chain, merging the links the VMs share """
+        for vm in self.vms:
+            link_files = get_link_files(vm)
+            for disk in vm.config.hardware.device:
+                if not isinstance(disk, vim.vm.device.VirtualDisk):
+                    continue
+                parent = None
+                for descriptor in get_disk_chain(disk):
+                    if descriptor not in self.links:
+                        files = link_files.get(descriptor)
+                        if files is None and parent is not None:
+                            # A delta's extent may be -delta.vmdk, -sesparse.vmdk or another name
+                            raise VMWareLinkedCloneExportFailed(
+                                f"ERROR: {vm.name} has no file layout for {descriptor}, "
+                                "its delta extent can't be located"
+                            )
+                        if files is None:
+                            files = [(descriptor, 0), (get_flat_path(descriptor), 0)]
+                        self.links[descriptor] = ChainLink(descriptor, files, vm, parent=parent)
+                    link = self.links[descriptor]
+                    link.users.add(vm.config.uuid)
+                    parent = link
+                self.disks.append((vm, disk.deviceInfo.label, parent))
+
+    @property
+    def journal_path(self):
+        """ Return the path of the journal used to resume interrupted downloads """
+        return os.path.join(self.base_dir, "linked.journal.json")
+
+    @property
+    def report_path(self):
+        """ Return the path of the JSON report of chains and sharing """
+        return os.path.join(self.base_dir, "linked-clones.json")
+
+    def run(self):
+        """ Download every link once, rebase the deltas, optionally flatten, write the report """
+        self.download()
+        for link in self.links.values():
+            if link.parent is not None:
+                self.rebase(link)
+        if self.flatten is not None:
+            for vm in self.vms:
+                leaves = [leaf for disk_vm, _, leaf in self.disks if disk_vm is vm]
+                names = get_unique_names([leaf.descriptor for leaf in leaves])
+                for leaf, name in zip(leaves, names):
+                    self.flatten_disk(vm, leaf, name)
+        return self.write_report()
+
+    def download(self):
+        """ Fetch every file of every link, max_parallel files at a time """
+        files = {}  # datastore path: (size, a VM using it)
+        for link in self.links.values():
+            files.update({path: (size, link.vm) for path, size in link.files})
+        session = get_session(pool_size=self.max_parallel * self.segments)
+        session.cookies.update(get_cookies(self.vmware_mgr))
+        journal = DownloadJournal(self.journal_path, reset=not self.resume)
+        progress = ExportProgress(
+            sum(size or 0 for size, _ in files.values()),
+            interval=self.interval,
+            output_format=self.progress_format,
+            name="linked-clones",
+        )
+        slots = BoundedSemaphore(self.max_parallel)
+        downloads = []
+        for datastore_path, (_, vm) in sorted(files.items()):
+            file_path = get_local_path(self.base_dir, datastore_path)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            url = get_file_url(self.vmware_mgr.ip_addr, vm, datastore_path)
+            download = SegmentedDownload(
+                session,
+                url,
+                file_path,
+                chunk_size=self.chunk_size,
+                journal=journal,
+                target_id=datastore_path,
+                resume=self.resume,
+                segments=self.segments,
+            )
+            progress.add(datastore_path, download)
+            downloads.append(download)
+        progress.start()
+        for download in downloads:
+            Thread(target=_run_limited, args=(download, slots), daemon=True).start()
+        failed = progress.wait()
+        if failed is not None:
+            failed.raise_for_error()
+        progress.complete()
+        journal.remove()
+
+    def rebase(self, link):
+        """ Point a delta's descriptor at its parent's local descriptor """
+        path = get_local_path(self.base_dir, link.descriptor)
+        parent_path = get_local_path(self.base_dir, link.parent.descriptor)
+        hint = os.path.relpath(parent_path, os.path.dirname(path))
+        with open(path) as file_:
+            text = file_.read()
+        text, count = PARENT_HINT_RE.subn(lambda match: f'{match.group(1)}"{hint}"', text)
+        if not count:
+            raise VMWareLinkedCloneExportFailed(
+                f"ERROR: {link.descriptor} is a delta without a parentFileNameHint"
+            )
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as file_:
+            file_.write(text)
+        os.replace(tmp_path, path)
+        debug(f"rebased {path} onto {hint}")
+
+    def flatten_disk(self, vm, leaf, name):
+        """ Convert a VM disk's whole chain into one standalone image, named after name """
+        out_dir = os.path.join(self.base_dir, vm.config.uuid)
+        os.makedirs(out_dir, exist_ok=True)
+        output_path = os.path.join(out_dir, f"{os.path.splitext(name)[0]}.{self.flatten}")
+        qemu_img.convert_chain(
+            "vmdk",
+            self.flatten,
+            get_local_path(self.base_dir, leaf.descriptor),
+            output_path,
+            os.path.join(self.base_dir, "datastore"),
+        )
+        return output_path
+
+    def write_report(self):
+        """ Write which VM disks use which links, and how much sharing saved """
+        saved = sum(link.size * (len(link.users) - 1) for link in self.links.values())
+        report = {
+            "downloaded_bytes": sum(link.size for link in self.links.values()),
+            "saved_bytes": saved,
+            "vms": [
+                {
+                    "uuid": vm.config.uuid,
+                    "name": vm.name,
+                    "disk": label,
+                    "descriptor": get_local_path(self.base_dir, leaf.descriptor),
+                    "chain": [
+                        {"descriptor": link.descriptor, "shared": link.shared, "bytes": link.size}
+                        for link in _chain_of(leaf)
+                    ],
+                }
+                for vm, label, leaf in self.disks
+            ],
+        }
+        with open(self.report_path, "w") as file_:
+            json.dump(report, file_, indent=2)
+        return report
+
+
+def _chain_of(leaf):
+    """ Return the links from the base to leaf """
+    chain = []
+    while leaf is not None:
+        chain.append(leaf)
+        leaf = leaf.parent
+    return list(reversed(chain))
+
+
+def _run_limited(download, slots):
+    """ Thread target - run a download once a slot is free """
+    with slots:
+        download.run()
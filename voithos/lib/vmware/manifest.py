@@ -0,0 +1,149 @@
+""" SHA-256 manifests of exported VM disks, and verification of the files they list """
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from time import time
+
+
+HASH_READ_SIZE = 1024 * 1024 * 8  # 8 MB
+VERIFY_WORKERS = 4
+
+
+def file_sha256(path, length=None, hasher=None, offset=0):
+    """Hash length bytes of path from offset (to the end when None) into hasher
+
+    Returns the hasher, a new SHA-256 one unless given, so a download can continue it.
+    """
+    hasher = hasher if hasher is not None else hashlib.sha256()
+    remaining = length
+    with open(path, "rb") as file_:
+        file_.seek(offset)
+        while remaining is None or remaining > 0:
+            size = HASH_READ_SIZE if remaining is None else min(HASH_READ_SIZE, remaining)
+            data = file_.read(size)
+            if not data:
+                break
+            hasher.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+    return hasher
+
+
+def _is_uri(path):
+    """ Return True if path is a URI, such as s3://bucket/key, rather than a local path """
+    return "://" in str(path)
+
+
+def _iso_time(timestamp):
+    """ Return a UNIX timestamp as an ISO 8601 UTC string, None stays None """
+    if timestamp is None:
+        return None
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat()
+
+
+class ExportManifest:
+    """The manifest.json-style record of one VM export
+
+    Lists each disk's targetId, file, size, SHA-256 digest and timing. A segmented download
+    lists a digest per segment instead, and a disk with no digest says why in sha256_note. File
+    paths inside the manifest's directory are stored relative to it, so the export can be moved
+    as a whole.
+    """
+
+    def __init__(self, path, vm_uuid=None, vm_name=None):
+        """ Describe the manifest written to path """
+        self.path = path
+        self.vm_uuid = vm_uuid
+        self.vm_name = vm_name
+        self.disks = []
+
+    @property
+    def base_dir(self):
+        """ Return the directory holding the manifest """
+        return os.path.dirname(os.path.abspath(self.path))
+
+    def add(self, entry):
+        """ Add one disk, a dict as returned by DiskDownload.manifest_entry() """
+        entry = dict(entry)
+        if not _is_uri(entry["file"]):
+            file_path = os.path.abspath(entry["file"])
+            if os.path.dirname(file_path) == self.base_dir:
+                entry["file"] = os.path.basename(file_path)
+        entry["started"] = _iso_time(entry.pop("start_ts", None))
+        entry["finished"] = _iso_time(entry.pop("end_ts", None))
+        self.disks.append(entry)
+
+    def write(self):
+        """ Write the manifest as JSON """
+        manifest = {
+            "vm_uuid": self.vm_uuid,
+            "vm_name": self.vm_name,
+            "created": _iso_time(time()),
+            "algorithm": "sha256",
+            "disks": self.disks,
+        }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file_:
+            json.dump(manifest, file_, indent=2)
+        os.replace(tmp_path, self.path)
+        return manifest
+
+    @classmethod
+    def load(cls, path):
+        """ Read a manifest written by write() """
+        with open(path) as file_:
+            data = json.load(file_)
+        manifest = cls(path, vm_uuid=data.get("vm_uuid"), vm_name=data.get("vm_name"))
+        manifest.disks = data["disks"]
+        return manifest
+
+    def resolve(self, entry):
+        """ Return the path of a disk entry's file, or its URI when it was uploaded """
+        if _is_uri(entry["file"]):
+            return entry["file"]
+        return os.path.join(self.base_dir, entry["file"])
+
+
+def verify_disk(path, entry):
+    """ Return a result dict comparing the file at path to its manifest entry """
+    result = {"file": path, "status": "ok", "message": ""}
+    segments = entry.get("segments")
+    if entry.get("sha256") is None and not segments:
+        message = entry.get("sha256_note") or "no digest recorded for this disk"
+        result.update(status="skipped", message=message)
+        return result
+    if _is_uri(path):
+        result.update(status="skipped", message="uploaded disks are not checked locally")
+        return result
+    if not os.path.exists(path):
+        result.update(status="failed", message="file is missing")
+        return result
+    # A block device is larger than the data written to it, only that much is hashed
+    size = os.path.getsize(path) if os.path.isfile(path) else entry["bytes"]
+    if size != entry["bytes"]:
+        result.update(status="failed", message=f"size {size} != {entry['bytes']}")
+        return result
+    if not segments:
+        segments = [{"offset": 0, "bytes": entry["bytes"], "sha256": entry["sha256"]}]
+    for segment in segments:
+        digest = file_sha256(path, length=segment["bytes"], offset=segment["offset"]).hexdigest()
+        if digest != segment["sha256"]:
+            result.update(
+                status="failed",
+                message=f"sha256 {digest} != {segment['sha256']} at offset {segment['offset']}",
+            )
+            return result
+    return result
+
+
+def verify_manifests(paths, workers=VERIFY_WORKERS):
+    """ Recheck every disk listed in the manifests at paths, workers files at a time """
+    checks = []
+    for path in paths:
+        manifest = ExportManifest.load(path)
+        for entry in manifest.disks:
+            checks.append((manifest.resolve(entry), entry))
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        return list(pool.map(lambda check: verify_disk(*check), checks))
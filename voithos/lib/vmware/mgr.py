@@ -1,6 +1,7 @@
 """ VMware command lib """
 
 import os
+import socket
 import ssl
 
 from pyVim import connect
@@ -8,6 +9,12 @@ from pyVmomi import vim
 
 from voithos.lib.system import error
 from voithos.lib.vmware.common import debug
+from voithos.lib.vmware.inventory import VMIndex, load_vm_records
+from voithos.lib.vmware.query import VMQuery, filter_records, load_query_records
+
+
+HOST_PORT = 443
+HOST_CHECK_TIMEOUT = 5  # seconds
 
 
 def _environ(name, value=None):
@@ -32,18 +39,36 @@ def _get_ssl_error():
         return ssl.SSLError
 
 
+def _reachable(address, port=HOST_PORT, timeout=HOST_CHECK_TIMEOUT):
+    """Return True if a TCP connection to address:port succeeds"""
+    try:
+        with socket.create_connection((address, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
 class VMWareMgr:
     """Object used to manage VMWare interactions"""
 
-    def __init__(self, username=None, password=None, ip_addr=None):
-        """Constructor the exporter, loading creds from env vars if needed"""
+    def __init__(self, username=None, password=None, ip_addr=None, scope=None, cache=None):
+        """Constructor the exporter, loading creds from env vars if needed
+
+        No VM records are loaded until something needs them, and UUID lookups before then ask
+        vCenter for just the VM they need. scope limits the records loaded to one inventory
+        path - a datacenter ("DC1"), a cluster ("DC1/host/Cluster1") or a VM folder
+        ("DC1/vm/Finance"). cache, an InventoryCache, keeps the records on disk between runs.
+        """
         self.username = _environ("VMWARE_USERNAME", username)
         self.password = _environ("VMWARE_PASSWORD", password)
         self.ip_addr = _environ("VMWARE_IP_ADDR", ip_addr)
         self.conn = None
         self.connect()
-        self.vms = []
-        self.load_vms()
+        self.host_addresses = {}  # ESXi host name: address to download from, see get_host_address
+        self.scope = scope
+        self.cache = cache
+        self._records = None  # VMRecord of each VM in scope, loaded on first use
+        self.index = None  # VMIndex of the records, once they are loaded
 
     conn = None  # Required for __del__
 
@@ -77,27 +102,69 @@ class VMWareMgr:
             error(f"ERROR: Invalid login for VMware server {self.ip_addr}", exit=True)
         debug("Connection successful")
 
-    def load_vms(self, entity=None):
-        """Return a list of each VM from all datacenters connected to self.conn
-        This function is recursive, since the VMs can be in a tree-like directory structure
+    @property
+    def is_vcenter(self):
+        """Return True when connected to vCenter, False when connected straight to ESXi"""
+        return self.conn.content.about.apiType == "VirtualCenter"
+
+    def get_host_address(self, vm):
+        """Return the address of the ESXi host running vm, to transfer its disks from directly
+
+        Going through vCenter proxies every byte through the appliance. The host's name is
+        used if it is reachable, then its VMkernel IPs, else the configured address.
         """
-        if entity is None:
-            debug("Starting recursive VM search")
-            self.load_vms(entity=self.conn.content.rootFolder)
-            return
-        if isinstance(entity, vim.VirtualMachine):
-            debug(f"VM:         {entity}  -  {entity.name}")
-            self.vms.append(entity)
-            return
-        if isinstance(entity, vim.Folder):
-            debug(f"FOLDER:     {entity}  -  {entity.name}")
-        if isinstance(entity, vim.Datacenter):
-            debug(f"DATACENTER: {entity}  -  {entity.name}")
-        if hasattr(entity, "vmFolder"):
-            self.load_vms(entity.vmFolder)
-        if hasattr(entity, "childEntity"):
-            for child in entity.childEntity:
-                self.load_vms(child)
+        host = vm.runtime.host
+        if host is None or not self.is_vcenter:
+            return self.ip_addr
+        if host.name not in self.host_addresses:
+            candidates = [host.name]
+            if host.config is not None:
+                candidates += [vnic.spec.ip.ipAddress for vnic in host.config.network.vnic]
+            address = next((addr for addr in candidates if _reachable(addr)), self.ip_addr)
+            debug(f"ESXi host {host.name} will be reached at {address}")
+            self.host_addresses[host.name] = address
+        return self.host_addresses[host.name]
+
+    @property
+    def records(self):
+        """Return the VMRecord of each VM in scope, loading them the first time"""
+        if self._records is None:
+            self.load_vms()
+        return self._records
+
+    @property
+    def vms(self):
+        """Return each VM in scope, loading the records the first time"""
+        return [record.vm for record in self.records]
+
+    def get_scope_container(self):
+        """Return the managed entity at self.scope, None for the whole inventory"""
+        if self.scope is None:
+            return None
+        path = self.scope.strip("/")
+        container = self.conn.content.searchIndex.FindByInventoryPath(inventoryPath=path)
+        if container is None:
+            error(f"ERROR: Inventory path {self.scope} was not found", exit=True)
+        return container
+
+    def load_vms(self, scope=None):
+        """Load a record of each VM in scope, from all datacenters by default
+
+        The property collector reads every VM's properties in a few paged calls, rather than
+        walking the folder tree one SOAP round-trip per attribute. A scope given here replaces
+        the one given to the constructor.
+        """
+        if scope is not None:
+            self.scope = scope
+        debug(f"Loading VM records with the property collector, scope: {self.scope}")
+        container = self.get_scope_container()
+        if self.cache is not None:
+            self._records = self.cache.load_records(
+                self.conn, self.ip_addr, scope=self.scope, container=container
+            )
+        else:
+            self._records = load_vm_records(self.conn, container=container)
+        self.index = VMIndex(self._records)
 
     def find_vms_by_name(self, names):
         """Return a list of VMs who's names contain any element found in names.
@@ -105,15 +172,45 @@ class VMWareMgr:
         """
         if "*" in names:
             return self.vms
-        return (vm for vm in self.vms if any(name in vm.name for name in names))
+        return (
+            record.vm
+            for record in self.records
+            if record.name is not None and any(name in record.name for name in names)
+        )
+
+    def query_vms(self, expression, names=None):
+        """Return the VMs matching a query expression, such as "power=off AND disk_gb>200"
+
+        names optionally also requires the name to contain one of them, as find_vms_by_name.
+        With a loaded or cached inventory the records are filtered in memory. Otherwise only
+        the properties the query needs are read, from the narrowest container it allows.
+        Raises VMQueryError if the expression is invalid.
+        """
+        query = VMQuery(expression)
+        if self._records is not None or self.cache is not None:
+            records = self.records
+        else:
+            records = load_query_records(self.conn, query, container=self.get_scope_container())
+        if names and "*" not in names:
+            records = [
+                record
+                for record in records
+                if record.name is not None and any(name in record.name for name in names)
+            ]
+        return [record.vm for record in filter_records(self.conn, query, records)]
 
     def find_vm_by_uuid(self, uuid):
-        """Return a single VM with a given UUID, or None"""
-        return next(
-            (
-                vm
-                for vm in self.vms
-                if hasattr(vm, "config") and vm.config and vm.config.uuid == uuid
-            ),
-            None,
-        )
+        """Return a single VM with a given BIOS or instance UUID, or None
+
+        Uses the index when the inventory is loaded, else asks vCenter's SearchIndex for just
+        that VM.
+        """
+        if self.index is not None:
+            record = self.index.find_by_uuid(uuid)
+            return record.vm if record is not None else None
+        search_index = self.conn.content.searchIndex
+        for instance_uuid in (False, True):
+            vm = search_index.FindByUuid(uuid=uuid, vmSearch=True, instanceUuid=instance_uuid)
+            if vm is not None:
+                return vm
+        return None
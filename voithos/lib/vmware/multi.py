@@ -0,0 +1,168 @@
+""" Collect VM reports from several vCenters at once, merged into one stream """
+import json
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Full, Queue
+from threading import Event
+
+import voithos.lib.vmware.reports as reports
+from voithos.lib.system import error
+from voithos.lib.vmware.common import debug
+from voithos.lib.vmware.mgr import VMWareMgr
+
+
+DEFAULT_VCENTER_WORKERS = 8
+DEFAULT_QUEUED_REPORTS = 1000  # reports collected ahead of the writer before workers wait
+QUEUE_POLL_INTERVAL = 1  # seconds
+_DONE = object()  # queued by a worker when its vCenter is finished
+
+
+class VCenter:
+    """ One vCenter to report on, as listed in a vCenters file """
+
+    def __init__(self, ip_addr, username=None, password=None, scope=None, name=None):
+        """ Credentials left as None fall back to the usual options and environment variables """
+        self.ip_addr = ip_addr
+        self.username = username
+        self.password = password
+        self.scope = scope
+        self.name = name if name is not None else ip_addr
+
+
+def read_vcenters_file(path, username=None, password=None, scope=None):
+    """Return a VCenter for each entry of a JSON vCenters file, for example:
+
+    [{"ip_addr": "vc1.local", "username": "admin", "password": "secret", "scope": "DC1"},
+     {"ip_addr": "vc2.local", "name": "dr"}]
+    Only ip_addr is required. username, password and scope default to the given values, and
+    name, used to tag each report, defaults to ip_addr. Raises ValueError if the file is invalid.
+    """
+    with open(path) as file_:
+        entries = json.load(file_)
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("expected a non-empty list of vCenters")
+    vcenters = []
+    for entry in entries:
+        if not isinstance(entry, dict) or not entry.get("ip_addr"):
+            raise ValueError(f"every vCenter needs an ip_addr, got {entry}")
+        vcenters.append(
+            VCenter(
+                entry["ip_addr"],
+                username=entry.get("username", username),
+                password=entry.get("password", password),
+                scope=entry.get("scope", scope),
+                name=entry.get("name"),
+            )
+        )
+    names = [vcenter.name for vcenter in vcenters]
+    if len(set(names)) != len(names):
+        raise ValueError(f"vCenter names must be unique, got {names}")
+    return vcenters
+
+
+class _Stopped(Exception):
+    """ The reader stopped consuming reports, so the worker should too """
+
+
+class MultiVCenterReport:
+    """Build VM reports on several vCenters concurrently, one worker thread per vCenter
+
+    Each report gets a "vcenter" key holding the name of the vCenter it came from. Reports are
+    yielded as soon as any vCenter produces them, so the total time is about that of the slowest
+    vCenter. A vCenter that fails is reported and recorded in failures, the others carry on.
+    """
+
+    def __init__(
+        self,
+        vcenters,
+        names=None,
+        query=None,
+        cache=None,
+        workers=DEFAULT_VCENTER_WORKERS,
+        queued_reports=DEFAULT_QUEUED_REPORTS,
+        mgr_class=VMWareMgr,
+    ):
+        """ names and query select the VMs as show-vm's --name and --filter do """
+        self.vcenters = vcenters
+        self.names = names or []
+        self.query = query
+        self.cache = cache
+        self.workers = max(min(workers, len(vcenters)), 1)
+        self.queued_reports = queued_reports
+        self.mgr_class = mgr_class
+        self.counts = {}  # vCenter name: reports collected
+        self.failures = {}  # vCenter name: error message
+        self.stopped = Event()
+
+    def iter_reports(self):
+        """ Yield each report as it is collected, from whichever vCenter has one ready """
+        queue = Queue(maxsize=self.queued_reports)
+        self.stopped.clear()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for vcenter in self.vcenters:
+                pool.submit(self._collect, vcenter, queue)
+            remaining = len(self.vcenters)
+            try:
+                while remaining:
+                    report = queue.get()
+                    if report is _DONE:
+                        remaining -= 1
+                    else:
+                        yield report
+            finally:
+                self.stopped.set()
+                _drain(queue)
+
+    def _collect(self, vcenter, queue):
+        """ Queue the reports of one vCenter, recording it as failed instead of raising """
+        self.counts[vcenter.name] = 0
+        try:
+            mgr = self.mgr_class(
+                username=vcenter.username,
+                password=vcenter.password,
+                ip_addr=vcenter.ip_addr,
+                scope=vcenter.scope,
+                cache=self.cache,
+            )
+            if self.query is not None:
+                vms = mgr.query_vms(self.query, names=self.names)
+            else:
+                vms = mgr.find_vms_by_name(self.names)
+            for report in reports.iter_vm_reports(mgr.conn, vms):
+                report["vcenter"] = vcenter.name
+                self._put(queue, report)
+                self.counts[vcenter.name] += 1
+            debug(f"vCenter {vcenter.name}: {self.counts[vcenter.name]} reports")
+        except _Stopped:
+            debug(f"vCenter {vcenter.name}: stopped")
+        except SystemExit:
+            # VMWareMgr has already written why it exits, an invalid login or missing credentials
+            self._fail(vcenter, "could not connect")
+        except Exception as exc:
+            self._fail(vcenter, str(exc) or type(exc).__name__)
+        finally:
+            self._put(queue, _DONE, wait=False)
+
+    def _fail(self, vcenter, reason):
+        """ Record and report that a vCenter failed """
+        self.failures[vcenter.name] = reason
+        error(f"ERROR: vCenter {vcenter.name} failed: {reason}")
+
+    def _put(self, queue, item, wait=True):
+        """ Queue item, waiting for room unless the reader has stopped """
+        while not self.stopped.is_set():
+            try:
+                queue.put(item, timeout=QUEUE_POLL_INTERVAL)
+                return
+            except Full:
+                continue
+        if wait:
+            raise _Stopped()
+
+
+def _drain(queue):
+    """ Discard whatever is queued so no worker stays blocked on a full queue """
+    while True:
+        try:
+            queue.get_nowait()
+        except Empty:
+            return
@@ -0,0 +1,141 @@
+""" Stream exported disks straight into an S3-compatible object store """
+import hashlib
+
+from voithos.lib.aws.s3 import (
+    DEFAULT_PART_SIZE,
+    DEFAULT_QUEUED_PARTS,
+    DEFAULT_UPLOAD_WORKERS,
+    MultipartUploader,
+    get_part_size,
+)
+from voithos.lib.vmware.common import debug
+from voithos.lib.vmware.transfer import CONNECT_TIMEOUT, READ_TIMEOUT, DiskDownload
+from voithos.lib.vmware.vmdk import SECTOR_SIZE, peek_virtual_size
+
+
+class S3Target:
+    """ Where, and how, exported disks are uploaded - a bucket, key prefix and part sizing """
+
+    def __init__(
+        self,
+        client,
+        bucket,
+        prefix="",
+        part_size=DEFAULT_PART_SIZE,
+        workers=DEFAULT_UPLOAD_WORKERS,
+        queued_parts=DEFAULT_QUEUED_PARTS,
+    ):
+        """ client is a boto3 S3 client, see voithos.lib.aws.aws.get_client """
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.part_size = part_size
+        self.workers = workers
+        self.queued_parts = queued_parts
+
+    def get_key(self, vm_uuid, name):
+        """ Return the object key of one of a VM's disks, <prefix>/<uuid>/<name> """
+        parts = [self.prefix, vm_uuid, name] if self.prefix else [vm_uuid, name]
+        return "/".join(parts)
+
+    def get_uri(self, key):
+        """ Return the s3:// URI of an object key """
+        return f"s3://{self.bucket}/{key}"
+
+
+class S3DiskUpload(DiskDownload):
+    """Stream one disk from its URL into a parallel S3 multipart upload
+
+    Nothing lands on local disk. The stream is cut into part_size parts, which a pool of
+    workers uploads while the next parts download. Memory holds at most the part being filled,
+    the queued parts and the ones being uploaded. With resume=True the parts of the unfinished
+    upload are listed, the stream continues after the last contiguous full part with a Range
+    request, and only the remaining parts are sent.
+    """
+
+    def __init__(self, session, url, target, key, expected_size=None, **kwargs):
+        """Construct the upload, nothing is transfered until start() or run()
+
+        expected_size, an upper bound on the stream's length, grows the part size so the
+        stream fits in S3's 10,000 parts. It must be the same on every attempt to resume.
+        """
+        super().__init__(session, url, target.get_uri(key), **kwargs)
+        self.target = target
+        self.key = key
+        self.part_size = get_part_size(target.part_size, expected_size)
+        self.uploader = None
+
+    def _stream(self):
+        """ GET the URL and upload it part by part """
+        if self._completed_earlier():
+            return
+        uploader = MultipartUploader(
+            self.target.client,
+            self.target.bucket,
+            self.key,
+            workers=self.target.workers,
+            queued_parts=self.target.queued_parts,
+        )
+        self.uploader = uploader
+        uploader.start(resume=self.resume)
+        uploaded = uploader.completed_parts(self.part_size)
+        offset = uploaded * self.part_size
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        try:
+            with self.session.get(self.url, stream=True, timeout=timeout, headers=headers) as resp:
+                resp.raise_for_status()
+                if offset and resp.status_code != 206:
+                    # The whole stream is coming, the parts already uploaded are skipped
+                    debug(f"{self.url} does not support ranges, skipping {uploaded} parts")
+                    offset = 0
+                self.resumed_from = offset
+                self.bytes_written = offset
+                # The parts kept in S3 can't be rehashed, so a ranged resume has no digest
+                self.hasher = hashlib.sha256() if offset == 0 else None
+                number = self._upload_stream(resp, uploader, offset // self.part_size + 1, uploaded)
+            uploader.complete(number - 1)
+        except BaseException:
+            # Keep the parts in S3 so --resume can continue from them
+            uploader.stop()
+            raise
+        if self.hasher is not None:
+            self.sha256 = self.hasher.hexdigest()
+        else:
+            self.sha256_note = "resumed from parts already in S3, which are not rehashed"
+        if self.journal is not None:
+            self.journal.commit(
+                self.target_id, self.bytes_written, complete=True, sha256=self.sha256
+            )
+
+    def _upload_stream(self, resp, uploader, number, uploaded):
+        """ Cut the response into parts from part number, return the number after the last """
+        buffer = bytearray()
+        for chunk in resp.iter_content(chunk_size=self.chunk_size):
+            if not chunk:
+                continue
+            if self.bytes_written == 0 and len(chunk) >= SECTOR_SIZE:
+                # The VMDK header gives the thick size before the upload finishes
+                self.thick_size = peek_virtual_size(chunk)
+            if self.hasher is not None:
+                self.hasher.update(chunk)
+            buffer += chunk
+            self._count(len(chunk))
+            while len(buffer) >= self.part_size:
+                self._add_part(uploader, number, bytes(buffer[: self.part_size]), uploaded)
+                del buffer[: self.part_size]
+                number += 1
+        if buffer or number == 1:
+            self._add_part(uploader, number, bytes(buffer), uploaded)
+            number += 1
+        return number
+
+    def _add_part(self, uploader, number, data, uploaded):
+        """ Queue a part, unless a previous run already uploaded it """
+        if number <= uploaded:
+            return
+        uploader.add_part(number, data)
+
+    def allocated_size(self):
+        """ Nothing is written locally """
+        return None
@@ -0,0 +1,105 @@
+""" Stream VM reports to stdout as they are built, one row at a time """
+import csv
+import json
+import sys
+from pprint import pprint
+
+
+REPORT_FORMATS = ["pprint", "json", "ndjson", "csv"]
+CSV_COLUMNS = [
+    "uuid",
+    "name",
+    "os",
+    "cores",
+    "ram_mb",
+    "num_disks",
+    "total_storage_gb",
+    "used_storage_gb",
+    "num_nics",
+    "net_list",
+    "shared_storage",
+]
+
+
+def get_csv_row(report):
+    """ Return the CSV_COLUMNS values of a get_vm_data report """
+    capacity_gb = sum(disk["capacity_gb"] for disk in report["storage"]["disks"])
+    used_gb = round(report["storage"]["partitions"]["total_used_gb"], 2)
+    net_list = " ||| ".join(network["vswitch_name"] for network in report["network"]["networks"])
+    shared = any(disk["shared"] for disk in report["storage"]["disks"])
+    return [
+        report["uuid"],
+        report["name"],
+        report["guest_os"],
+        report["num_cpu"],
+        report["ram"]["total_mb"],
+        report["storage"]["num_disks"],
+        capacity_gb,
+        used_gb,
+        report["network"]["num_interfaces"],
+        net_list,
+        "yes" if shared else "no",
+    ]
+
+
+def write_reports(reports, output_format, stream=None, extra_columns=()):
+    """Write each report as soon as it is yielded, return how many were written
+
+    Nothing is held beyond the current report. json writes one array, opened before the first
+    report and closed after the last, so the output matches json.dumps of the whole list.
+    ndjson writes one object per line. csv quotes values with the csv module, and writes the
+    report keys in extra_columns, such as "vcenter", ahead of CSV_COLUMNS.
+    """
+    stream = stream if stream is not None else sys.stdout
+    writer = {
+        "pprint": _write_pprint,
+        "json": _write_json,
+        "ndjson": _write_ndjson,
+        "csv": _write_csv,
+    }[output_format]
+    if output_format == "csv":
+        return writer(reports, stream, extra_columns)
+    return writer(reports, stream)
+
+
+def _write_pprint(reports, stream):
+    """ Pretty print each report """
+    count = 0
+    for count, report in enumerate(reports, 1):
+        pprint(report, stream=stream)
+        stream.flush()
+    return count
+
+
+def _write_json(reports, stream):
+    """ Write the reports as one JSON array, element by element """
+    count = 0
+    stream.write("[")
+    for count, report in enumerate(reports, 1):
+        if count > 1:
+            stream.write(", ")
+        stream.write(json.dumps(report))
+        stream.flush()
+    stream.write("]\n")
+    stream.flush()
+    return count
+
+
+def _write_ndjson(reports, stream):
+    """ Write one JSON object per line """
+    count = 0
+    for count, report in enumerate(reports, 1):
+        stream.write(json.dumps(report) + "\n")
+        stream.flush()
+    return count
+
+
+def _write_csv(reports, stream, extra_columns=()):
+    """ Write a header, then one CSV row per report """
+    count = 0
+    writer = csv.writer(stream, lineterminator="\n")
+    writer.writerow(list(extra_columns) + CSV_COLUMNS)
+    for count, report in enumerate(reports, 1):
+        writer.writerow([report.get(column) for column in extra_columns] + get_csv_row(report))
+        stream.flush()
+    return count
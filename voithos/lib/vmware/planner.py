@@ -0,0 +1,261 @@
+""" Plan migration waves from show-vm reports with first-fit decreasing bin packing """
+import csv
+import json
+import sys
+from operator import le, sub
+from pprint import pprint
+
+
+MB_IN_GB = 1024
+SECONDS_IN_HOUR = 3600
+PLAN_FORMATS = ["pprint", "json", "csv"]
+PLAN_CSV_COLUMNS = [
+    "wave",
+    "wave_duration_hours",
+    "vcenter",
+    "uuid",
+    "name",
+    "group",
+    "cores",
+    "ram_gb",
+    "storage_gb",
+    "transfer_gb",
+]
+
+
+class WavePlanError(ValueError):
+    """ The inventory, groups or constraints can't be planned """
+
+
+def read_inventory(path):
+    """Return the reports of a show-vm json or ndjson output file
+
+    Reports of several vCenters (--vcenters-file) keep their vcenter tag.
+    """
+    with open(path) as file_:
+        text = file_.read()
+    try:
+        reports = json.loads(text)
+    except json.JSONDecodeError:
+        try:
+            reports = [json.loads(line) for line in text.splitlines() if line.strip()]
+        except json.JSONDecodeError as exc:
+            raise WavePlanError(f"ERROR: {path} is not show-vm json or ndjson output") from exc
+    if isinstance(reports, dict):
+        reports = [reports]
+    return reports
+
+
+def read_groups(path):
+    """Return {group name: [VM name or UUID, ...]} from a JSON file, for example:
+
+    {"erp": ["erp-db-01", "erp-app-01"], "web": ["4215a3c4-..."]}
+    The VMs of a group always land in the same wave.
+    """
+    with open(path) as file_:
+        groups = json.load(file_)
+    if not isinstance(groups, dict) or not all(isinstance(vms, list) for vms in groups.values()):
+        raise WavePlanError(f"ERROR: {path} must map group names to lists of VMs")
+    return groups
+
+
+class PlanItem:
+    """ A VM, or a group of VMs that move together, and the resources moving it takes """
+
+    def __init__(self, name, reports):
+        """ Sum the cores, RAM, disk capacity and data to transfer of the reports """
+        self.name = name
+        self.reports = reports
+        self.cores = 0
+        self.ram_gb = 0
+        self.storage_gb = 0
+        self.transfer_gb = 0
+        for report in reports:
+            capacity_gb = sum(disk["capacity_gb"] for disk in report["storage"]["disks"])
+            used_gb = report["storage"]["partitions"]["total_used_gb"]
+            self.cores += report["num_cpu"] or 0
+            self.ram_gb += (report["ram"]["total_mb"] or 0) / MB_IN_GB
+            self.storage_gb += capacity_gb
+            # Guest partition usage is only known with VMware tools running, else assume full
+            self.transfer_gb += used_gb if used_gb else capacity_gb
+
+
+class Wave:
+    """ VMs migrated together in one maintenance window """
+
+    def __init__(self, number):
+        """ Start empty """
+        self.number = number
+        self.items = []
+        self.cores = 0
+        self.ram_gb = 0
+        self.storage_gb = 0
+        self.transfer_gb = 0
+        self.oversized = False  # True when a single item exceeds the constraints on its own
+
+    def add(self, item):
+        """ Add item to the wave """
+        self.items.append(item)
+        self.cores += item.cores
+        self.ram_gb += item.ram_gb
+        self.storage_gb += item.storage_gb
+        self.transfer_gb += item.transfer_gb
+
+    @property
+    def reports(self):
+        """ Return the reports of every VM in the wave """
+        return [report for item in self.items for report in item.reports]
+
+    def as_dict(self, throughput_mbps):
+        """ Return the wave's totals, predicted duration and VMs, for JSON output """
+        return {
+            "wave": self.number,
+            "num_vms": len(self.reports),
+            "groups": [item.name for item in self.items if len(item.reports) > 1],
+            "cores": self.cores,
+            "ram_gb": round(self.ram_gb, 2),
+            "storage_gb": round(self.storage_gb, 2),
+            "transfer_gb": round(self.transfer_gb, 2),
+            "duration_hours": round(
+                transfer_seconds(self.transfer_gb, throughput_mbps) / SECONDS_IN_HOUR, 2
+            ),
+            "oversized": self.oversized,
+            "vms": [
+                {key: report.get(key) for key in ("vcenter", "uuid", "name") if key in report}
+                for report in self.reports
+            ],
+        }
+
+
+def transfer_seconds(transfer_gb, throughput_mbps):
+    """ Return the seconds transferring transfer_gb takes at throughput_mbps MB/s """
+    return transfer_gb * MB_IN_GB / throughput_mbps
+
+
+class WavePlanner:
+    """Pack VMs into as few waves as the constraints allow, with first-fit decreasing
+
+    Each wave must transfer within window_hours at the measured throughput_mbps (MB/s, shared by
+    the wave's transfers), and may land at most max_cores, max_ram_gb and max_storage_gb. A limit
+    left as None is not checked. Items are sorted by the largest share of any limit they use,
+    then each goes into the first wave it fits, so planning thousands of VMs takes well under a
+    second. An item that exceeds a limit on its own gets a wave to itself, marked oversized.
+    """
+
+    def __init__(
+        self, window_hours, throughput_mbps, max_cores=None, max_ram_gb=None, max_storage_gb=None
+    ):
+        """ Check the constraints """
+        for value in (window_hours, throughput_mbps, max_cores, max_ram_gb, max_storage_gb):
+            if value is not None and value <= 0:
+                raise WavePlanError("ERROR: The window, throughput and limits must be over 0")
+        self.throughput_mbps = throughput_mbps
+        self.window_hours = window_hours
+        # attribute: the most one wave may hold
+        self.limits = {
+            "transfer_gb": window_hours * SECONDS_IN_HOUR * throughput_mbps / MB_IN_GB,
+            "cores": max_cores,
+            "ram_gb": max_ram_gb,
+            "storage_gb": max_storage_gb,
+        }
+        self.limits = {attr: limit for attr, limit in self.limits.items() if limit is not None}
+
+    def get_items(self, reports, groups=None):
+        """Return a PlanItem per group and per VM in no group
+
+        Group members are matched by UUID, then by name. Raises WavePlanError if a member
+        matches no VM, or a VM is in more than one group.
+        """
+        by_uuid = {report.get("uuid"): report for report in reports}
+        by_name = {}
+        for report in reports:
+            by_name.setdefault(report.get("name"), []).append(report)
+        grouped = {}  # id of a grouped report: its group
+        items = []
+        for group, members in (groups or {}).items():
+            group_reports = []
+            for member in members:
+                matches = [by_uuid[member]] if member in by_uuid else by_name.get(member, [])
+                if not matches:
+                    raise WavePlanError(f"ERROR: {member} of group {group} is not in the inventory")
+                for report in matches:
+                    if grouped.get(id(report)) == group:
+                        continue
+                    if id(report) in grouped:
+                        other = grouped[id(report)]
+                        raise WavePlanError(
+                            f"ERROR: {report['name']} is in groups {other} and {group}"
+                        )
+                    grouped[id(report)] = group
+                    group_reports.append(report)
+            if group_reports:
+                items.append(PlanItem(group, group_reports))
+        for report in reports:
+            if id(report) not in grouped:
+                items.append(PlanItem(report.get("name"), [report]))
+        return items
+
+    def get_loads(self, item):
+        """ Return the fraction of each per-wave limit the item uses """
+        return tuple(getattr(item, attr) / limit for attr, limit in self.limits.items())
+
+    def plan(self, reports, groups=None):
+        """Return the list of Waves for the reports of show-vm, keeping groups together
+
+        Each wave's headroom is tracked as fractions of the limits. A wave is no longer searched
+        once its headroom in some limit is below what even the smallest item needs there.
+        """
+        items = [(self.get_loads(item), item) for item in self.get_items(reports, groups)]
+        if not items:
+            return []
+        items.sort(key=lambda pair: max(pair[0], default=0), reverse=True)
+        smallest = [min(loads[dim] for loads, _ in items) for dim in range(len(self.limits))]
+        waves = []
+        open_waves = []  # (headroom, wave) of the waves that can still take an item
+        for loads, item in items:
+            for headroom, wave in open_waves:
+                if all(map(le, loads, headroom)):
+                    break
+            else:
+                headroom, wave = [1] * len(loads), Wave(len(waves) + 1)
+                wave.oversized = max(loads, default=0) > 1
+                waves.append(wave)
+                open_waves.append((headroom, wave))
+            wave.add(item)
+            headroom[:] = map(sub, headroom, loads)
+            if not all(map(le, smallest, headroom)):
+                open_waves = [pair for pair in open_waves if pair[1] is not wave]
+        return waves
+
+
+def write_plan(waves, throughput_mbps, output_format, stream=None):
+    """ Write the waves as pprint or json summaries, or as one CSV row per VM """
+    stream = stream if stream is not None else sys.stdout
+    if output_format == "pprint":
+        for wave in waves:
+            pprint(wave.as_dict(throughput_mbps), stream=stream)
+    elif output_format == "json":
+        stream.write(json.dumps([wave.as_dict(throughput_mbps) for wave in waves]) + "\n")
+    elif output_format == "csv":
+        writer = csv.writer(stream, lineterminator="\n")
+        writer.writerow(PLAN_CSV_COLUMNS)
+        for wave in waves:
+            duration = wave.as_dict(throughput_mbps)["duration_hours"]
+            for item in wave.items:
+                group = item.name if len(item.reports) > 1 else ""
+                for report in item.reports:
+                    vm = PlanItem(report.get("name"), [report])
+                    writer.writerow(
+                        [
+                            wave.number,
+                            duration,
+                            report.get("vcenter", ""),
+                            report.get("uuid"),
+                            report.get("name"),
+                            group,
+                            vm.cores,
+                            round(vm.ram_gb, 2),
+                            round(vm.storage_gb, 2),
+                            round(vm.transfer_gb, 2),
+                        ]
+                    )
@@ -0,0 +1,266 @@
+""" Track and report VMware export progress from byte-count callbacks """
+import json
+import sys
+from threading import Condition, Lock
+from time import time
+
+
+PROGRESS_FORMATS = ["text", "json"]
+MAX_WAKE_INTERVAL = 30  # seconds - wake at least this often, even when reports are rarer
+
+
+def bytes_to_gb(qty_bytes):
+    """ Return a GB value of bytes, rounded to 2 decimals """
+    return round(qty_bytes / 1024 / 1024 / 1024, 2)
+
+
+def bytes_to_mb(qty_bytes):
+    """ Return a MB value of bytes, rounded to 2 decimals """
+    return round(qty_bytes / 1024 / 1024, 2)
+
+
+class DiskProgress:
+    """ Counters for one disk of an export, fed by its download's callbacks """
+
+    def __init__(self, target_id, download):
+        """ Track download, which is reported as target_id """
+        self.target_id = target_id
+        self.download = download
+        self.received_bytes = 0
+        self.reported_bytes = 0  # received_bytes at the last report, for the current rate
+        self.reported_ts = None
+
+    @property
+    def done(self):
+        """ Return True once the download thread has finished, successfully or not """
+        return self.download.done
+
+    @property
+    def covered_bytes(self):
+        """ Return how much of the virtual disk has been transfered """
+        if self.done and self.download.error is None and self.download.thick_size:
+            return self.download.thick_size
+        return self.download.covered_bytes
+
+    def snapshot(self, now):
+        """ Return this disk's progress as a dict, and start a new rate interval """
+        elapsed = max(self.download.elapsed_seconds, 0.001)
+        interval = max(now - self.reported_ts, 0.001) if self.reported_ts else elapsed
+        avg_bps = self.received_bytes / elapsed
+        rate_bps = 0 if self.done else (self.received_bytes - self.reported_bytes) / interval
+        expected = self.download.thick_size
+        eta = None
+        if self.done:
+            eta = 0
+        elif expected and avg_bps:
+            # The ETA is measured on the virtual disk, since VMDK streams are compressed
+            covered_per_second = self.download.covered_bytes / elapsed
+            if covered_per_second:
+                eta = int(max(expected - self.download.covered_bytes, 0) / covered_per_second)
+        self.reported_bytes = self.received_bytes
+        self.reported_ts = now
+        return {
+            "target_id": self.target_id,
+            "path": self.download.file_path,
+            "bytes": self.received_bytes,
+            "covered_bytes": self.covered_bytes,
+            "expected_bytes": expected,
+            "rate_bps": int(rate_bps),
+            "avg_bps": int(avg_bps),
+            "eta_seconds": eta,
+            "done": self.done,
+        }
+
+
+class ExportProgress:
+    """Collect byte counts from every disk download of an export and report on an interval
+
+    Downloads call back into this object as bytes arrive and when they finish, so wait()
+    reacts to a finished or failed disk immediately instead of on the next poll.
+    Reports are printed as text, or as NDJSON events when output_format="json".
+    """
+
+    def __init__(self, total_bytes, interval=15, output_format="text", stream=None, name=""):
+        """ Report progress of total_bytes every interval seconds - 0 disables reports """
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.output_format = output_format
+        self.stream = stream if stream is not None else sys.stdout
+        self.name = name
+        self.disks = []
+        self.lock = Lock()
+        self.condition = Condition(self.lock)
+        self.finished = []  # disks that finished since wait() last looked
+        self.start_ts = None
+        self.lease_status = None  # optional callable returning the NFC lease states
+
+    def add(self, target_id, download):
+        """ Register a download, its callbacks will feed this object """
+        disk = DiskProgress(target_id, download)
+        self.disks.append(disk)
+        download.byte_callbacks.append(lambda num_bytes: self._on_bytes(disk, num_bytes))
+        download.finish_callbacks.append(lambda: self._on_finish(disk))
+        return disk
+
+    def _on_bytes(self, disk, num_bytes):
+        """ Download callback - bytes arrived """
+        with self.lock:
+            disk.received_bytes += num_bytes
+
+    def _on_finish(self, disk):
+        """ Download callback - the download thread finished, wake wait() """
+        with self.condition:
+            self.finished.append(disk)
+            self.condition.notify_all()
+
+    @property
+    def covered_bytes(self):
+        """ Return how much of the VM's virtual disks have been transfered """
+        return sum(disk.covered_bytes for disk in self.disks)
+
+    @property
+    def received_bytes(self):
+        """ Return how many bytes have been received over the network """
+        return sum(disk.received_bytes for disk in self.disks)
+
+    @property
+    def percent(self):
+        """ Return the percentage of the export that is complete, 0-100 """
+        if not self.total_bytes:
+            return 0
+        return min(int(self.covered_bytes / self.total_bytes * 100), 100)
+
+    @property
+    def elapsed_seconds(self):
+        """ Return the seconds since start() """
+        return time() - self.start_ts if self.start_ts else 0
+
+    def emit(self, event, **fields):
+        """ Write one event - a JSON line, or a human readable line for text output """
+        if self.output_format == "json":
+            record = {"event": event, "ts": round(time(), 3), "vm": self.name}
+            record.update(fields)
+            self.stream.write(json.dumps(record) + "\n")
+        else:
+            self.stream.write(_format_text(event, fields))
+        self.stream.flush()
+
+    def start(self):
+        """ Mark the start of the export and emit the start event """
+        self.start_ts = time()
+        self.emit(
+            "start",
+            total_bytes=self.total_bytes,
+            interval=self.interval,
+            disks=[
+                {
+                    "target_id": disk.target_id,
+                    "path": disk.download.file_path,
+                    "url": disk.download.url,
+                }
+                for disk in self.disks
+            ],
+        )
+
+    def report(self):
+        """ Emit a progress event covering every disk """
+        now = time()
+        elapsed = max(self.elapsed_seconds, 0.001)
+        self.emit(
+            "progress",
+            elapsed_seconds=int(elapsed),
+            percent=self.percent,
+            covered_bytes=self.covered_bytes,
+            total_bytes=self.total_bytes,
+            avg_bps=int(self.received_bytes / elapsed),
+            disks=[disk.snapshot(now) for disk in self.disks],
+            leases=self.lease_status() if self.lease_status is not None else [],
+        )
+
+    def wait(self, on_tick=None):
+        """Block until every download finishes or one fails, reporting every interval
+
+        on_tick, if given, is called with this object each time wait() wakes up. Returns the
+        download that failed first, or None when they all succeeded.
+        """
+        wake_interval = min(self.interval, MAX_WAKE_INTERVAL) or MAX_WAKE_INTERVAL
+        last_report = time()
+        pending = list(self.disks)
+        while pending:
+            with self.condition:
+                if not self.finished:
+                    self.condition.wait(timeout=wake_interval)
+                finished, self.finished = self.finished, []
+            for disk in finished:
+                pending.remove(disk)
+                if disk.download.error is not None:
+                    self.emit("error", target_id=disk.target_id, message=str(disk.download.error))
+                    return disk.download
+                self.emit(
+                    "disk_done",
+                    target_id=disk.target_id,
+                    path=disk.download.file_path,
+                    bytes=disk.received_bytes,
+                    thick_bytes=disk.download.thick_size,
+                    allocated_bytes=disk.download.allocated_size(),
+                    seconds=round(disk.download.elapsed_seconds, 1),
+                    avg_bps=int(disk.received_bytes / max(disk.download.elapsed_seconds, 0.001)),
+                )
+            if on_tick is not None:
+                on_tick(self)
+            if pending and self.interval and time() - last_report >= self.interval:
+                self.report()
+                last_report = time()
+        return None
+
+    def complete(self):
+        """ Emit the final event of a successful export """
+        elapsed = max(self.elapsed_seconds, 0.001)
+        self.emit(
+            "complete",
+            elapsed_seconds=round(elapsed, 1),
+            covered_bytes=self.covered_bytes,
+            bytes=self.received_bytes,
+            avg_bps=int(self.received_bytes / elapsed),
+        )
+
+
+def _format_text(event, fields):
+    """ Return the human readable form of an event """
+    if event == "start":
+        lines = [f"Download {bytes_to_gb(fields['total_bytes'])} GB:"]
+        lines += [f"  {disk['path']} <-- {disk['url']}" for disk in fields["disks"]]
+        if fields["interval"]:
+            lines.append(f"  Starting download ... Progress updates every {fields['interval']}s")
+        return "\n".join(lines) + "\n"
+    if event == "progress":
+        lines = [""]
+        for disk in fields["disks"]:
+            done = "(DONE)" if disk["done"] else ""
+            speed = f"[CUR SPEED: {bytes_to_mb(disk['rate_bps'])} MB/s]"
+            eta = f"[ETA: {disk['eta_seconds']}s]" if disk["eta_seconds"] else ""
+            covered_gb = bytes_to_gb(disk["covered_bytes"])
+            lines.append(f"  {disk['path']} - {covered_gb} GB\t{speed} {eta} {done}")
+        total_gb = bytes_to_gb(fields["total_bytes"])
+        covered_gb = bytes_to_gb(fields["covered_bytes"])
+        percent = fields["percent"]
+        lines.append(f"- Total Downloaded: \t{covered_gb} GB / {total_gb} GB - {percent}%")
+        lines.append(f"- Avg Speed: \t{bytes_to_mb(fields['avg_bps'])} MB/s")
+        for lease in fields["leases"]:
+            since = lease["seconds_since_renewal"]
+            renewed = f"renewed {since}s ago" if since is not None else "not renewed yet"
+            latency = lease["last_latency_ms"]
+            lines.append(f"- NFC lease: \t{lease['state']}, {renewed} ({latency} ms)")
+        return "\n".join(lines) + "\n"
+    if event == "disk_done":
+        speed = bytes_to_mb(fields["avg_bps"])
+        line = f"  {fields['path']} finished in {fields['seconds']}s [AVG SPEED: {speed} MB/s]"
+        if fields.get("allocated_bytes") is not None:
+            line += f" [ALLOCATED: {bytes_to_gb(fields['allocated_bytes'])} GB]"
+        return line + "\n"
+    if event == "error":
+        return f"  {fields['target_id']} failed: {fields['message']}\n"
+    if event == "complete":
+        speed = bytes_to_mb(fields["avg_bps"])
+        return f"Finished download in {fields['elapsed_seconds']}s [AVG SPEED: {speed} MB/s]\n"
+    return f"{event}: {fields}\n"
@@ -0,0 +1,263 @@
+""" Filter VMs with a small query language, reading only the properties a query needs """
+import fnmatch
+import re
+import shlex
+
+from pyVmomi import vim
+
+from voithos.lib.vmware.common import debug
+from voithos.lib.vmware.inventory import VMRecord, retrieve_object_properties, retrieve_properties
+
+
+BYTES_IN_GB = 1024 * 1024 * 1024
+CONDITION_RE = re.compile(r"^(?P<field>\w+)\s*(?P<op>!=|>=|<=|=|~|>|<)\s*(?P<value>.*)$")
+NUMERIC_OPS = [">", "<", ">=", "<="]
+POWER_STATES = {"poweredOn": "on", "poweredOff": "off", "suspended": "suspended"}
+# field: property paths it is computed from
+FIELDS = {
+    "name": ["name"],
+    "uuid": ["config.uuid"],
+    "power": ["runtime.powerState"],
+    "guest": ["config.guestFullName"],
+    "cpu": ["config.hardware.numCPU"],
+    "ram_gb": ["config.hardware.memoryMB"],
+    "disk_gb": ["config.hardware.device"],
+    "datastore": ["datastore"],
+    "host": ["runtime.host"],
+    "cluster": ["runtime.host"],
+}
+NUMERIC_FIELDS = ["cpu", "ram_gb", "disk_gb"]
+# Fields that name a container, an exact match on one narrows what vCenter is asked for
+PUSHDOWN_FIELDS = ["cluster", "datastore"]
+
+
+class VMQueryError(ValueError):
+    """ A query expression could not be parsed """
+
+
+class Condition:
+    """ One field comparison, such as power=off or disk_gb>200 """
+
+    def __init__(self, field, op, value):
+        """ Check the comparison makes sense for the field """
+        if field not in FIELDS:
+            raise VMQueryError(f"ERROR: Unknown field {field}, use one of {sorted(FIELDS)}")
+        if op in NUMERIC_OPS or field in NUMERIC_FIELDS:
+            if field not in NUMERIC_FIELDS:
+                raise VMQueryError(f"ERROR: {field} is not numeric, it can't use {op}")
+            if op == "~":
+                raise VMQueryError(f"ERROR: {field} is numeric, it can't use ~")
+            try:
+                value = float(value)
+            except ValueError as exc:
+                raise VMQueryError(f"ERROR: {field}{op}{value} needs a number") from exc
+        self.field = field
+        self.op = op
+        self.value = value
+
+    def matches(self, actual):
+        """ Return True if the field's value satisfies the condition. Lists match any item """
+        if isinstance(actual, list):
+            if self.op == "!=":
+                return not any(self._compare(item, "=") for item in actual)
+            return any(self._compare(item, self.op) for item in actual)
+        return self._compare(actual, self.op)
+
+    def _compare(self, actual, op):
+        """ Compare one value """
+        if actual is None:
+            return op == "!="
+        if self.field in NUMERIC_FIELDS:
+            return {
+                "=": actual == self.value,
+                "!=": actual != self.value,
+                ">": actual > self.value,
+                "<": actual < self.value,
+                ">=": actual >= self.value,
+                "<=": actual <= self.value,
+            }[op]
+        actual, expected = str(actual).lower(), self.value.lower()
+        if op == "~":
+            return fnmatch.fnmatchcase(actual, expected)
+        return (actual == expected) == (op == "=")
+
+    def __repr__(self):
+        """ Show the condition as it was written """
+        return f"{self.field}{self.op}{self.value}"
+
+
+def parse_query(text):
+    """Parse text into a list of alternatives, each a list of conditions that must all hold
+
+    Conditions are joined with AND, which binds tighter than OR. = and != compare whole
+    values and ~ matches a glob pattern such as ssd*, all ignoring case. > < >= <= compare
+    numbers. Quote values that contain spaces.
+    """
+    try:
+        tokens = shlex.split(text)
+    except ValueError as exc:
+        raise VMQueryError(f"ERROR: Invalid query {text}: {exc}") from exc
+    groups, group, words = [], [], []
+    for token in tokens + ["OR"]:
+        keyword = token.upper()
+        if keyword not in ("AND", "OR"):
+            words.append(token)
+            continue
+        if not words:
+            raise VMQueryError(f"ERROR: Invalid query {text}: {token} needs a condition before it")
+        match = CONDITION_RE.match(" ".join(words))
+        if match is None:
+            raise VMQueryError(f"ERROR: Invalid condition {' '.join(words)}")
+        group.append(Condition(match.group("field"), match.group("op"), match.group("value")))
+        words = []
+        if keyword == "OR":
+            groups.append(group)
+            group = []
+    return groups
+
+
+class VMQuery:
+    """ A parsed query, evaluated against VM records """
+
+    def __init__(self, text):
+        """ Parse text, raising VMQueryError if it is invalid """
+        self.text = text
+        self.groups = parse_query(text)
+
+    @property
+    def fields(self):
+        """ Return the fields the query uses """
+        return {condition.field for group in self.groups for condition in group}
+
+    @property
+    def property_paths(self):
+        """ Return the VM properties needed to evaluate the query and identify the VMs """
+        paths = {"name", "config.uuid"}
+        for field in self.fields:
+            paths.update(FIELDS[field])
+        return sorted(paths)
+
+    def get_pushdown(self):
+        """Return (field, name) of a container every match must be in, or None
+
+        Only an exact cluster= or datastore= condition in a query without OR qualifies.
+        """
+        if len(self.groups) != 1:
+            return None
+        for field in PUSHDOWN_FIELDS:
+            for condition in self.groups[0]:
+                if condition.field == field and condition.op == "=":
+                    return field, condition.value
+        return None
+
+    def matches(self, values):
+        """ Return True if {field: value} satisfies the query """
+        return any(
+            all(condition.matches(values.get(condition.field)) for condition in group)
+            for group in self.groups
+        )
+
+
+class QueryContext:
+    """Names of the datastores, hosts and clusters VM records refer to
+
+    Each kind is read in one property collector call, and only if the query uses it.
+    """
+
+    def __init__(self, conn):
+        """ Nothing is read until a name is needed """
+        self.conn = conn
+        self.names = {}  # managed object type: {moref: name}
+        self.host_clusters = None  # host moref: cluster name
+
+    def get_names(self, obj_type):
+        """ Return {moref: name} for every object of obj_type """
+        if obj_type not in self.names:
+            self.names[obj_type] = {
+                obj._moId: props.get("name")
+                for obj, props in retrieve_properties(self.conn, obj_type, ["name"])
+            }
+        return self.names[obj_type]
+
+    def get_cluster_name(self, host):
+        """ Return the name of the cluster a host belongs to, None for standalone hosts """
+        if self.host_clusters is None:
+            clusters = self.get_names(vim.ClusterComputeResource)
+            self.host_clusters = {
+                obj._moId: clusters.get(props["parent"]._moId) if props.get("parent") else None
+                for obj, props in retrieve_properties(self.conn, vim.HostSystem, ["parent"])
+            }
+        return self.host_clusters.get(host._moId)
+
+    def get_values(self, record, fields):
+        """ Return {field: value} of a VM record for the given fields """
+        props = record.props
+        values = {}
+        for field in fields:
+            if field == "name":
+                values[field] = record.name
+            elif field == "uuid":
+                values[field] = record.uuid
+            elif field == "power":
+                values[field] = POWER_STATES.get(record.power_state, record.power_state)
+            elif field == "guest":
+                values[field] = props.get("config.guestFullName")
+            elif field == "cpu":
+                values[field] = props.get("config.hardware.numCPU")
+            elif field == "ram_gb":
+                memory_mb = props.get("config.hardware.memoryMB")
+                values[field] = memory_mb / 1024 if memory_mb is not None else None
+            elif field == "disk_gb":
+                values[field] = sum(disk.capacityInBytes for disk in record.disks) / BYTES_IN_GB
+            elif field == "datastore":
+                names = self.get_names(vim.Datastore)
+                values[field] = [names.get(ds._moId) for ds in props.get("datastore") or []]
+            elif field == "host":
+                host = record.host
+                values[field] = self.get_names(vim.HostSystem).get(host._moId) if host else None
+            elif field == "cluster":
+                values[field] = self.get_cluster_name(record.host) if record.host else None
+        return values
+
+
+def find_by_name(conn, obj_type, name):
+    """ Return the managed object of obj_type named name, ignoring case, or None """
+    for obj, props in retrieve_properties(conn, obj_type, ["name"]):
+        if (props.get("name") or "").lower() == name.lower():
+            return obj
+    return None
+
+
+def load_query_records(conn, query, container=None):
+    """Return records of the VMs that could match query, holding only the properties it needs
+
+    An exact cluster or datastore condition narrows the traversal to that cluster, or to the
+    datastore's VMs, so vCenter never sends the rest of the inventory. A container, such as a
+    scope, already narrows it and takes precedence.
+    """
+    paths = query.property_paths
+    pushdown = query.get_pushdown() if container is None else None
+    if pushdown is None:
+        results = retrieve_properties(conn, vim.VirtualMachine, paths, container=container)
+    elif pushdown[0] == "cluster":
+        cluster = find_by_name(conn, vim.ClusterComputeResource, pushdown[1])
+        if cluster is None:
+            return []
+        results = retrieve_properties(conn, vim.VirtualMachine, paths, container=cluster)
+    else:
+        datastore = find_by_name(conn, vim.Datastore, pushdown[1])
+        if datastore is None:
+            return []
+        datastore_props = retrieve_object_properties(conn, [datastore], vim.Datastore, ["vm"])
+        _, props = next(datastore_props, (None, {}))
+        vms = list(props.get("vm") or [])
+        results = retrieve_object_properties(conn, vms, vim.VirtualMachine, paths)
+    debug(f"query {query.text}: pushdown {pushdown}, properties {paths}")
+    return [VMRecord(vm, props) for vm, props in results]
+
+
+def filter_records(conn, query, records):
+    """ Return the records that match query """
+    context = QueryContext(conn)
+    fields = query.fields
+    return [record for record in records if query.matches(context.get_values(record, fields))]
@@ -1,6 +1,22 @@
 """ Generate reports from VMWare VM data """
 from pyVmomi import vim
 
+from voithos.lib.vmware.inventory import retrieve_object_properties
+
+
+REPORT_BATCH_SIZE = 500  # VMs whose properties are read per RetrievePropertiesEx call
+# Every property get_vm_data reads, so a batch of reports needs no further round-trips
+REPORT_PROPERTIES = [
+    "name",
+    "summary.config",
+    "summary.quickStats.uptimeSeconds",
+    "summary.overallStatus",
+    "config.createDate",
+    "config.hardware.device",
+    "runtime.powerState",
+    "guest.disk",
+]
+
 
 def bytes_to_gb(bytes_val):
     """ Convert bytes to GB, rounded to 2 decimal places """
@@ -11,8 +27,13 @@ def bytes_to_gb(bytes_val):
 
 def get_disk_data(vm):
     """ Return a list of dictionaries showing useful disk-related data """
+    return _disk_data(vm.config.hardware.device)
+
+
+def _disk_data(devices):
+    """ Return get_disk_data's list for a VM's hardware devices """
     disk_data = []
-    for dev in vm.config.hardware.device:
+    for dev in devices:
         if not isinstance(dev, vim.vm.device.VirtualDisk):
             continue
         shared = dev.backing.sharing != "sharingNone"
@@ -31,7 +52,11 @@ def get_disk_data(vm):
 
 def get_partition_data(vm):
     """ Return a dictionary of this VMs available useful partition data """
-    partitions = vm.guest.disk
+    return _partition_data(vm.guest.disk)
+
+
+def _partition_data(partitions):
+    """ Return get_partition_data's dictionary for a VM's guest partitions """
     total_used_gb = 0
     # Partition info is only available when the VM is on & has vmware tools
     part_data = []
@@ -55,8 +80,13 @@ def get_partition_data(vm):
 
 def get_network_data(vm):
     """ return a list of dictionaries showing useful network data """
+    return _network_data(vm.config.hardware.device)
+
+
+def _network_data(devices):
+    """ Return get_network_data's list for a VM's hardware devices """
     net_data = []
-    for dev in vm.config.hardware.device:
+    for dev in devices:
         if not hasattr(dev, "macAddress"):
             continue
         pci_slot_num = dev.slotInfo.pciSlotNumber if dev.slotInfo is not None else ""
@@ -77,26 +107,66 @@ def get_network_data(vm):
 
 def get_vm_data(vm):
     """ Return a dictionary of useful data about an entire VM """
+    return _vm_data(
+        {
+            "name": vm.name,
+            "summary.config": vm.summary.config,
+            "summary.quickStats.uptimeSeconds": vm.summary.quickStats.uptimeSeconds,
+            "summary.overallStatus": vm.summary.overallStatus,
+            "config.createDate": vm.config.createDate,
+            "config.hardware.device": vm.config.hardware.device,
+            "runtime.powerState": vm.runtime.powerState,
+            "guest.disk": vm.guest.disk,
+        }
+    )
+
+
+def _vm_data(props):
+    """ Return get_vm_data's dictionary from a VM's REPORT_PROPERTIES values """
+    summary_config = props["summary.config"]
+    devices = props.get("config.hardware.device") or []
     return {
-        "name": vm.name,
-        "uuid": vm.summary.config.uuid,
-        "create_date": str(vm.config.createDate),
-        "guest_os": vm.summary.config.guestFullName,
-        "uptime_seconds": vm.summary.quickStats.uptimeSeconds,
-        "power_state": vm.runtime.powerState,
-        "status": vm.summary.overallStatus,
-        "num_cpu": vm.summary.config.numCpu,
+        "name": props["name"],
+        "uuid": summary_config.uuid,
+        "create_date": str(props.get("config.createDate")),
+        "guest_os": summary_config.guestFullName,
+        "uptime_seconds": props.get("summary.quickStats.uptimeSeconds"),
+        "power_state": props["runtime.powerState"],
+        "status": props["summary.overallStatus"],
+        "num_cpu": summary_config.numCpu,
         "ram": {
-            "total_mb": vm.summary.config.memorySizeMB,
-            "used_mb": vm.summary.config.memorySizeMB,
+            "total_mb": summary_config.memorySizeMB,
+            "used_mb": summary_config.memorySizeMB,
         },
         "storage": {
-            "num_disks": vm.summary.config.numVirtualDisks,
-            "partitions": get_partition_data(vm),
-            "disks": get_disk_data(vm),
+            "num_disks": summary_config.numVirtualDisks,
+            "partitions": _partition_data(props.get("guest.disk") or []),
+            "disks": _disk_data(devices),
         },
         "network": {
-            "num_interfaces": vm.summary.config.numEthernetCards,
-            "networks": get_network_data(vm),
+            "num_interfaces": summary_config.numEthernetCards,
+            "networks": _network_data(devices),
         },
     }
+
+
+def iter_vm_reports(conn, vms, batch_size=REPORT_BATCH_SIZE):
+    """Yield get_vm_data's dictionary for each VM, in order
+
+    The properties of batch_size VMs at a time are read in one RetrievePropertiesEx call and
+    the reports are built from them in memory, instead of one round-trip per attribute.
+    """
+    vms = iter(vms)
+    while True:
+        batch = [vm for _, vm in zip(range(batch_size), vms)]
+        if not batch:
+            return
+        props = {
+            vm._moId: vm_props
+            for vm, vm_props in retrieve_object_properties(
+                conn, batch, vim.VirtualMachine, REPORT_PROPERTIES, page_size=batch_size
+            )
+        }
+        for vm in batch:
+            if vm._moId in props:  # a VM deleted since it was listed is left out
+                yield _vm_data(props[vm._moId])
@@ -0,0 +1,91 @@
+""" Keep landed disk files sparse - detect zero data and leave holes instead of writing it """
+import ctypes
+import ctypes.util
+import os
+import stat
+
+from voithos.lib.vmware.common import debug
+
+
+FALLOC_FL_KEEP_SIZE = 0x01  # linux/falloc.h
+FALLOC_FL_PUNCH_HOLE = 0x02
+ZERO_WRITE_SIZE = 1024 * 1024 * 4
+SPARSE_BLOCK_SIZE = 1024 * 64  # zero detection granularity, a multiple of filesystem blocks
+
+
+def is_zero(data):
+    """ Return True if data (bytes or a memoryview) is non-empty and every byte is zero """
+    if not data or data[0] or data[-1]:
+        return False  # cheap exit for the common case of real data
+    # Comparing bytes is a memcmp, comparing a memoryview goes element by element
+    data = bytes(data)
+    return data == bytes(len(data))
+
+
+def iter_runs(data, block_size=SPARSE_BLOCK_SIZE):
+    """Yield (start, end, zero) for the alternating data and all-zero runs of data
+
+    Zero detection works on block_size blocks, so zero runs shorter than a block are data.
+    """
+    view = memoryview(data)
+    run_start, run_zero = 0, None
+    for start in range(0, len(view), block_size):
+        zero = is_zero(view[start : start + block_size])
+        if run_zero is None:
+            run_zero = zero
+        elif zero != run_zero:
+            yield run_start, start, run_zero
+            run_start, run_zero = start, zero
+    if len(view):
+        yield run_start, len(view), run_zero
+
+
+def _libc_fallocate():
+    """ Return libc's fallocate function, or None if it isn't available """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fallocate = libc.fallocate
+    except (OSError, AttributeError, TypeError):
+        return None
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+    return fallocate
+
+
+_FALLOCATE = _libc_fallocate()
+
+
+def punch_hole(fd, offset, length):
+    """Make a byte range of a file read as zeros, deallocating it when the filesystem can
+
+    Used where a range may hold stale data, so seeking past it is not enough. Filesystems
+    without hole punching get the zeros written instead.
+    """
+    if length <= 0:
+        return
+    if _FALLOCATE is not None:
+        mode = FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE
+        if _FALLOCATE(fd, mode, offset, length) == 0:
+            return
+        debug(f"hole punching failed ({os.strerror(ctypes.get_errno())}), writing zeros")
+    zeros = bytes(min(length, ZERO_WRITE_SIZE))
+    end = offset + length
+    while offset < end:
+        step = min(len(zeros), end - offset)
+        os.pwrite(fd, zeros[:step], offset)
+        offset += step
+
+
+def is_block_device(path):
+    """ Return True if path exists and is a block device """
+    return os.path.exists(path) and stat.S_ISBLK(os.stat(path).st_mode)
+
+
+def allocated_size(path):
+    """ Return the bytes a regular file occupies on disk, None for devices and missing files """
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return None
+    if not stat.S_ISREG(stat_result.st_mode):
+        return None
+    return stat_result.st_blocks * 512
@@ -0,0 +1,188 @@
+""" Token-bucket bandwidth shaping shared by every disk download in the process """
+import json
+import os
+import signal
+import threading
+from time import monotonic, sleep
+
+from voithos.lib.vmware.common import debug
+
+
+BYTES_IN_MB = 1024 * 1024
+THROTTLED_CHUNK_SIZE = 1024 * 1024  # 1 MB - smaller reads keep throttled streams smooth
+CONTROL_FILE_POLL_INTERVAL = 5  # seconds
+
+
+class TokenBucket:
+    """A token bucket that lets callers go into debt
+
+    consume(n) always succeeds, but when the bucket is overdrawn the caller sleeps until the
+    debt is repaid. Streams that read big chunks are slowed in proportion, and when one stream
+    stops consuming, the others get its share of the rate automatically.
+    """
+
+    def __init__(self, rate_bps=None, burst_seconds=1):
+        """ Allow rate_bps bytes per second, None or 0 means unlimited """
+        self.lock = threading.Lock()
+        self.rate_bps = rate_bps
+        self.burst_seconds = burst_seconds
+        self.tokens = 0
+        self.updated = monotonic()
+
+    def set_rate(self, rate_bps):
+        """ Change the rate, effective immediately """
+        with self.lock:
+            self._refill()
+            self.rate_bps = rate_bps
+
+    def _refill(self):
+        """ Add the tokens earned since the last update, caller holds the lock """
+        now = monotonic()
+        if self.rate_bps:
+            capacity = self.rate_bps * self.burst_seconds
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate_bps, capacity)
+        self.updated = now
+
+    def take(self, num_bytes):
+        """ Take num_bytes of tokens, return how long the caller must sleep to repay any debt """
+        with self.lock:
+            if not self.rate_bps:
+                return 0
+            self._refill()
+            self.tokens -= num_bytes
+            return -self.tokens / self.rate_bps if self.tokens < 0 else 0
+
+    def consume(self, num_bytes):
+        """ Take num_bytes of tokens, sleeping as long as required """
+        wait = self.take(num_bytes)
+        if wait:
+            sleep(wait)
+
+
+class BandwidthShaper:
+    """Global, per-ESXi-host and per-VM bandwidth limits for every download in the process
+
+    Limits are in bytes per second. Each stream draws from all the buckets that apply to it
+    and waits for the slowest one. Limits can be changed at runtime with set_limits(), by
+    editing a JSON control file, or by sending SIGHUP to reload the control file.
+    """
+
+    def __init__(self, global_bps=None, host_bps=None, vm_bps=None):
+        """ Construct the shaper, None or 0 leaves a level unlimited """
+        self.lock = threading.Lock()
+        self.default_limits = {"global_bps": global_bps, "host_bps": host_bps, "vm_bps": vm_bps}
+        self.global_bps = global_bps
+        self.host_bps = host_bps
+        self.vm_bps = vm_bps
+        self.host_overrides = {}  # host: bytes per second, from the control file
+        self.global_bucket = TokenBucket(global_bps)
+        self.host_buckets = {}
+        self.vm_buckets = {}
+        self.control_file = None
+        self.control_mtime = None
+        self.watcher = None
+        self.stop_event = threading.Event()
+
+    @property
+    def enabled(self):
+        """ Return True if any limit is set """
+        return bool(self.global_bps or self.host_bps or self.vm_bps or self.host_overrides)
+
+    def _host_rate(self, host):
+        """ Return the limit for one host, a control file override wins """
+        return self.host_overrides.get(host, self.host_bps)
+
+    def _buckets(self, host, vm):
+        """ Return the buckets a stream from host for vm draws from """
+        with self.lock:
+            if host not in self.host_buckets:
+                self.host_buckets[host] = TokenBucket(self._host_rate(host))
+            if vm not in self.vm_buckets:
+                self.vm_buckets[vm] = TokenBucket(self.vm_bps)
+            return [self.global_bucket, self.host_buckets[host], self.vm_buckets[vm]]
+
+    def throttle(self, host, vm, num_bytes):
+        """ Account for num_bytes received from host for vm, sleeping if over any limit """
+        wait = max(bucket.take(num_bytes) for bucket in self._buckets(host, vm))
+        if wait:
+            sleep(wait)
+
+    def get_throttle(self, host, vm):
+        """ Return a callable(num_bytes) throttling one stream, for DiskDownload """
+        return lambda num_bytes: self.throttle(host, vm, num_bytes)
+
+    def set_limits(self, global_bps=None, host_bps=None, vm_bps=None, host_overrides=None):
+        """ Replace every limit and apply them to the existing buckets """
+        with self.lock:
+            self.global_bps = global_bps
+            self.host_bps = host_bps
+            self.vm_bps = vm_bps
+            self.host_overrides = host_overrides or {}
+            self.global_bucket.set_rate(global_bps)
+            for host, bucket in self.host_buckets.items():
+                bucket.set_rate(self._host_rate(host))
+            for bucket in self.vm_buckets.values():
+                bucket.set_rate(vm_bps)
+        debug(f"bandwidth limits: global={global_bps} host={host_bps} vm={vm_bps}")
+
+    def load_control_file(self, path=None):
+        """Read limits from a JSON control file, values in MB/s, for example:
+
+        {"global_mbps": 400, "host_mbps": 200, "vm_mbps": 100, "hosts": {"esxi-01": 50}}
+        A missing key keeps the limit the shaper was constructed with, null or 0 is unlimited.
+        """
+        path = path if path is not None else self.control_file
+        with open(path) as file_:
+            limits = json.load(file_)
+        self.control_mtime = os.stat(path).st_mtime
+        defaults = self.default_limits
+        self.set_limits(
+            global_bps=_file_limit(limits, "global_mbps", defaults["global_bps"]),
+            host_bps=_file_limit(limits, "host_mbps", defaults["host_bps"]),
+            vm_bps=_file_limit(limits, "vm_mbps", defaults["vm_bps"]),
+            host_overrides={
+                host: mbps_to_bps(mbps) for host, mbps in limits.get("hosts", {}).items()
+            },
+        )
+
+    def watch(self, path, interval=CONTROL_FILE_POLL_INTERVAL):
+        """ Load path now, reload it whenever it changes and on SIGHUP """
+        self.control_file = path
+        self.load_control_file()
+        self.watcher = threading.Thread(
+            target=self._watch, args=(interval,), daemon=True, name="bandwidth-control-file"
+        )
+        self.watcher.start()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGHUP, lambda sig, frame: self._reload())
+
+    def _reload(self):
+        """ Reload the control file, keeping the current limits if it can't be read """
+        try:
+            self.load_control_file()
+        except (OSError, ValueError) as exc:
+            debug(f"keeping current bandwidth limits, failed to load {self.control_file}: {exc}")
+
+    def _watch(self, interval):
+        """ Thread target - reload the control file when its modification time changes """
+        while not self.stop_event.wait(interval):
+            try:
+                mtime = os.stat(self.control_file).st_mtime
+            except OSError:
+                continue
+            if mtime != self.control_mtime:
+                self._reload()
+
+    def stop(self):
+        """ Stop watching the control file """
+        self.stop_event.set()
+
+
+def mbps_to_bps(mbps):
+    """ Return MB/s as bytes per second, None and 0 stay unlimited """
+    return int(float(mbps) * BYTES_IN_MB) if mbps else None
+
+
+def _file_limit(limits, key, default):
+    """ Return a control file limit in bytes per second, default when the key is missing """
+    return mbps_to_bps(limits[key]) if key in limits else default
@@ -0,0 +1,513 @@
+""" Stream VMDK files out of VMware over HTTP """
+import hashlib
+import json
+import os
+from threading import BoundedSemaphore, Event, Lock, Thread
+from time import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from voithos.lib.vmware.common import debug
+from voithos.lib.vmware.manifest import file_sha256
+from voithos.lib.vmware.sparse import allocated_size, is_block_device, iter_runs, punch_hole
+from voithos.lib.vmware.vmdk import SECTOR_SIZE, peek_virtual_size
+
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024 * 20  # 20 MB
+CONNECT_TIMEOUT = 30  # seconds
+READ_TIMEOUT = 300  # seconds - a stalled stream raises instead of hanging forever
+COMMIT_INTERVAL = 1024 * 1024 * 256  # 256 MB - fsync and journal the offset this often
+HOST_CONNECTION_LIMIT = 8  # concurrent HTTP streams allowed to any one host
+
+
+class VMWareDownloadFailed(Exception):
+    """ A disk download did not complete """
+
+
+def get_session(pool_size=10):
+    """ Return a requests session whose connection pool can hold pool_size streams """
+    session = requests.Session()
+    # The NFC service uses the ESXi host's self-signed certificate
+    session.verify = False
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+_HOST_SLOTS = {}
+_HOST_SLOTS_LOCK = Lock()
+
+
+def get_host_slots(host, limit=HOST_CONNECTION_LIMIT):
+    """ Return the semaphore capping concurrent connections to host, shared process-wide """
+    with _HOST_SLOTS_LOCK:
+        if host not in _HOST_SLOTS:
+            _HOST_SLOTS[host] = BoundedSemaphore(limit)
+        return _HOST_SLOTS[host]
+
+
+class DownloadJournal:
+    """Sidecar JSON file recording how many bytes of each disk are safely on disk
+
+    Offsets are keyed by the NFC device's targetId, which is stable across leases, so an
+    interrupted export can resume with a fresh lease.
+    """
+
+    def __init__(self, path, reset=False):
+        """ Load the journal at path, or start an empty one when reset=True """
+        self.path = path
+        self.lock = Lock()
+        self.entries = {}
+        if not reset and os.path.exists(path):
+            with open(path) as file_:
+                self.entries = json.load(file_)
+
+    def get_offset(self, target_id):
+        """ Return the committed byte offset of a disk, 0 if it was never started """
+        return self.entries.get(target_id, {}).get("offset", 0)
+
+    def is_complete(self, target_id):
+        """ Return True if the disk finished downloading in an earlier run """
+        return self.entries.get(target_id, {}).get("complete", False)
+
+    def get_digest(self, target_id):
+        """ Return the SHA-256 recorded when the disk completed, or None """
+        return self.entries.get(target_id, {}).get("sha256")
+
+    def get_segments(self, target_id):
+        """ Return {segment start offset: bytes committed} for a segmented download """
+        segments = self.entries.get(target_id, {}).get("segments", {})
+        return {int(start): done for start, done in segments.items()}
+
+    def get_segment_digests(self, target_id):
+        """ Return {segment start offset: SHA-256} of the segments that finished """
+        digests = self.entries.get(target_id, {}).get("segment_sha256", {})
+        return {int(start): digest for start, digest in digests.items()}
+
+    def commit(self, target_id, offset, complete=False, sha256=None):
+        """ Record that offset bytes of target_id are durable, and its digest once complete """
+        with self.lock:
+            entry = self.entries.setdefault(target_id, {})
+            entry.update({"offset": offset, "complete": complete})
+            if sha256 is not None:
+                entry["sha256"] = sha256
+            self._save()
+
+    def commit_segment(self, target_id, start, done, sha256=None):
+        """ Record that done bytes of the segment beginning at start are durable """
+        with self.lock:
+            entry = self.entries.setdefault(target_id, {"offset": 0, "complete": False})
+            entry.setdefault("segments", {})[str(start)] = done
+            if sha256 is not None:
+                entry.setdefault("segment_sha256", {})[str(start)] = sha256
+            entry["offset"] = sum(entry["segments"].values())
+            self._save()
+
+    def _save(self):
+        """ Write the journal to disk, the caller must hold self.lock """
+        # Write-and-rename so a crash never leaves a truncated journal behind
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file_:
+            json.dump(self.entries, file_)
+            file_.flush()
+            os.fsync(file_.fileno())
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        """ Delete the journal, once every disk is complete it has no further use """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class DiskDownload:
+    """ Stream a single URL to a local file, counting bytes as they arrive """
+
+    def __init__(
+        self,
+        session,
+        url,
+        file_path,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        journal=None,
+        target_id=None,
+        resume=False,
+        throttle=None,
+    ):
+        """Construct the download, nothing is transfered until start() or run()
+
+        When a journal is given the committed offset is recorded under target_id as the file
+        is written. With resume=True the download continues from the journaled offset.
+        throttle, if given, is called with the size of each chunk received and may sleep to
+        slow the stream down.
+        """
+        self.session = session
+        self.url = url
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.journal = journal
+        self.target_id = target_id
+        self.resume = resume
+        self.throttle = throttle
+        self.resumed_from = 0
+        self.bytes_written = 0
+        self.hasher = None
+        self.sha256 = None  # hex digest of the file written, once complete
+        self.sha256_note = None  # why a finished disk has no sha256
+        self.sparse_bytes = 0  # zero bytes left as holes instead of being written
+        self.thick_size = None  # virtual disk size, when the download path knows it
+        self.disk_position = None  # end of the last decoded grain, when the stream is decoded
+        self.counter_lock = Lock()
+        self.byte_callbacks = []  # called with the size of each chunk received
+        self.finish_callbacks = []  # called once the download thread finishes
+        self.error = None
+        self.done = False
+        self.start_ts = None
+        self.end_ts = None
+        self.thread = None
+
+    @property
+    def elapsed_seconds(self):
+        """ Return how long this download has been running, or ran for """
+        if self.start_ts is None:
+            return 0
+        end = self.end_ts if self.end_ts is not None else time()
+        return end - self.start_ts
+
+    @property
+    def covered_bytes(self):
+        """ Return how far into the virtual disk the download has progressed, if known """
+        if self.disk_position is not None:
+            return self.disk_position
+        return self.bytes_written
+
+    def is_alive(self):
+        """ Return True while the download thread is running """
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """ Run the download in a background thread """
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def join(self, timeout=None):
+        """ Wait for the download thread to finish """
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def run(self):
+        """ Download the file. Failures are kept in self.error so the caller can raise them """
+        self.start_ts = time()
+        try:
+            self._stream()
+        except Exception as exc:  # pylint: disable=broad-except
+            debug(f"download of {self.url} failed: {exc}")
+            self.error = exc
+        finally:
+            self.end_ts = time()
+            self.done = True
+            for callback in self.finish_callbacks:
+                callback()
+
+    def _count(self, num_bytes):
+        """ Add num_bytes to the byte counter, safe to call from several threads """
+        if self.throttle is not None:
+            self.throttle(num_bytes)
+        with self.counter_lock:
+            self.bytes_written += num_bytes
+        for callback in self.byte_callbacks:
+            callback(num_bytes)
+
+    def _completed_earlier(self):
+        """ Return True, and set the byte counter, if the journal says this disk is done """
+        if not self.resume or self.journal is None:
+            return False
+        if not self.journal.is_complete(self.target_id):
+            return False
+        debug(f"{self.file_path} was completed by a previous run, skipping")
+        self.bytes_written = self.journal.get_offset(self.target_id)
+        self.sha256 = self.journal.get_digest(self.target_id)
+        return True
+
+    def _stream(self):
+        """ GET the URL and write each chunk to disk """
+        if self._completed_earlier():
+            return
+        offset = 0
+        if self.resume and self.journal is not None:
+            offset = self.journal.get_offset(self.target_id)
+        if not os.path.exists(self.file_path):
+            offset = 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        with self.session.get(self.url, stream=True, timeout=timeout, headers=headers) as resp:
+            resp.raise_for_status()
+            if offset and resp.status_code != 206:
+                # The endpoint ignored the Range header and is sending the whole file
+                debug(f"{self.url} does not support ranges, restarting {self.file_path}")
+                offset = 0
+            self.resumed_from = offset
+            self.bytes_written = offset
+            self.hasher = hashlib.sha256()
+            if offset:
+                # The digest covers the whole file, so the part kept from the last run is reread
+                file_sha256(self.file_path, length=offset, hasher=self.hasher)
+            mode = "r+b" if offset else "wb"
+            with open(self.file_path, mode) as file_:
+                # Anything past the committed offset may be garbage from the interrupted run
+                file_.truncate(offset)
+                file_.seek(offset)
+                uncommitted = 0
+                for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                    if not chunk:
+                        continue
+                    if self.bytes_written == 0 and len(chunk) >= SECTOR_SIZE:
+                        # The VMDK header gives the thick size before the download finishes
+                        self.thick_size = peek_virtual_size(chunk)
+                    self.hasher.update(chunk)
+                    self._write_sparse(file_, chunk)
+                    self._count(len(chunk))
+                    uncommitted += len(chunk)
+                    if uncommitted >= COMMIT_INTERVAL:
+                        self._commit(file_)
+                        uncommitted = 0
+                self.sha256 = self.hasher.hexdigest()
+                # A trailing run of zeros was only seeked over, set the size explicitly
+                file_.truncate(self.bytes_written)
+                self._commit(file_, complete=True)
+        if self.thick_size is None:
+            # Resumed downloads never saw the header arrive, read it back from the file
+            with open(self.file_path, "rb") as file_:
+                self.thick_size = peek_virtual_size(file_.read(SECTOR_SIZE))
+
+    def _write_sparse(self, file_, chunk):
+        """Write chunk at the file's position, seeking over all-zero runs
+
+        The file is always truncated to the resume offset first, so whatever is seeked over
+        is a hole that reads as zeros.
+        """
+        view = memoryview(chunk)
+        for start, end, zero in iter_runs(view):
+            if zero:
+                file_.seek(end - start, os.SEEK_CUR)
+                self._count_sparse(end - start)
+            else:
+                file_.write(view[start:end])
+
+    def _count_sparse(self, num_bytes):
+        """ Add num_bytes to the count of zero bytes not written """
+        with self.counter_lock:
+            self.sparse_bytes += num_bytes
+
+    def allocated_size(self):
+        """ Return the bytes the landed file occupies on disk, None for block devices """
+        return allocated_size(self.file_path)
+
+    def _commit(self, file_, complete=False):
+        """ Flush the file to stable storage, then journal the offset """
+        if self.journal is None:
+            return
+        file_.flush()
+        os.fsync(file_.fileno())
+        sha256 = self.sha256 if complete else None
+        self.journal.commit(self.target_id, self.bytes_written, complete=complete, sha256=sha256)
+
+    def manifest_entry(self):
+        """ Return this disk's record for the export manifest """
+        return {
+            "target_id": self.target_id,
+            "file": self.file_path,
+            "bytes": self.bytes_written,
+            "allocated_bytes": self.allocated_size(),
+            "sha256": self.sha256,
+            "sha256_note": self.sha256_note,
+            "start_ts": self.start_ts,
+            "end_ts": self.end_ts,
+            "seconds": round(self.elapsed_seconds, 1),
+        }
+
+    def raise_for_error(self):
+        """ Raise VMWareDownloadFailed if this download did not complete """
+        if self.error is not None:
+            raise VMWareDownloadFailed(
+                f"ERROR: Download of {self.url} to {self.file_path} failed: {self.error}"
+            ) from self.error
+
+
+class SegmentedDownload(DiskDownload):
+    """Download one URL as several byte-range segments fetched in parallel
+
+    Each segment is written in place with pwrite into a preallocated file, or into a block
+    device at least as large as the download. Segments land out of order, so each is hashed on
+    its own as it arrives and the manifest lists a digest per segment. When the endpoint does not
+    honour range requests this falls back to a single DiskDownload stream, which can only write
+    files.
+    """
+
+    def __init__(
+        self, *args, segments=4, max_host_connections=HOST_CONNECTION_LIMIT, **kwargs
+    ):
+        """ Construct the download, see DiskDownload for the shared arguments """
+        super().__init__(*args, **kwargs)
+        self.segments = segments
+        self.host_slots = get_host_slots(urlsplit(self.url).hostname, max_host_connections)
+        self.stop_event = Event()
+        self.reused_file = False
+        self.ranges = []  # (start, end) of each segment
+        self.segment_digests = {}  # segment start: SHA-256 of the segment
+
+    def _probe_size(self):
+        """Return the size of the file if the endpoint honours ranges, else None
+
+        The first sector is read too, so thick_size is known before the segments start. It is
+        the virtual size of a VMDK stream, or the size of the file itself for a raw extent.
+        """
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        headers = {"Range": f"bytes=0-{SECTOR_SIZE - 1}"}
+        with self.session.get(self.url, stream=True, timeout=timeout, headers=headers) as resp:
+            resp.raise_for_status()
+            content_range = resp.headers.get("Content-Range", "")
+            if resp.status_code != 206 or "/" not in content_range:
+                return None
+            total = content_range.rsplit("/", 1)[1]
+            if not total.isdigit():
+                return None
+            head = b"".join(resp.iter_content(chunk_size=SECTOR_SIZE))
+            self.thick_size = peek_virtual_size(head) or int(total)
+            return int(total)
+
+    def _plan(self, total):
+        """ Return a list of (start, end) byte ranges, end exclusive, covering total bytes """
+        segment_size = -(-total // self.segments)  # ceiling division
+        return [
+            (start, min(start + segment_size, total)) for start in range(0, total, segment_size)
+        ]
+
+    def _stream(self):
+        """ Fetch every segment in parallel, or fall back to one stream """
+        if self._completed_earlier():
+            segments = self.journal.get_segments(self.target_id)
+            self.ranges = [(start, start + done) for start, done in sorted(segments.items())]
+            self.segment_digests = self.journal.get_segment_digests(self.target_id)
+            return
+        total = self._probe_size()
+        block_device = is_block_device(self.file_path)
+        if total is None and block_device:
+            raise VMWareDownloadFailed(
+                f"{self.url} refused range requests, it can't be written to {self.file_path}"
+            )
+        if total is None or (total < self.segments * self.chunk_size and not block_device):
+            debug(f"{self.url} - not segmenting, ranges refused or file too small")
+            super()._stream()
+            return
+        committed = {}
+        if self.resume and self.journal is not None and os.path.exists(self.file_path):
+            committed = self.journal.get_segments(self.target_id)
+            self.segment_digests = self.journal.get_segment_digests(self.target_id)
+        self.resumed_from = sum(committed.values())
+        self.bytes_written = self.resumed_from
+        # Zero runs are left as holes, a reused file may hold stale data so its holes are punched.
+        # A block device can't be truncated and always holds old data, so its zeros are written
+        self.reused_file = os.path.exists(self.file_path)
+        fd = os.open(self.file_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if block_device:
+                device_size = os.lseek(fd, 0, os.SEEK_END)
+                if device_size < total:
+                    raise VMWareDownloadFailed(
+                        f"{self.file_path} is {device_size} bytes, the disk needs {total}"
+                    )
+            elif self.reused_file and not committed:
+                os.ftruncate(fd, 0)  # nothing to keep, start from an empty sparse file
+                self.reused_file = False
+            if not block_device:
+                os.ftruncate(fd, total)
+            threads = []
+            errors = []
+            self.ranges = self._plan(total)
+            for start, end in self.ranges:
+                thread = Thread(
+                    target=self._run_segment,
+                    args=(fd, start, end, committed.get(start, 0), errors),
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise errors[0]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        if self.journal is not None:
+            self.journal.commit(self.target_id, total, complete=True)
+
+    def manifest_entry(self):
+        """ Return this disk's record for the export manifest, with a digest per segment """
+        entry = super().manifest_entry()
+        if self.segment_digests:
+            entry["segments"] = [
+                {"offset": start, "bytes": end - start, "sha256": self.segment_digests.get(start)}
+                for start, end in self.ranges
+            ]
+        return entry
+
+    def _run_segment(self, fd, start, end, done, errors):
+        """ Thread target - fetch one segment, stopping the others if it fails """
+        try:
+            with self.host_slots:
+                self._fetch_segment(fd, start, end, done)
+        except Exception as exc:  # pylint: disable=broad-except
+            self.stop_event.set()
+            errors.append(exc)
+
+    def _fetch_segment(self, fd, start, end, done):
+        """ GET bytes [start + done, end), pwrite them at their offset and hash the segment """
+        if start + done >= end and start in self.segment_digests:
+            return
+        hasher = hashlib.sha256()
+        if done:
+            # Only the part kept from an earlier run is reread, the rest is hashed as it arrives
+            file_sha256(self.file_path, length=done, hasher=hasher, offset=start)
+        if start + done < end:
+            headers = {"Range": f"bytes={start + done}-{end - 1}"}
+            timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+            with self.session.get(self.url, stream=True, timeout=timeout, headers=headers) as resp:
+                resp.raise_for_status()
+                if resp.status_code != 206:
+                    raise VMWareDownloadFailed(f"{self.url} refused the range {headers['Range']}")
+                uncommitted = 0
+                for chunk in resp.iter_content(chunk_size=self.chunk_size):
+                    if self.stop_event.is_set():
+                        return
+                    if not chunk:
+                        continue
+                    hasher.update(chunk)
+                    self._pwrite_sparse(fd, chunk, start + done)
+                    done += len(chunk)
+                    self._count(len(chunk))
+                    uncommitted += len(chunk)
+                    if uncommitted >= COMMIT_INTERVAL and self.journal is not None:
+                        os.fsync(fd)
+                        self.journal.commit_segment(self.target_id, start, done)
+                        uncommitted = 0
+        self.segment_digests[start] = hasher.hexdigest()
+        if self.journal is not None:
+            os.fsync(fd)
+            self.journal.commit_segment(
+                self.target_id, start, done, sha256=self.segment_digests[start]
+            )
+
+    def _pwrite_sparse(self, fd, chunk, offset):
+        """ Write chunk at offset, leaving holes for all-zero runs """
+        view = memoryview(chunk)
+        for start, end, zero in iter_runs(view):
+            if not zero:
+                os.pwrite(fd, view[start:end], offset + start)
+                continue
+            if self.reused_file:
+                punch_hole(fd, offset + start, end - start)
+            self._count_sparse(end - start)
@@ -0,0 +1,322 @@
+""" Read VMware sparse and streamOptimized VMDK files without qemu-img """
+import os
+import struct
+import zlib
+
+
+SECTOR_SIZE = 512
+SPARSE_MAGIC = 0x564D444B  # "KDMV"
+# SparseExtentHeader: magic, version, flags, capacity, grainSize, descriptorOffset,
+# descriptorSize, numGTEsPerGT, rgdOffset, gdOffset, overHead, uncleanShutdown,
+# the four line-ending check chars, compressAlgorithm and padding
+HEADER_FORMAT = "<IIIQQQQIQQQB4sH433s"
+FLAG_COMPRESSED = 1 << 16
+FLAG_MARKERS = 1 << 17
+MARKER_EOS = 0
+MARKER_GT = 1
+MARKER_GD = 2
+MARKER_FOOTER = 3
+GD_AT_END = 0xFFFFFFFFFFFFFFFF  # streamOptimized headers point at the footer instead
+DESCRIPTOR_SIGNATURE = b"# Disk DescriptorFile"
+
+
+class VMDKFormatError(Exception):
+    """ The data is not a VMDK this module can read """
+
+
+class SparseExtentHeader:
+    """ The 512 byte header found at the start (and in the footer) of a sparse VMDK extent """
+
+    def __init__(self, data):
+        """ Parse the header from the first 512 bytes of data """
+        if len(data) < SECTOR_SIZE:
+            raise VMDKFormatError("ERROR: VMDK header is truncated")
+        fields = struct.unpack(HEADER_FORMAT, data[:SECTOR_SIZE])
+        (
+            self.magic,
+            self.version,
+            self.flags,
+            self.capacity,
+            self.grain_size,
+            self.descriptor_offset,
+            self.descriptor_size,
+            self.num_gtes_per_gt,
+            self.rgd_offset,
+            self.gd_offset,
+            self.overhead,
+            self.unclean_shutdown,
+            _,
+            self.compress_algorithm,
+            _,
+        ) = fields
+        if self.magic != SPARSE_MAGIC:
+            raise VMDKFormatError("ERROR: Not a sparse VMDK extent (bad magic number)")
+
+    @property
+    def is_stream_optimized(self):
+        """ Return True if grains are compressed and wrapped in markers """
+        return bool(self.flags & FLAG_COMPRESSED) and bool(self.flags & FLAG_MARKERS)
+
+    @property
+    def virtual_size(self):
+        """ Return the size of the virtual disk in bytes """
+        return self.capacity * SECTOR_SIZE
+
+    @property
+    def grain_bytes(self):
+        """ Return the size of one uncompressed grain in bytes """
+        return self.grain_size * SECTOR_SIZE
+
+
+class VMDKDescriptor:
+    """ The text descriptor of a VMDK - embedded in a sparse extent or as its own file """
+
+    def __init__(self, text):
+        """ Parse the descriptor text """
+        self.text = text
+        self.fields = {}
+        self.extents = []
+        self.ddb = {}
+        for line in text.splitlines():
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith(("RW ", "RDONLY ", "NOACCESS ")):
+                self.extents.append(_parse_extent(line))
+                continue
+            if "=" not in line:
+                continue
+            key, value = (part.strip() for part in line.split("=", 1))
+            value = value.strip('"')
+            if key.startswith("ddb."):
+                self.ddb[key[4:]] = value
+            else:
+                self.fields[key] = value
+
+    @property
+    def create_type(self):
+        """ Return the createType, such as streamOptimized or monolithicFlat """
+        return self.fields.get("createType")
+
+    @property
+    def virtual_size(self):
+        """ Return the size of the virtual disk in bytes, the sum of its extents """
+        return sum(extent["sectors"] for extent in self.extents) * SECTOR_SIZE
+
+
+def _parse_extent(line):
+    """ Parse an extent line: <access> <sectors> <type> ["file name" [offset]] """
+    head, _, tail = line.partition('"')
+    access, sectors, extent_type = head.split()[:3]
+    file_name, _, offset = tail.partition('"')
+    return {
+        "access": access,
+        "sectors": int(sectors),
+        "type": extent_type,
+        "file_name": file_name or None,
+        "offset": int(offset) if offset.strip() else 0,
+    }
+
+
+class ChunkReader:
+    """ File-like read(n) over an iterator of byte chunks, such as requests' iter_content """
+
+    def __init__(self, chunks):
+        """ Wrap an iterator of bytes objects """
+        self.chunks = iter(chunks)
+        self.buffer = bytearray()
+        self.position = 0
+
+    def read(self, size):
+        """ Return exactly size bytes, or fewer only at the end of the stream """
+        while len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.position += len(data)
+        return data
+
+
+def _read_exact(stream, size):
+    """ Read size bytes from stream or raise VMDKFormatError """
+    data = stream.read(size)
+    if len(data) != size:
+        raise VMDKFormatError("ERROR: VMDK stream ended unexpectedly")
+    return data
+
+
+def _skip(stream, size):
+    """ Discard size bytes from stream without holding them all in memory """
+    while size > 0:
+        step = min(size, 1024 * 1024)
+        _read_exact(stream, step)
+        size -= step
+
+
+def read_stream_header(stream):
+    """Read the header and everything up to the first marker from a streamOptimized VMDK
+
+    Returns the parsed SparseExtentHeader, leaving stream positioned at the first marker.
+    """
+    header = SparseExtentHeader(_read_exact(stream, SECTOR_SIZE))
+    if not header.is_stream_optimized:
+        raise VMDKFormatError("ERROR: VMDK is not streamOptimized, it can't be read as a stream")
+    _skip(stream, header.overhead * SECTOR_SIZE - SECTOR_SIZE)
+    return header
+
+
+def iter_grains(stream, header):
+    """Yield (byte offset, data) for every grain of a streamOptimized VMDK
+
+    stream must be positioned at the first marker, see read_stream_header. Grain tables,
+    the grain directory and the footer are skipped. Iteration stops at the end-of-stream marker.
+    A grain larger than the header's grain size raises VMDKFormatError.
+    """
+    for offset, compressed in _iter_markers(stream, header, keep_data=True):
+        data = zlib.decompress(compressed)
+        if len(data) > header.grain_bytes:
+            raise VMDKFormatError(
+                f"ERROR: VMDK grain at {offset} inflates to {len(data)} bytes, "
+                f"over the {header.grain_bytes} byte grain size"
+            )
+        yield offset, data
+
+
+def count_stream_grains(stream, header):
+    """ Return how many grains a streamOptimized VMDK stream holds, without inflating them """
+    return sum(1 for _ in _iter_markers(stream, header, keep_data=False))
+
+
+def _iter_markers(stream, header, keep_data):
+    """Yield (byte offset, compressed data or None) for each grain marker in the stream
+
+    A grain that is not aligned to the header's grain size, or lies past the end of the disk,
+    raises VMDKFormatError.
+    """
+    while True:
+        marker = stream.read(12)
+        if not marker:
+            return  # Some writers omit the end-of-stream marker
+        if len(marker) != 12:
+            raise VMDKFormatError("ERROR: VMDK stream ended inside a marker")
+        value, size = struct.unpack("<QI", marker)
+        if size:
+            offset = value * SECTOR_SIZE
+            if offset % header.grain_bytes or offset >= header.virtual_size:
+                raise VMDKFormatError(f"ERROR: VMDK grain at {offset} is outside the disk grains")
+            # Grain marker: LBA, compressed size, then the deflated grain, padded to a sector
+            if keep_data:
+                compressed = _read_exact(stream, size)
+            else:
+                compressed = None
+                _skip(stream, size)
+            _skip(stream, -(12 + size) % SECTOR_SIZE)
+            yield offset, compressed
+            continue
+        # Metadata marker: one sector holding the sector count and type, then the metadata
+        (marker_type,) = struct.unpack("<I", _read_exact(stream, 4))
+        _skip(stream, SECTOR_SIZE - 16)
+        if marker_type == MARKER_EOS:
+            return
+        _skip(stream, value * SECTOR_SIZE)
+
+
+def read_descriptor(file_, header):
+    """ Return the VMDKDescriptor embedded in a sparse extent, or None if it has none """
+    if not header.descriptor_offset or not header.descriptor_size:
+        return None
+    file_.seek(header.descriptor_offset * SECTOR_SIZE)
+    text = file_.read(header.descriptor_size * SECTOR_SIZE)
+    return VMDKDescriptor(text.rstrip(b"\0").decode("utf-8", errors="replace"))
+
+
+def _read_footer_header(file_):
+    """ Return the header copy in a streamOptimized footer, None if the file has no footer """
+    size = file_.seek(0, os.SEEK_END)
+    if size < SECTOR_SIZE * 3:
+        return None
+    # <footer marker> <footer header> <end-of-stream marker>
+    file_.seek(size - SECTOR_SIZE * 2)
+    try:
+        return SparseExtentHeader(file_.read(SECTOR_SIZE))
+    except VMDKFormatError:
+        return None
+
+
+def count_allocated_grains(file_, header):
+    """ Return the number of grains allocated in a sparse extent, from its grain tables """
+    gd_offset = header.gd_offset
+    if gd_offset == GD_AT_END:
+        footer = _read_footer_header(file_)
+        if footer is None or footer.gd_offset == GD_AT_END:
+            # No usable footer, walk the markers instead
+            file_.seek(0)
+            return count_stream_grains(file_, read_stream_header(file_))
+        gd_offset = footer.gd_offset
+    num_grains = -(-header.capacity // header.grain_size)
+    num_gts = -(-num_grains // header.num_gtes_per_gt)
+    file_.seek(gd_offset * SECTOR_SIZE)
+    directory = struct.unpack(f"<{num_gts}I", _read_exact(file_, num_gts * 4))
+    allocated = 0
+    for gt_offset in directory:
+        if not gt_offset:
+            continue
+        file_.seek(gt_offset * SECTOR_SIZE)
+        table = struct.unpack(
+            f"<{header.num_gtes_per_gt}I", _read_exact(file_, header.num_gtes_per_gt * 4)
+        )
+        # 0 is unallocated and 1 is an explicitly zeroed grain
+        allocated += sum(1 for entry in table if entry > 1)
+    return allocated
+
+
+class VMDKInfo:
+    """ Summary of a VMDK file: its header, descriptor, size and allocation """
+
+    def __init__(self, path, count_grains=False):
+        """ Read the VMDK at path. Counting allocated grains reads every grain table """
+        self.path = path
+        self.header = None
+        self.descriptor = None
+        self.allocated_grains = None
+        with open(path, "rb") as file_:
+            start = file_.read(SECTOR_SIZE)
+            if start.startswith(DESCRIPTOR_SIGNATURE):
+                # A text descriptor file pointing at flat or sparse extent files
+                file_.seek(0)
+                self.descriptor = VMDKDescriptor(file_.read().decode("utf-8", errors="replace"))
+                return
+            self.header = SparseExtentHeader(start)
+            self.descriptor = read_descriptor(file_, self.header)
+            if count_grains:
+                self.allocated_grains = count_allocated_grains(file_, self.header)
+
+    @property
+    def virtual_size(self):
+        """ Return the size of the virtual disk in bytes """
+        if self.header is not None:
+            return self.header.virtual_size
+        return self.descriptor.virtual_size
+
+    @property
+    def allocated_size(self):
+        """ Return the bytes of guest data stored in the extent, None if not counted """
+        if self.allocated_grains is None:
+            return None
+        return self.allocated_grains * self.header.grain_bytes
+
+
+def peek_virtual_size(data):
+    """ Return the virtual size from the first bytes of a sparse VMDK, None if it isn't one """
+    try:
+        return SparseExtentHeader(data).virtual_size
+    except VMDKFormatError:
+        return None
+
+
+def get_virtual_size(path):
+    """ Return the virtual ("thick") size of a VMDK file in bytes """
+    return VMDKInfo(path).virtual_size
@@ -0,0 +1,312 @@
+""" Warm migration - copy a running VM's disks, then only what changed since, using CBT """
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep, time
+
+from pyVmomi import vim
+
+from voithos.lib.vmware.common import debug
+from voithos.lib.vmware.datastore import (
+    get_cookies,
+    get_file_url,
+    get_flat_path,
+    get_unique_names,
+)
+from voithos.lib.vmware.progress import bytes_to_gb, bytes_to_mb
+from voithos.lib.vmware.sparse import iter_runs, punch_hole
+from voithos.lib.vmware.transfer import (
+    CONNECT_TIMEOUT,
+    DEFAULT_CHUNK_SIZE,
+    READ_TIMEOUT,
+    VMWareDownloadFailed,
+    get_session,
+)
+
+
+SNAPSHOT_NAME = "voithos-warm-migration"
+WARM_SYNC_PASSES = 3  # incremental passes while the VM runs, before shutting it down
+MIN_DELTA_BYTES = 1024 * 1024 * 1024  # 1 GB - stop syncing online once a pass copies less
+TASK_TIMEOUT = 3600  # seconds
+SHUTDOWN_TIMEOUT = 900  # seconds
+POLL_INTERVAL = 5  # seconds
+
+
+class VMWareWarmMigrationFailed(Exception):
+    """ The warm migration could not continue """
+
+
+def wait_for_task(task, timeout=TASK_TIMEOUT, poll_interval=1):
+    """ Wait for a vSphere task to finish and return its result, raising if it failed """
+    deadline = time() + timeout
+    while task.info.state not in (vim.TaskInfo.State.success, vim.TaskInfo.State.error):
+        if time() > deadline:
+            raise VMWareWarmMigrationFailed(f"ERROR: Task {task.info.key} timed out")
+        sleep(poll_interval)
+    if task.info.state == vim.TaskInfo.State.error:
+        raise VMWareWarmMigrationFailed(f"ERROR: Task {task.info.key} failed: {task.info.error}")
+    return task.info.result
+
+
+class WarmSyncState:
+    """Sidecar JSON file with the changeId each local disk copy is current to
+
+    Kept between runs, so an interrupted warm migration continues incrementally instead of
+    copying every disk again.
+    """
+
+    def __init__(self, path):
+        """ Load the state at path, if there is one """
+        self.path = path
+        self.passes = 0
+        self.disks = {}  # str(device key): {"file", "change_id", "capacity"}
+        if os.path.exists(path):
+            with open(path) as file_:
+                data = json.load(file_)
+            self.passes = data["passes"]
+            self.disks = data["disks"]
+
+    def get_change_id(self, key, file_path):
+        """ Return the changeId the local copy of a disk is current to, "*" if it has none """
+        entry = self.disks.get(key)
+        if entry is None or entry["file"] != file_path or not os.path.exists(file_path):
+            return "*"
+        return entry["change_id"]
+
+    def save(self):
+        """ Write the state to disk """
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file_:
+            json.dump({"passes": self.passes, "disks": self.disks}, file_, indent=2)
+            file_.flush()
+            os.fsync(file_.fileno())
+        os.replace(tmp_path, self.path)
+
+
+class WarmMigration:
+    """Copy a VM's disks to raw files while it runs, then sync the changes after shutdown
+
+    Each pass snapshots the VM, asks QueryChangedDiskAreas which extents of each disk changed
+    since the previous pass ("*" - every allocated extent - on the first one), copies those
+    extents from the frozen base disks through the datastore /folder HTTP interface, then
+    removes the snapshot. Passes repeat while the VM runs until one copies less than
+    min_delta_bytes or max_passes is reached. The VM is then shut down and a final pass
+    makes the copies consistent, so downtime is only the final delta.
+    """
+
+    def __init__(
+        self,
+        vmware_mgr,
+        vm,
+        base_dir=None,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        max_passes=WARM_SYNC_PASSES,
+        min_delta_bytes=MIN_DELTA_BYTES,
+        shutdown=True,
+        shutdown_timeout=SHUTDOWN_TIMEOUT,
+    ):
+        """Construct the migration, nothing is copied until run()
+
+        With shutdown=True the guest OS is asked to shut down before the final pass,
+        otherwise the final pass waits for the VM to be powered off by other means.
+        """
+        self.vmware_mgr = vmware_mgr
+        self.vm = vm
+        self.base_dir = base_dir if base_dir is not None else os.getcwd()
+        self.chunk_size = chunk_size
+        self.max_passes = max_passes
+        self.min_delta_bytes = min_delta_bytes
+        self.shutdown = shutdown
+        self.shutdown_timeout = shutdown_timeout
+        self.state = WarmSyncState(self.state_path)
+        self.session = None
+
+    @property
+    def state_path(self):
+        """ Return the path of the sidecar file tracking each disk's changeId """
+        return os.path.join(self.base_dir, f"{self.vm.config.uuid}.warm.json")
+
+    @property
+    def powered_off(self):
+        """ Return True if the VM is powered off """
+        return self.vm.runtime.powerState == vim.VirtualMachine.PowerState.poweredOff
+
+    def get_file_paths(self, disks):
+        """Return {disk key: local raw file it is copied to}
+
+        Disks with the same file name on different datastores get distinct files, see
+        get_unique_names.
+        """
+        names = get_unique_names([disk.backing.fileName for disk in disks])
+        return {
+            disk.key: os.path.join(self.base_dir, f"{os.path.splitext(name)[0]}.raw")
+            for disk, name in zip(disks, names)
+        }
+
+    def get_session(self):
+        """Return the HTTP session authenticated as the vSphere API session, creating it once
+
+        Not thread-safe, sync_pass creates it before starting the copy threads.
+        """
+        if self.session is None:
+            self.session = get_session(pool_size=len(self.vm.config.hardware.device))
+            self.session.cookies.update(get_cookies(self.vmware_mgr))
+        return self.session
+
+    def enable_cbt(self):
+        """ Turn on Changed Block Tracking, it takes effect with the next snapshot """
+        if self.vm.config.changeTrackingEnabled:
+            return
+        print("Enabling Changed Block Tracking")
+        spec = vim.vm.ConfigSpec(changeTrackingEnabled=True)
+        wait_for_task(self.vm.ReconfigVM_Task(spec=spec))
+
+    def run(self):
+        """ Sync while the VM runs, shut it down, then run the final pass """
+        if self.vm.snapshot is not None:
+            raise VMWareWarmMigrationFailed(
+                "ERROR: The VM has snapshots, remove them before a warm migration"
+            )
+        self.enable_cbt()
+        online_passes = 0
+        while not self.powered_off:
+            copied = self.sync_pass()
+            online_passes += 1
+            if copied < self.min_delta_bytes:
+                debug(f"pass copied {copied} bytes, below {self.min_delta_bytes}, stopping")
+                break
+            if online_passes >= self.max_passes:
+                break
+        self.wait_for_power_off()
+        self.sync_pass(final=True)
+        print(f"Warm migration complete after {self.state.passes} passes")
+
+    def wait_for_power_off(self):
+        """ Shut the guest down, or wait for it to be powered off """
+        if self.powered_off:
+            return
+        if self.shutdown:
+            print("Shutting down the guest OS for the final sync")
+            self.vm.ShutdownGuest()
+        else:
+            print("Waiting for the VM to be powered off for the final sync")
+        deadline = time() + self.shutdown_timeout
+        while not self.powered_off:
+            if time() > deadline:
+                raise VMWareWarmMigrationFailed(
+                    f"ERROR: The VM was still on after {self.shutdown_timeout}s"
+                )
+            sleep(POLL_INTERVAL)
+
+    def sync_pass(self, final=False):
+        """ Snapshot the VM and copy every disk's changed extents, return the bytes copied """
+        start = time()
+        kind = "Final" if final else "Online"
+        print(f"{kind} pass {self.state.passes + 1}: creating snapshot")
+        snapshot = wait_for_task(
+            self.vm.CreateSnapshot_Task(
+                name=SNAPSHOT_NAME,
+                description="Temporary snapshot for a voithos warm migration",
+                memory=False,
+                quiesce=False,
+            )
+        )
+        try:
+            disks = [
+                device
+                for device in snapshot.config.hardware.device
+                if isinstance(device, vim.vm.device.VirtualDisk)
+            ]
+            file_paths = self.get_file_paths(disks)
+            self.get_session()  # created once here, the copy threads only share it
+            with ThreadPoolExecutor(max_workers=max(len(disks), 1)) as pool:
+                copied = sum(
+                    pool.map(
+                        lambda disk: self.sync_disk(snapshot, disk, file_paths[disk.key]), disks
+                    )
+                )
+        finally:
+            wait_for_task(snapshot.RemoveSnapshot_Task(removeChildren=False))
+        self.state.passes += 1
+        self.state.save()
+        seconds = max(time() - start, 0.001)
+        speed = bytes_to_mb(copied / seconds)
+        print(f"  copied {bytes_to_gb(copied)} GB in {int(seconds)}s [AVG SPEED: {speed} MB/s]")
+        return copied
+
+    def sync_disk(self, snapshot, disk, file_path):
+        """ Copy the extents of one disk that changed since its last sync to file_path """
+        key = str(disk.key)
+        change_id = self.state.get_change_id(key, file_path)
+        areas = self.get_changed_areas(snapshot, disk, change_id)
+        url = get_file_url(self.vmware_mgr.ip_addr, self.vm, get_flat_path(disk.backing.fileName))
+        fresh = change_id == "*"
+        copied = 0
+        flags = os.O_RDWR | os.O_CREAT | (os.O_TRUNC if fresh else 0)
+        fd = os.open(file_path, flags, 0o644)
+        try:
+            os.ftruncate(fd, disk.capacityInBytes)
+            for start, length in areas:
+                copied += self.copy_range(url, fd, start, length, fresh)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.state.disks[key] = {
+            "file": file_path,
+            "change_id": disk.backing.changeId,
+            "capacity": disk.capacityInBytes,
+        }
+        debug(f"{file_path}: {len(areas)} changed areas, {copied} bytes since {change_id}")
+        return copied
+
+    def get_changed_areas(self, snapshot, disk, change_id):
+        """ Return (start, length) of every extent of disk that changed since change_id """
+        areas = []
+        offset = 0
+        while offset < disk.capacityInBytes:
+            try:
+                info = self.vm.QueryChangedDiskAreas(
+                    snapshot=snapshot, deviceKey=disk.key, startOffset=offset, changeId=change_id
+                )
+            except vim.fault.VimFault as exc:
+                if change_id != "*":
+                    raise VMWareWarmMigrationFailed(
+                        f"ERROR: CBT query for {disk.backing.fileName} failed, delete "
+                        f"{self.state_path} to copy it in full: {exc}"
+                    ) from exc
+                # Some datastores can't list allocated areas, copy the whole disk instead
+                debug(f"allocated area query failed, copying all of {disk.backing.fileName}")
+                return [(0, disk.capacityInBytes)]
+            areas += [(area.start, area.length) for area in info.changedArea or []]
+            if not info.length:
+                break
+            offset = info.startOffset + info.length
+        return areas
+
+    def copy_range(self, url, fd, start, length, fresh):
+        """Copy length bytes at start of the remote flat file into fd, in chunk_size ranges
+
+        Zero runs are left as holes. In a file that already holds an earlier copy they are
+        punched, since the data they replace may not be zero.
+        """
+        session = self.get_session()
+        copied = 0
+        end = start + length
+        for range_start in range(start, end, self.chunk_size):
+            range_end = min(range_start + self.chunk_size, end)
+            headers = {"Range": f"bytes={range_start}-{range_end - 1}"}
+            timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+            resp = session.get(url, headers=headers, timeout=timeout)
+            resp.raise_for_status()
+            data = resp.content
+            if resp.status_code != 206 or len(data) != range_end - range_start:
+                raise VMWareDownloadFailed(f"ERROR: {url} did not return {headers['Range']}")
+            view = memoryview(data)
+            for run_start, run_end, zero in iter_runs(view):
+                offset = range_start + run_start
+                if not zero:
+                    os.pwrite(fd, view[run_start:run_end], offset)
+                elif not fresh:
+                    punch_hole(fd, offset, run_end - run_start)
+            copied += len(data)
+        return copied